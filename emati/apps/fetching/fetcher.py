@@ -1,16 +1,53 @@
 from django.db.utils import IntegrityError
 from django.conf import settings
+from django import db
 
+import time
+import threading
 import importlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import date, timedelta
-from website.models import Article
+from django.db.models import Max
+from website.models import Article, IngestBatch, FetchWindow
+from .sources import scheduler
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+# Number of titles that are searched with a single query
+TITLES_PER_QUERY = 20
+
+# Number of title queries that are sent at the same time. Calls to each
+# source are still limited by its semaphore.
+PARALLEL_TITLE_QUERIES = 4
+
+# Number of titles that are looked up in the database at once
+TITLE_LOOKUP_BATCH_SIZE = 500
+
+
+# One semaphore per type of source. Limits the number of concurrent calls to
+# a source across all fetchers of this process.
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+
+def _get_semaphore(source):
+    with _semaphores_lock:
+        key = type(source)
+        if key not in _semaphores:
+            _semaphores[key] = threading.BoundedSemaphore(
+                source.max_concurrent_requests
+            )
+        return _semaphores[key]
+
+
 class Fetcher:
-    """Loads articles from various sources and stores them in a database."""
+    """Loads articles from various sources and stores them in a database.
+
+    All sources are called concurrently, each in its own thread. Thus the
+    time a query takes is that of the slowest source, not the sum of all.
+    """
 
     def __init__(self):
         self.sources = []
@@ -49,47 +86,319 @@ class Fetcher:
     def download(self, query, start_date=None, end_date=None):
         """Searches all sources for the given query string. Stores articles 
         in the database. The searched time span can be limited via 
-        `start_date` and `end_date`."""
+        `start_date` and `end_date`.
+
+        All articles that were added are recorded as an `IngestBatch`.
+        Returns this batch or None if no articles were added."""
+        last_id = self._get_last_article_id()
+        self._call_all('download', query, start_date, end_date, timeout=False)
+        for (name, counters) in sorted(scheduler.get_counters().items()):
+            logger.info("Requests to {}: {}".format(name, counters))
+        return self._record_ingest_batch(last_id)
+
+
+    def download_range(self, start_date, end_date, jobs=1, resume=False):
+        """Downloads all articles published within a long time span.
+
+        The time span is broken down into windows of one week for each
+        source. Sources that can't download a given time span (see
+        `supports_date_range`) get a single window for the whole span. Every
+        window is recorded as a `FetchWindow` and downloaded by one of `jobs`
+        threads. With `resume`, windows that were done by an earlier run are
+        skipped, so an interrupted backfill continues where it stopped.
+
+        All articles that were added are recorded as a single `IngestBatch`.
+        Returns this batch or None if no articles were added."""
+        windows = self._get_windows(start_date, end_date, resume)
+        logger.info("{} windows to download".format(len(windows)))
+
+        last_id = self._get_last_article_id()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            statuses = list(executor.map(self._download_window, windows))
+
+        num_failed = statuses.count(FetchWindow.Status.FAILED)
+        if num_failed:
+            logger.warning("{} windows failed. Resume to try them again.".format(num_failed))
+        return self._record_ingest_batch(last_id)
+
+
+    def _get_windows(self, start_date, end_date, resume):
+        """Returns a list of tuples (source, window) that must be downloaded,
+        ordered by date so that all sources are busy at the same time."""
+        def add_window(source, start, end):
+            w, _ = FetchWindow.objects.get_or_create(
+                source=self._get_source_name(source),
+                start_date=start,
+                end_date=end
+            )
+            if not (resume and w.status == FetchWindow.Status.DONE):
+                windows.append((source, w))
+
+        # Splitting the time span is of no use for sources that ignore it.
+        # They would load the same articles for every window.
+        windows = []
+        sources = []
         for s in self.sources:
-            s.download(query, start_date, end_date)
+            if s.supports_date_range:
+                sources.append(s)
+            else:
+                add_window(s, start_date, end_date)
+
+        while start_date <= end_date:
+            window_end = min(start_date + timedelta(days=6), end_date)
+            for s in sources:
+                add_window(s, start_date, window_end)
+            start_date += timedelta(days=7)
+        return windows
+
+
+    def _download_window(self, item):
+        """Downloads a `FetchWindow` and records whether it succeeded.
+        Runs in a separate thread. Returns the new status."""
+        source, window = item
+        try:
+            # Never show the result of an earlier run while downloading. If
+            # this run is aborted, the window stays in progress and is
+            # downloaded again when resuming.
+            window.status = FetchWindow.Status.IN_PROGRESS
+            window.save(update_fields=['status', 'updated'])
+
+            logger.info("Downloading {} ...".format(window))
+            try:
+                with _get_semaphore(source):
+                    source.download("", window.start_date, window.end_date)
+                window.status = FetchWindow.Status.DONE
+            except Exception:
+                logger.exception("Error while downloading {}".format(window))
+                window.status = FetchWindow.Status.FAILED
+            window.save(update_fields=['status', 'updated'])
+        finally:
+            # Each thread opens its own database connection
+            db.connection.close()
+        return window.status
+
+
+    def _get_source_name(self, source):
+        """Returns the import path of a source's class."""
+        return '{}.{}'.format(type(source).__module__, type(source).__name__)
+
+
+    def _get_last_article_id(self):
+        return Article.objects.aggregate(Max('pk'))['pk__max'] or 0
+
+
+    def _record_ingest_batch(self, previous_last_id):
+        """Creates a batch for all articles with a larger primary key than
+        `previous_last_id`. Primary keys are assigned in ascending order, so
+        these are exactly the articles that were added since then."""
+        last_id = self._get_last_article_id()
+        if last_id <= previous_last_id:
+            return None
+        batch = IngestBatch.objects.create(
+            first_article_id=previous_last_id + 1,
+            last_article_id=last_id
+        )
+        logger.info("Recorded new articles {}-{}".format(
+            batch.first_article_id, batch.last_article_id
+        ))
+        return batch
 
     
     def query(self, query, start_date=None, end_date=None, max_results=10):
         """Query all sources for a given query string."""
-        articles = []
-        for s in self.sources:
-            articles += s.query(
-                query, 
-                start_date=start_date, 
-                end_date=end_date, 
-                max_results=max_results
-            )
-        return articles
+        return self._merge(self._call_all(
+            'query',
+            query, 
+            start_date=start_date, 
+            end_date=end_date, 
+            max_results=max_results
+        ))
 
     
     def query_title(self, query, start_date=None, end_date=None, max_results=10):
         """Query all sources for a query string but only look at titles."""
-        articles = []
-        for s in self.sources:
-            articles += s.query_title(
-                query, 
-                start_date=start_date, 
-                end_date=end_date, 
-                max_results=max_results
+        return self._merge(self._call_all(
+            'query_title',
+            query, 
+            start_date=start_date, 
+            end_date=end_date, 
+            max_results=max_results
+        ))
+
+    def query_titles(self, titles, max_results=10, failed=None):
+        """Query all sources for several titles at once. Sources that failed
+        or timed out are appended to the list `failed`, if given."""
+        return self._merge(self._call_all(
+            'query_titles',
+            titles,
+            max_results=max_results,
+            failed=failed
+        ))
+
+
+    def resolve_titles(self, titles, failed=None):
+        """Finds the articles with the given titles.
+
+        Titles are compared after `Article.normalize_title()`. Articles in the
+        database are found with a single lookup. All others are searched in
+        the sources, many titles per query (see `query_titles()`).
+
+        Args:
+            titles (list): The titles to look up.
+            failed (list): If given, titles that were not found and that a
+                source failed to search for are appended. Looking them up
+                again later might find them.
+
+        Returns:
+            A dict that maps each title that was found to its article.
+            Articles from the database are saved, all others are not.
+        """
+        by_key = {}
+        for t in titles:
+            key = Article.normalize_title(Article.truncate_title(t))
+            if key:
+                by_key.setdefault(key, []).append(t)
+
+        found = {}
+        keys = list(by_key)
+        for start in range(0, len(keys), TITLE_LOOKUP_BATCH_SIZE):
+            for a in Article.objects.filter(
+                normalized_title__in=keys[start:start + TITLE_LOOKUP_BATCH_SIZE]
+            ):
+                found[a.normalized_title] = a
+        logger.info("Found {}/{} titles in the database".format(len(found), len(keys)))
+
+        missing = [by_key[k][0] for k in keys if k not in found]
+        groups = [
+            missing[i:i + TITLES_PER_QUERY]
+            for i in range(0, len(missing), TITLES_PER_QUERY)
+        ]
+        def query(group):
+            failed_sources = []
+            articles = self.query_titles(
+                group, max_results=3 * len(group), failed=failed_sources
             )
-        return articles
+            return group, articles, failed_sources
+
+        unsure = set()
+        with ThreadPoolExecutor(max_workers=PARALLEL_TITLE_QUERIES) as executor:
+            for (group, articles, failed_sources) in executor.map(query, groups):
+                for a in articles:
+                    key = Article.normalize_title(Article.truncate_title(a.title))
+                    found.setdefault(key, a)
+                if failed_sources:
+                    unsure.update(
+                        Article.normalize_title(Article.truncate_title(t))
+                        for t in group
+                    )
+
+        if failed is not None:
+            for key in unsure:
+                if key not in found:
+                    failed += by_key[key]
+
+        result = {}
+        for (key, ts) in by_key.items():
+            if key in found:
+                for t in ts:
+                    result[t] = found[key]
+        return result
+
 
     def query_pmid(self, pmid_list, start_date=None, end_date=None, max_results=100):
         """Query all sources for a given list of PMIDs."""
+        # Not every source knows PMIDs
+        sources = [s for s in self.sources if hasattr(s, 'query_pmid')]
+        return self._merge(self._call_all(
+            'query_pmid',
+            pmid_list,
+            start_date=start_date,
+            end_date=end_date,
+            max_results=max_results,
+            sources=sources
+        ))
+
+
+    def _merge(self, results):
         articles = []
-        for s in self.sources:
-            try:
-                 articles += s.query_pmid(
-                    pmid_list,
-                    start_date=start_date,
-                    end_date=end_date,
-                    max_results=max_results
-                )
-            except:
-                continue
-        return articles
\ No newline at end of file
+        for (source, result) in results:
+            articles += result
+        return articles
+
+
+    def _call_all(self, method, *args, timeout=True, sources=None, failed=None, **kwargs):
+        """Calls a method of all sources concurrently.
+
+        Args:
+            method (string): The name of the method.
+            timeout (bool): Whether to stop waiting for a source after its
+                `query_timeout`.
+            sources (list): Only call these sources instead of all.
+            failed (list): If given, sources that failed or timed out are
+                appended to it.
+
+        Returns:
+            A list of tuples (source, result) in the order in which the
+            sources finished. Sources that failed or timed out are logged
+            and left out.
+        """
+        if sources is None:
+            sources = self.sources
+        if not sources:
+            return []
+
+        executor = ThreadPoolExecutor(max_workers=len(sources))
+        start = time.time()
+        deadlines = {}
+        futures = {}
+        for s in sources:
+            f = executor.submit(self._call, s, method, args, kwargs)
+            futures[f] = s
+            deadlines[f] = start + s.query_timeout if timeout else None
+
+        results = []
+        pending = set(futures)
+        while pending:
+            next_deadline = min(
+                (d for d in (deadlines[f] for f in pending) if d is not None),
+                default=None
+            )
+            wait_time = None
+            if next_deadline is not None:
+                wait_time = max(0, next_deadline - time.time())
+            done, pending = wait(pending, timeout=wait_time, return_when=FIRST_COMPLETED)
+
+            for f in done:
+                try:
+                    results.append((futures[f], f.result()))
+                except Exception:
+                    logger.exception("Error in {}.{}".format(
+                        type(futures[f]).__name__, method
+                    ))
+                    if failed is not None:
+                        failed.append(futures[f])
+
+            # Give up on sources that took too long
+            now = time.time()
+            for f in list(pending):
+                if deadlines[f] is not None and deadlines[f] <= now:
+                    logger.warning("{}.{} timed out".format(
+                        type(futures[f]).__name__, method
+                    ))
+                    pending.remove(f)
+                    if failed is not None:
+                        failed.append(futures[f])
+
+        # Don't wait for threads of sources that timed out
+        executor.shutdown(wait=False)
+        return results
+
+
+    def _call(self, source, method, args, kwargs):
+        """Calls a method of a source. Runs in a separate thread."""
+        try:
+            with _get_semaphore(source):
+                return getattr(source, method)(*args, **kwargs)
+        finally:
+            # Each thread opens its own database connection
+            db.connection.close()
\ No newline at end of file
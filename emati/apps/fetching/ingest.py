@@ -0,0 +1,133 @@
+"""Stores downloaded articles in the database in bulk.
+
+Example:
+    from fetching.ingest import store_articles
+    result = store_articles(articles)
+    print(result.inserted, result.duplicates)
+"""
+
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.utils import IntegrityError
+
+from website.models import Article
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Maximum number of articles inserted per query
+BULK_SIZE = 500
+
+
+IngestResult = namedtuple('IngestResult', ['inserted', 'duplicates'])
+
+# Fields of Article that identify an article at its source
+IDENTIFIER_FIELDS = ('pmid', 'arxiv_id', 'doi')
+
+
+def get_known_ids(field, ids):
+    """Returns the set of those `ids` that already exist in the given
+    field (e.g. 'pmid' or 'title') of any article."""
+    ids = list(set(ids))
+    known = set()
+    for start in range(0, len(ids), BULK_SIZE):
+        known.update(Article.objects.filter(**{
+            field + '__in': ids[start:start + BULK_SIZE]
+        }).values_list(field, flat=True))
+    return known
+
+
+def drop_known_ids(field, ids):
+    """Returns the list of `ids` without those that already exist in the
+    given identifier field, keeping their order."""
+    known = get_known_ids(field, ids)
+    return [i for i in ids if i not in known]
+
+
+def store_articles(articles):
+    """Inserts articles that are not in the database yet.
+
+    Articles are unique by title. Titles are truncated the same way as in
+    `Article.save()`. Duplicates within `articles` and articles that already
+    exist, either with the same title or the same source identifier (see
+    `IDENTIFIER_FIELDS`), are skipped. All others are inserted with a few
+    bulk queries in a single transaction.
+
+    If the bulk insert fails anyway (e.g. because another process inserted
+    the same article in the meantime, or because the database compares
+    titles case-insensitively), every article is inserted separately
+    inside its own savepoint.
+
+    Args:
+        articles (list): Unsaved instances of Article. `None` entries are
+            ignored.
+
+    Returns:
+        An IngestResult with the number of inserted articles and the number
+        of articles that were skipped as duplicates.
+    """
+    unique = {}
+    num_articles = 0
+    for a in articles:
+        if a is None:
+            continue
+        num_articles += 1
+        a.title = Article.truncate_title(a.title)
+        a.normalized_title = Article.normalize_title(a.title)
+        unique.setdefault(a.title, a)
+
+    if not unique:
+        return IngestResult(0, num_articles)
+
+    # Few queries to find those that already exist
+    new_articles = list(unique.values())
+    existing = get_known_ids('title', [a.title for a in new_articles])
+    new_articles = [a for a in new_articles if a.title not in existing]
+    for field in IDENTIFIER_FIELDS:
+        new_articles = _drop_known_articles(field, new_articles)
+
+    try:
+        with transaction.atomic():
+            Article.objects.bulk_create(new_articles, batch_size=BULK_SIZE)
+        inserted = len(new_articles)
+    except IntegrityError:
+        logger.info("Bulk insert failed. Inserting articles one by one ...")
+        inserted = _store_separately(new_articles)
+
+    return IngestResult(inserted, num_articles - inserted)
+
+
+def _drop_known_articles(field, articles):
+    """Removes articles whose identifier in `field` already exists in the
+    database or appeared earlier in the list."""
+    ids = [getattr(a, field) for a in articles if getattr(a, field)]
+    if not ids:
+        return articles
+    seen = get_known_ids(field, ids)
+    result = []
+    for a in articles:
+        value = getattr(a, field)
+        if value:
+            if value in seen:
+                continue
+            seen.add(value)
+        result.append(a)
+    return result
+
+
+def _store_separately(articles):
+    """Inserts articles one by one, skipping those that already exist.
+    Returns the number of inserted articles."""
+    inserted = 0
+    with transaction.atomic():
+        for a in articles:
+            try:
+                # A savepoint keeps the transaction usable after an error
+                with transaction.atomic():
+                    a.save()
+                inserted += 1
+            except IntegrityError:
+                pass
+    return inserted
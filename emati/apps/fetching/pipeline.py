@@ -0,0 +1,104 @@
+"""A small framework to run processing stages concurrently.
+
+Each stage runs in its own thread. Stages are connected by bounded queues, so
+a fast stage waits for a slow one instead of piling up items in memory.
+
+Example:
+    pages = download_pages()
+    for articles in run_pipeline(pages, [parse, format]):
+        store(articles)
+"""
+
+import queue
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Marks the end of a stream of items
+_DONE = object()
+
+
+class _Failure:
+    """Passes an exception of a stage on to the consumer."""
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def run_pipeline(items, stages, queue_size=2):
+    """Feeds items through a list of stages.
+
+    Args:
+        items (iterable): The input. Iterated in a separate thread, so this
+            can be a generator that e.g. downloads the items.
+        stages (list): Functions that are applied to every item, one after
+            another. Each one runs in a separate thread.
+        queue_size (int): Maximum number of items waiting between two
+            stages.
+
+    Yields:
+        The results of the last stage in the order of the input. If any
+        stage raises an exception, the pipeline is stopped and the exception
+        is raised here.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+
+    def put(q, item):
+        # Give up if the consumer stopped, instead of blocking forever
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(queues[0], item):
+                    return
+        except Exception as e:
+            put(queues[0], _Failure(e))
+        put(queues[0], _DONE)
+
+    def work(func, q_in, q_out):
+        while True:
+            try:
+                item = q_in.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return
+                continue
+            if item is _DONE or isinstance(item, _Failure):
+                put(q_out, item)
+                return
+            try:
+                result = func(item)
+            except Exception as e:
+                put(q_out, _Failure(e))
+                return
+            if not put(q_out, result):
+                return
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    for i, func in enumerate(stages):
+        threads.append(threading.Thread(
+            target=work, args=(func, queues[i], queues[i + 1]), daemon=True
+        ))
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        # Unblock all threads, e.g. if the consumer stopped early
+        stop.set()
@@ -3,8 +3,24 @@
 Inherit from this class to implement a new source for articles.
 """
 
+import feedparser
+import requests
+from datetime import date
+
 from django.conf import settings
 
+from .cache import get_cache
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Seconds to wait for a response to a single request
+REQUEST_TIMEOUT_SECONDS = 60
+
+# Maximum number of open connections per host kept by each source
+CONNECTION_POOL_SIZE = 10
+
 
 class AbstractSource:
 
@@ -16,6 +32,27 @@ class AbstractSource:
         else:
             self.batch_size = 1000
 
+        # Used by the Fetcher, which queries all sources concurrently.
+        # Subclasses may overwrite these to suit their service.
+        self.query_timeout = settings.FETCHING_QUERY_TIMEOUT
+        self.max_concurrent_requests = settings.FETCHING_MAX_CONCURRENT_REQUESTS
+
+        # Whether `download()` only loads articles of the given time span.
+        # Backfills split long time spans into windows only for such sources.
+        self.supports_date_range = True
+
+        # Sends all requests of this source (see `scheduler.get_scheduler()`).
+        # Must be set by subclasses.
+        self.scheduler = None
+
+        # Reuses connections across requests and threads (see `_get()`)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=CONNECTION_POOL_SIZE, pool_maxsize=CONNECTION_POOL_SIZE
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
 
     def query(self, query, start_date=None, end_date=None, max_results=10):
         raise NotImplementedError("The 'query' method was not implemented.")
@@ -25,5 +62,76 @@ class AbstractSource:
         raise NotImplementedError("The 'query_title' method was not implemented.")
 
 
+    def query_titles(self, titles, max_results=10):
+        """Searches for several titles at once. Returns a list of articles
+        which may contain any number of matches per title.
+
+        Sources should override this to send a single query. By default every
+        title is searched separately.
+        """
+        articles = []
+        for t in titles:
+            articles += self.query_title(t, max_results=max_results)
+        return articles
+
+
     def download(self, query, start_date=None, end_date=None):
-        raise NotImplementedError("The 'download' method was not implemented.")
\ No newline at end of file
+        raise NotImplementedError("The 'download' method was not implemented.")
+
+
+    def _is_final(self, end_date):
+        """Checks whether a time span ended before today. Listings of such
+        a time span don't change anymore and may be cached."""
+        return end_date is not None and end_date < date.today()
+
+
+    def _get(self, url, headers=None, cacheable=False):
+        """Sends a GET request via the scheduler of this source.
+
+        Args:
+            url (string): The URL to load.
+            headers (dict): Optional headers, e.g. for a conditional request.
+            cacheable (bool): Whether the response can't change anymore and
+                may be answered from the cache (see `cache.get_cache()`).
+
+        Returns:
+            A tuple (content, response). `content` is the body as bytes or
+            empty if the server answered "304 Not Modified". `response` is
+            None if the content came from the cache.
+
+        Raises:
+            An exception if the request failed.
+        """
+        responses = []
+        def send():
+            response = self.session.get(
+                url, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS
+            )
+            responses.append(response)
+            if response.status_code == 304:
+                return b''
+            response.raise_for_status()
+            return response.content
+
+        request = {'url': url}
+        if headers:
+            request['headers'] = headers
+        content = get_cache().fetch(
+            self.scheduler.name, request, lambda: self.scheduler.call(send),
+            cacheable=cacheable
+        )
+        return content, (responses[-1] if responses else None)
+
+
+    def _parse_feed(self, url, cacheable=False):
+        """Loads and parses a feed (see `_get()`).
+
+        Returns the result of `feedparser.parse()` or None if the feed could
+        not be loaded.
+        """
+        try:
+            content, _ = self._get(url, cacheable=cacheable)
+        except Exception:
+            logger.error("Could not load {}".format(url), exc_info=True)
+            return None
+        return feedparser.parse(content)
\ No newline at end of file
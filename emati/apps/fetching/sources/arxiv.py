@@ -1,23 +1,29 @@
 #!/usr/bin/env python
 
+import re
 from datetime import date, datetime
 from pprint import pprint
-import feedparser
 
-from django.db.utils import IntegrityError
 from django.conf import settings
 from website.models import Article
 from .abstractsource import AbstractSource
+from .scheduler import get_scheduler
+from ..ingest import store_articles, get_known_ids
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+# arXiv asks for no more than one request every three seconds
+REQUESTS_PER_SECOND = 1 / 3
+
+
 class Arxiv(AbstractSource):
 
 
     def __init__(self):
         super().__init__()
+        self.scheduler = get_scheduler('arxiv', REQUESTS_PER_SECOND)
     
 
     def _compose_query(self, query, start_date=None, end_date=None):
@@ -51,6 +57,18 @@ class Arxiv(AbstractSource):
         return self.query(query, start_date, end_date, max_results, restrict_title=True)
 
 
+    def query_titles(self, titles, max_results=10):
+        """Searches for several titles in a single query."""
+        phrases = []
+        for t in titles:
+            words = re.sub(r'[^\w\s]', ' ', t).split()
+            if words:
+                phrases.append('ti:%22{}%22'.format('+'.join(words)))
+        if not phrases:
+            return []
+        return self.query('+OR+'.join(phrases), max_results=max_results)
+
+
     def query(self, query, start_date=None, end_date=None, max_results=10, restrict_title=False):
         """Retrieve articles from arXiv for a given query string and time span.
 
@@ -73,9 +91,12 @@ class Arxiv(AbstractSource):
 
         query = self._compose_query(query, start_date, end_date)
         results, _ = self._get_result_tuple(
-            query, start=0, max_results=max_results, search_type=search_type
+            query, start=0, max_results=max_results, search_type=search_type,
+            cacheable=self._is_final(end_date)
         )
-        
+        if results is None:
+            # Let the caller know, instead of pretending nothing was found
+            raise RuntimeError('Could not query arXiv for "{}"'.format(query))
         if not results:
             return []
 
@@ -95,55 +116,59 @@ class Arxiv(AbstractSource):
         query = self._compose_query(query, start_date, end_date)
         logger.info('Querying for "{}" ...'.format(query))
 
+        # Listings that include today may still grow
+        cacheable = self._is_final(end_date)
         start = 0
         results, total_num_results = self._get_result_tuple(
-            query, start=start, max_results=self.batch_size
+            query, start=start, max_results=self.batch_size, cacheable=cacheable
         )
+        if results is None:
+            # Let the caller know, e.g. to retry this time span later
+            raise RuntimeError('Could not query arXiv for "{}"'.format(query))
         if not results:
             logger.info("No results")
             return
 
         num_new_results = 0
-        num_integrity_errors = 0
+        num_duplicates = 0
         while results:
-            for result in results:
-                article = self._format_article(result)
-                if article is not None:
-                    try:
-                        article.save()
-                        num_new_results += 1
-                    except IntegrityError:
-                        # Uniqueness of articles is handled on database level.
-                        # Do not warn about every single IntegrityError.
-                        # Else they might flood the terminal messages.
-                        num_integrity_errors += 1
+            # Skip articles we already know
+            known = get_known_ids('arxiv_id', [self._get_arxiv_id(r) for r in results])
+            results = [r for r in results if self._get_arxiv_id(r) not in known]
+
+            stored = store_articles([self._format_article(r) for r in results])
+            num_new_results += stored.inserted
+            num_duplicates += stored.duplicates
 
             start += self.batch_size
             results, _ = self._get_result_tuple(
-                query, start=start, max_results=self.batch_size
+                query, start=start, max_results=self.batch_size, cacheable=cacheable
             )
+            if results is None:
+                # Don't skip the remaining results silently
+                raise RuntimeError('Could not load results {} to {} of arXiv '
+                    'query "{}"'.format(start, start + self.batch_size, query))
 
             logger.info("  {}/{}".format(
                 min(start, total_num_results), total_num_results)
             )
 
         logger.info("Fetched {} new articles.".format(num_new_results))
-        if num_integrity_errors > 0:
-            msg = "Could not save {} articles. ".format(num_integrity_errors)
-            msg += "They probably already existed in the database. "
-            msg += "(IntegrityError)"
-            logger.info(msg)
+        if num_duplicates > 0:
+            logger.info("Skipped {} articles that already existed in the "
+                "database.".format(num_duplicates))
 
 
     def _get_result_tuple(self, search_query, id_list=[], start=0, max_results=10, 
                      sort_by='relevance', sort_order='descending', 
-                     search_type='all'):
+                     search_type='all', cacheable=False):
         """
         Queries arxiv.org and parses the returned results. Returns the
         dictionary containing the complete response. Returns a tuple of 
         (results, num_results), where `results` is a list of the results 
         returned in this batch and `num_results` is the total amount of
-        results found for this query string.
+        results found for this query string. Set `cacheable` only if the
+        results can't change anymore (see `_is_final()`).
         """
         url = (
             'http://export.arxiv.org/api/query?'
@@ -163,9 +188,8 @@ class Arxiv(AbstractSource):
             sort_by, 
             sort_order
         )
-        result_dict = feedparser.parse(url)
-        if result_dict.get('status') != 200:
-            logger.error("HTTP Error " + str(result_dict.get('status', 'no status')) + " in query")
+        result_dict = self._parse_feed(url, cacheable)
+        if result_dict is None:
             return None, None
         else:
             total_num_results = int(result_dict['feed']['opensearch_totalresults'])
@@ -179,6 +203,8 @@ class Arxiv(AbstractSource):
         a.abstract = result['summary']
         a.journal = 'arXiv'
         a.url_source = result['link']
+        a.arxiv_id = self._get_arxiv_id(result)
+        a.doi = result.get('arxiv_doi')
         a.pubdate = datetime.strptime(
             # Given format: 2018-03-02T15:27:39Z
             result['published'].split('T')[0], '%Y-%m-%d'
@@ -202,5 +228,11 @@ class Arxiv(AbstractSource):
         return a
 
 
+    def _get_arxiv_id(self, result):
+        """Returns the arXiv identifier of a result without its version.
+        E.g. '1802.00001' for 'http://arxiv.org/abs/1802.00001v2'."""
+        return re.sub(r'v\d+$', '', result['id'].split('/abs/')[-1])
+
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
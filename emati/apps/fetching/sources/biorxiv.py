@@ -2,22 +2,68 @@
 
 from datetime import date, datetime
 from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
 import feedparser
 
-from django.db.utils import IntegrityError
 from django.conf import settings
-from website.models import Article
+from website.models import Article, FeedState
 from .abstractsource import AbstractSource
+from .scheduler import get_scheduler
+from ..ingest import store_articles, get_known_ids
 import re
 
 import logging
 logger = logging.getLogger(__name__)
 
+
+# bioRxiv doesn't publish a limit. Be polite.
+REQUESTS_PER_SECOND = 5
+
+# Number of feeds that are loaded at the same time
+PARALLEL_REQUESTS = 4
+
+# The subjects of bioRxiv. Each one has its own feed.
+CATEGORIES = [
+    'all',
+    'animal_behavior_and_cognition',
+    'biochemistry',
+    'bioengineering',
+    'bioinformatics',
+    'biophysics',
+    'cancer_biology',
+    'cell_biology',
+    'clinical_trials',
+    'developmental_biology',
+    'ecology',
+    'epidemiology',
+    'evolutionary_biology',
+    'genetics',
+    'genomics',
+    'immunology',
+    'microbiology',
+    'molecular_biology',
+    'neuroscience',
+    'paleontology',
+    'pathology',
+    'pharmacology_and_toxicology',
+    'physiology',
+    'plant_biology',
+    'scientific_communication_and_education',
+    'synthetic_biology',
+    'systems_biology',
+    'zoology',
+]
+
+
 class bioRxiv(AbstractSource):
 
 
     def __init__(self):
         super().__init__()
+        self.scheduler = get_scheduler('biorxiv', REQUESTS_PER_SECOND)
+
+        # The feeds only list the latest articles, whatever the dates
+        self.supports_date_range = False
 
     def query_title(self, query, start_date=None, end_date=None, max_results=10):
         """Same as a normal query but restricts the search to only titles."""
@@ -29,103 +75,112 @@ class bioRxiv(AbstractSource):
 
 
     def download(self, query, start_date=None, end_date=None):
-        logger.info('self "{}" download "{}" start_date "{}" end_date "{}" ...'.format(self, query, start_date, end_date))
         """Similar to `query()` but saves all results to the database.
 
-        In contrast to `query()` this doesn't return the articles. Instead
-        they are processed in batches and saved to the database.
+        bioRxiv's feeds can't be searched by date. Instead the feeds of all
+        categories are loaded at once and every new article is saved. Feeds
+        that didn't change since the last run are skipped (see `FeedState`).
         """
-        categories = [   'all',
-                         'animal_behavior_and_cognition',
-                         'biochemistry',
-                         'bioengineering',
-                         'bioinformatics',
-                         'biophysics',
-                         'cancer_biology',
-                         'cell_biology',
-                         'clinical_trials',
-                         'developmental_biology',
-                         'ecology',
-                         'epidemiology',
-                         'evolutionary_biology',
-                         'genetics',
-                         'genomics',
-                         'immunology',
-                         'microbiology',
-                         'molecular_biology',
-                         'neuroscience',
-                         'paleontology',
-                         'pathology',
-                         'pharmacology_and_toxicology',
-                         'physiology',
-                         'plant_biology',
-                         'scientific_communication_and_education',
-                         'synthetic_biology',
-                         'systems_biology',
-                         'zoology',
-                     ]
+        logger.info('self "{}" download "{}" start_date "{}" end_date "{}" ...'.format(self, query, start_date, end_date))
+        categories = CATEGORIES
         # use just 3 category for testing
         # categories = [ 'all','zoology', 'systems_biology' ]
 
+        urls = [self._get_url(c) for c in categories]
+        states = {s.url: s for s in FeedState.objects.filter(url__in=urls)}
+
         num_new_results = 0
-        num_integrity_errors = 0
-
-        while categories:
-            results, total_num_results = self._get_result_tuple(query, categories.pop())
-            for result in results:
-                article = self._format_article(result)
-                if article is not None:
-                    try:
-                        article.save()
-                        num_new_results += 1
-                    except IntegrityError:
-                        # Uniqueness of articles is handled on database level.
-                        # Do not warn about every single IntegrityError.
-                        # Else they might flood the terminal messages.
-                        num_integrity_errors += 1
-
-            logger.info("  {}/{}".format(
-                min(len(categories),total_num_results), total_num_results)
+        num_duplicates = 0
+        num_failed = 0
+
+        # Most articles appear in 'all' and in their subject. Only the first
+        # occurrence in this run is considered.
+        seen = set()
+
+        with ThreadPoolExecutor(max_workers=PARALLEL_REQUESTS) as executor:
+            feeds = executor.map(
+                lambda url: self._load_feed(url, states.get(url)), urls
             )
+            # Articles are saved in this thread, while the other feeds load
+            for i, (url, (results, validators)) in enumerate(zip(urls, feeds)):
+                if results is None:
+                    num_failed += 1
+                    continue
+
+                unique = {}
+                for r in results:
+                    key = self._get_doi(r) or r['link']
+                    if key not in seen:
+                        seen.add(key)
+                        unique[key] = r
+                results = list(unique.values())
+
+                # Skip articles we already know
+                known = get_known_ids('doi', [self._get_doi(r) for r in results if self._get_doi(r)])
+                results = [r for r in results if self._get_doi(r) not in known]
+
+                stored = store_articles([self._format_article(r) for r in results])
+                num_new_results += stored.inserted
+                num_duplicates += stored.duplicates
+
+                # Remember the feed's version only after its articles were saved
+                if validators is not None:
+                    FeedState.objects.update_or_create(url=url, defaults=validators)
+
+                logger.info("  {}/{}".format(i + 1, len(urls)))
 
         logger.info("Fetched {} new articles.".format(num_new_results))
-        if num_integrity_errors > 0:
-            msg = "Could not save {} articles. ".format(num_integrity_errors)
-            msg += "They probably already existed in the database. "
-            msg += "(IntegrityError)"
-            logger.info(msg)
+        if num_duplicates > 0:
+            logger.info("Skipped {} articles that already existed in the "
+                "database.".format(num_duplicates))
+        if num_failed == len(urls):
+            # Let the caller know, e.g. to retry later
+            raise RuntimeError("Could not load any bioRxiv feed")
 
 
-    def _get_result_tuple(self, search_query, category):
-        logger.info('_get_result_tuple search_query "{}" category "{}" ...'.format(search_query,category))
-        """
-        Queries biorxiv.org and parses the returned results. Returns the
-        dictionary containing the complete response. Returns a tuple of 
-        (results, num_results), where `results` is a list of the results 
-        returned in this batch and `num_results` is the total amount of
-        results found for this query string.
+    def _get_url(self, category):
+        return 'http://connect.biorxiv.org/biorxiv_xml.php?subject={}'.format(category)
+
+
+    def _load_feed(self, url, state=None):
+        """Loads and parses the feed of a category. Runs in a separate thread.
+
+        Args:
+            url (string): The URL of the feed.
+            state (FeedState): The validators of the last response, if any.
+
+        Returns:
+            A tuple (results, validators). `results` is the list of entries,
+            which is empty if the feed didn't change, or None if it could not
+            be loaded. `validators` is a dict of the new 'etag' and
+            'last_modified', or None if unknown.
         """
-        url = (
-            'http://connect.biorxiv.org/biorxiv_xml.php?subject='
-              '{}'
-        ).format(
-             category
-        )
-        result_dict = feedparser.parse(url)
-        if result_dict.get('status') != 200:
-            logger.error("HTTP Error " + str(result_dict.get('status', 'no status')) + " in query")
+        headers = state.get_headers() if state is not None else None
+        try:
+            content, response = self._get(url, headers)
+        except Exception:
+            logger.error("Could not load {}".format(url), exc_info=True)
             return None, None
-        else:
-            results = result_dict['entries']
-            total_num_results = len(results)
-            return results, total_num_results
-    
+        if not content:
+            logger.info("  unchanged: {}".format(url))
+            return [], None
+
+        validators = None
+        if response is not None:
+            validators = {
+                'etag': response.headers.get('ETag', ''),
+                'last_modified': response.headers.get('Last-Modified', ''),
+            }
+        return feedparser.parse(content)['entries'], validators
+
+
     def _format_article(self, result):
         a = Article()
         a.title = result['title']
         a.abstract = result['description']
         a.journal = 'bioRxiv'
         a.url_source = result['link']
+        a.doi = self._get_doi(result)
         a.pubdate = datetime.strptime(
             result['date'], '%Y-%m-%d'
         ).date()
@@ -147,5 +202,12 @@ class bioRxiv(AbstractSource):
         a.authors_list = authors
         return a
 
+    def _get_doi(self, result):
+        """Returns the DOI of a result (given as 'doi:10.1101/...') or None."""
+        identifier = result.get('dc_identifier', '')
+        if identifier.startswith('doi:'):
+            return identifier[len('doi:'):]
+        return None
+
 if __name__ == '__main__':
     pass
@@ -0,0 +1,220 @@
+"""An on-disk cache for the responses of the sources.
+
+Responses are stored as files named after a hash of the request, so the same
+request always maps to the same file. Each source has its own time to live.
+The cache is limited in size. If it grows too large, the least recently used
+responses are removed.
+
+Only responses that can't change are answered from the cache, e.g. the
+records of a fixed list of PMIDs or listings of a time span that ended
+before today. The callers decide this per request. Other
+responses are still stored so offline mode can replay them.
+
+In offline mode every request is answered from the cache, no matter how old
+the response is. Requests that were never cached fail instead of going to the
+network. This replays earlier runs exactly, e.g. for debugging or tests.
+
+Example:
+    from fetching.sources.cache import get_cache
+    data = get_cache().fetch('arxiv', {'url': url}, lambda: download(url))
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+from django.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# When the cache is too large, responses are removed until it is at most
+# this fraction of its maximum size
+EVICTION_TARGET = 0.9
+
+
+class CacheMiss(Exception):
+    """Raised in offline mode for requests that are not in the cache."""
+
+
+
+class ResponseCache:
+    """Stores responses (as bytes) in a directory.
+
+    The modification time of a file is the time the response was received.
+    Its access time is set explicitly whenever the response is read, so LRU
+    eviction doesn't depend on how the file system is mounted.
+
+    Args:
+        directory (string): Where to keep the responses.
+        max_size (int): Maximum total size of all responses in bytes.
+        ttl (dict): Seconds a response stays valid, by source. Sources that
+            are not listed are not cached.
+        offline (bool): Never go to the network (see module docs).
+    """
+
+    def __init__(self, directory, max_size, ttl, offline=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.offline = offline
+        self._size = None
+        self._lock = threading.Lock()
+
+
+    def fetch(self, source, request, send, cacheable=True):
+        """Returns the cached response to a request or sends it.
+
+        Args:
+            source (string): The name of the source, e.g. 'pubmed'.
+            request (dict): Everything that determines the response, e.g.
+                the URL or the parameters of an API call.
+            send (callable): Sends the request and returns the response as
+                bytes, or None if it failed. Failed requests are not cached.
+            cacheable (bool): Whether the response can't change anymore.
+                Otherwise the request is always sent, except in offline mode.
+
+        Returns:
+            The response as bytes or None.
+
+        Raises:
+            CacheMiss: In offline mode, if the response was never cached.
+        """
+        if source not in self.ttl and not self.offline:
+            return send()
+
+        path = self._get_path(source, request)
+        if self.offline:
+            data = self._read(path, None)
+        elif cacheable:
+            data = self._read(path, self.ttl[source])
+        else:
+            data = None
+        if data is not None:
+            return data
+        if self.offline:
+            raise CacheMiss("No cached response for {} {}".format(source, request))
+
+        data = send()
+        if data is not None:
+            self._write(path, data)
+        return data
+
+
+    def _get_path(self, source, request):
+        """Returns the file of a request. Its name is the hash of the request
+        with sorted keys, so equal requests share the same file."""
+        key = json.dumps([source, request], sort_keys=True, default=str)
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, source, digest[:2], digest)
+
+
+    def _read(self, path, ttl):
+        """Returns the content of a file or None if it doesn't exist or is
+        older than `ttl` seconds."""
+        try:
+            if ttl is not None and time.time() - os.path.getmtime(path) > ttl:
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Mark as recently used
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+            return data
+        except FileNotFoundError:
+            return None
+
+
+    def _write(self, path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Use a unique temporary name. Several threads might write at once.
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+
+        # An older response to the same request is replaced. Its size no
+        # longer counts.
+        try:
+            old_size = os.path.getsize(path)
+        except FileNotFoundError:
+            old_size = 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for (_, _, size) in self._list_files())
+            else:
+                self._size += len(data) - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+
+    def _evict(self):
+        """Removes the least recently used responses until the cache is
+        small enough. Must be called with the lock held."""
+        files = sorted(self._list_files())
+        target = self.max_size * EVICTION_TARGET
+        self._size = sum(size for (_, _, size) in files)
+        num_removed = 0
+        for (_, path, size) in files:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            num_removed += 1
+        logger.info("Removed {} responses from the cache".format(num_removed))
+
+
+    def _list_files(self):
+        """Returns a list of tuples (access time, path, size) of all cached
+        responses."""
+        files = []
+        for (root, _, names) in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_atime, path, stat.st_size))
+        return files
+
+
+
+class _NoCache:
+    """Used if no cache directory is configured. Sends every request."""
+
+    offline = False
+
+    def fetch(self, source, request, send, cacheable=True):
+        return send()
+
+
+
+# The global cache. Created on first access.
+_cache = None
+
+
+def get_cache():
+    """Returns the global response cache."""
+    global _cache
+    if _cache is None:
+        if settings.FETCHING_CACHE_DIR:
+            _cache = ResponseCache(
+                settings.FETCHING_CACHE_DIR,
+                settings.FETCHING_CACHE_MAX_SIZE,
+                settings.FETCHING_CACHE_TTL,
+                settings.FETCHING_CACHE_OFFLINE,
+            )
+        else:
+            _cache = _NoCache()
+    return _cache
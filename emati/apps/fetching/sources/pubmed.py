@@ -1,31 +1,36 @@
 #!/usr/bin/env python
 
+import io
 import sys
 import re
-import time
+import hashlib
 import itertools
+from concurrent.futures import ThreadPoolExecutor
 from Bio import Entrez, Medline
-from requests import Timeout
-from urllib3.exceptions import HTTPError
-from socket import error as SocketError
 from datetime import datetime, date
 
-from django.db.utils import IntegrityError
 from django.conf import settings
 
 from .abstractsource import AbstractSource
+from .scheduler import get_scheduler
+from .cache import get_cache, CacheMiss
+from ..pipeline import run_pipeline
+from ..ingest import store_articles, drop_known_ids
 from website.models import Article
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-# Time between requests if any one fails
-WAIT_SECONDS = 10
+# Efetch returns at most this many records per request
+MAX_PAGE_SIZE = 10000
 
-# Maximum number of times a request will be sent before considering it failed
-# and returning nothing instead
-MAX_NR_REQUESTS = 10
+# Number of pages that are fetched in parallel
+PARALLEL_REQUESTS = 3
+
+# NCBI allows 10 requests per second with an API key and 3 without
+REQUESTS_PER_SECOND_WITH_KEY = 10
+REQUESTS_PER_SECOND_WITHOUT_KEY = 3
 
 
 
@@ -37,6 +42,16 @@ class Pubmed(AbstractSource):
         Entrez.email = settings.FETCHING_PUBMED_EMAIL
         Entrez.api_key = settings.FETCHING_PUBMED_API_KEY
 
+        # Retries are left to the scheduler, which knows when to back off
+        Entrez.max_tries = 1
+
+        # Shared by all instances, since NCBI limits requests per user
+        if Entrez.api_key:
+            requests_per_second = REQUESTS_PER_SECOND_WITH_KEY
+        else:
+            requests_per_second = REQUESTS_PER_SECOND_WITHOUT_KEY
+        self.scheduler = get_scheduler('pubmed', requests_per_second)
+
 
     def _compose_query(self, query, start_date=None, end_date=None):
         """Takes a query string and appends the required filters to it."""
@@ -61,6 +76,18 @@ class Pubmed(AbstractSource):
         query = query + '[TI]'
         return self.query(query, start_date, end_date, max_results)
 
+    def query_titles(self, titles, max_results=10):
+        """Searches for several titles in a single query."""
+        phrases = []
+        for t in titles:
+            # Quotes and brackets would break the query
+            words = re.sub(r'[^\w\s-]', ' ', t).split()
+            if words:
+                phrases.append('"{}"[TI]'.format(' '.join(words)))
+        if not phrases:
+            return []
+        return self.query('(' + ' OR '.join(phrases) + ')', max_results=max_results)
+
     def query_pmid(self, pmid_list, start_date=None, end_date=None, max_results=10):
 
         # Get a list of ids
@@ -70,8 +97,14 @@ class Pubmed(AbstractSource):
         if max_results is not None:
             idlist = idlist[:max_results]
 
-        # Get the actual content for these ids
-        records = self._fetch_papers(idlist)
+        # Upload the ids once. Then fetch their content by reference.
+        history = self._post_ids(idlist)
+        if history is None:
+            return []
+        records = list(itertools.chain.from_iterable(
+            self._parse_page(page)
+            for page in self._download_pages(history, len(idlist), MAX_PAGE_SIZE, idlist)
+        ))
 
         # Convert Pubmed records to our Article format
         articles = [self._format_article(r, start_date, end_date) for r in records]
@@ -97,15 +130,21 @@ class Pubmed(AbstractSource):
         # Append the timespan and some necessary filters to the query
         query = self._compose_query(query, start_date, end_date)
         
-        # Get a list of ids
-        idlist = self._fetch_ids(query)
+        # Keep the search result on the server
+        count, history = self._search(query)
+        if history is None:
+            # Let the caller know, instead of pretending nothing was found
+            raise RuntimeError('Could not query Pubmed for "{}"'.format(query))
 
         # Shorten the list if desired
         if max_results is not None:
-            idlist = idlist[:max_results]
+            count = min(count, max_results)
 
-        # Get the actual content for these ids
-        records = self._fetch_papers(idlist)
+        # Get the actual content of the results
+        records = list(itertools.chain.from_iterable(
+            self._parse_page(page)
+            for page in self._download_pages(history, count, MAX_PAGE_SIZE)
+        ))
 
         # Convert Pubmed records to our Article format
         articles = [self._format_article(r, start_date, end_date) for r in records]
@@ -121,37 +160,51 @@ class Pubmed(AbstractSource):
 
         In contrast to `query()` this doesn't return the articles. Instead they
         are processed in batches and saved to the database.
+
+        Downloading, parsing and formatting run in separate threads while
+        the articles are saved (see `run_pipeline()`). Only a few batches are
+        held in memory at any time, no matter how many articles there are.
         """
         query = self._compose_query(query, start_date, end_date)
-        idlist = self._fetch_ids(query)
-        start = 0
-        logger.info("Loading {} articles ...".format(len(idlist)))
+        count, history = self._search(query)
+        if history is None:
+            # Let the caller know, e.g. to retry this time span later
+            raise RuntimeError('Could not query Pubmed for "{}"'.format(query))
+
+        # Only download the records of PMIDs we don't know yet
+        pmids = self._get_ids(history, count)
+        if pmids is not None:
+            new_pmids = drop_known_ids('pmid', pmids)
+            logger.info("Skipping {} known PMIDs.".format(len(pmids) - len(new_pmids)))
+            if len(new_pmids) < len(pmids):
+                history = self._post_ids(new_pmids)
+                if new_pmids and history is None:
+                    raise RuntimeError("Could not post {} PMIDs to Pubmed".format(len(new_pmids)))
+            pmids = new_pmids
+            count = len(pmids)
+
+        logger.info("Loading {} articles ...".format(count))
         num_new_results = 0
-        num_integrity_errors = 0
-        while start < len(idlist):
-            end = start + self.batch_size
-            batch_ids = idlist[start:end]
-            records = self._fetch_papers(batch_ids)
-            for record in records:
-                article = self._format_article(record, start_date, end_date)
-                if article is not None:
-                    try:
-                        article.save()
-                        num_new_results += 1
-                    except IntegrityError:
-                        # Uniqueness of articles is handled on database level.
-                        # Do not warn about every single IntegrityError.
-                        # Else they might flood the terminal messages.
-                        num_integrity_errors += 1
-            logger.info("  {}/{}".format(min(end, len(idlist)), len(idlist)))
-            start += self.batch_size
+        num_duplicates = 0
+        page_size = min(self.batch_size, MAX_PAGE_SIZE)
+        batches = run_pipeline(
+            self._download_pages(history, count, page_size, pmids),
+            [
+                self._parse_page,
+                lambda records: [self._format_article(r, start_date, end_date) for r in records],
+            ]
+        )
+        for (start, articles) in zip(itertools.count(0, page_size), batches):
+            end = start + page_size
+            stored = store_articles(articles)
+            num_new_results += stored.inserted
+            num_duplicates += stored.duplicates
+            logger.info("  {}/{}".format(min(end, count), count))
         
         logger.info("Fetched {} new results.".format(num_new_results))
-        if num_integrity_errors > 0:
-            msg = "Could not save {} articles. ".format(num_integrity_errors)
-            msg += "They probably already existed in the database. "
-            msg += "(IntegrityError)"
-            logger.info(msg)
+        if num_duplicates > 0:
+            logger.info("Skipped {} articles that already existed in the "
+                "database.".format(num_duplicates))
 
 
 
@@ -236,6 +289,8 @@ class Pubmed(AbstractSource):
             a.url_fulltext = self._get_fulltext_url(record)
             a.url_source = self._get_source_url(record)
             a.pubdate = self._extract_pubdate(record, start_date, end_date)
+            a.pmid = str(record['PMID'])
+            a.doi = self._extract_doi(record)
             return a
         except KeyError:
             # Some field could not be supplied
@@ -243,6 +298,15 @@ class Pubmed(AbstractSource):
             return None
 
 
+    def _extract_doi(self, record):
+        """Returns the DOI of a record or None if it has none."""
+        # Article identifiers look like '10.1000/xyz123 [doi]'
+        for aid in record.get('AID', []):
+            if aid.endswith(' [doi]'):
+                return aid[:-len(' [doi]')]
+        return None
+
+
     def _get_source_url(self, record):
         """Returns the URL to this article's Pubmed page."""
         return 'http://www.ncbi.nlm.nih.gov/pubmed/' + str(record['PMID'])
@@ -261,59 +325,178 @@ class Pubmed(AbstractSource):
         return 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/elink.fcgi?dbfrom=pubmed&cmd=prlinks&retmode=ref&id=' + str(record['PMID'])
 
 
-    def _fetch_ids(self, query):
-        """Queries Pubmed and returns the list of PMIDs."""
+    def _request(self, send):
+        """Sends a request to Entrez, respecting NCBI's rate limit.
+
+        Args:
+            send (callable): Sends the request and reads its response.
+
+        Returns:
+            The result of `send` or None if it failed (see
+            `RequestScheduler.call()`).
+        """
+        try:
+            return self.scheduler.call(send)
+        except Exception:
+            logger.error("An error occured while requesting data from Pubmed:", exc_info=True)
+            return None
+
+
+    def _entrez(self, utility, cache_key=None, **params):
+        """Calls an Entrez utility (e.g. 'esearch') with the given
+        parameters.
+
+        Args:
+            cache_key (dict): Identifies a response that can't change, e.g.
+                the records of a fixed list of PMIDs. Such responses are
+                answered from the cache (see `cache.get_cache()`). The key
+                replaces the parameters, since those refer to the history
+                server with a WebEnv that is new for every search. Without a
+                key, the request is always sent.
+
+        Returns:
+            The raw response as bytes or None if the request failed.
+        """
+        def send():
+            data = getattr(Entrez, utility)(**params).read()
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            return data
+
+        request = dict(cache_key or params, utility=utility)
+        try:
+            return get_cache().fetch(
+                'pubmed', request, lambda: self._request(send),
+                cacheable=cache_key is not None
+            )
+        except CacheMiss:
+            logger.error("Not in the cache: {}".format(request))
+            return None
+
+
+    def _search(self, query):
+        """Queries Pubmed and keeps the resulting PMIDs on the history server.
+
+        Returns:
+            A tuple of (number_of_results, history). `history` is a tuple of
+            (WebEnv, query_key) that references the results in later requests.
+        """
         logger.info('Querying Pubmed for "{}" ...'.format(query))
-        for _ in range(MAX_NR_REQUESTS):
-            try:
-                handle = Entrez.esearch(db="pubmed", term=query, retmax=100000000)
-
-                record = Entrez.read(handle)
-                
-                logger.info('Found {} PMIDs.'.format(len(record["IdList"])))
-                return record["IdList"]
-            except:
-                logger.error(
-                    "An error occured while fetching Pubmed IDs. " +
-                    "Trying again in {} seconds.".format(WAIT_SECONDS), 
-                    exc_info=True
-                )
-                time.sleep(WAIT_SECONDS)
-        return []
-
-
-    def _fetch_papers(self, pmid_list):
-        """Loads the papers for a given list of PMIDs.
-        Returns a list of all found pubmed records.
+        data = self._entrez('esearch', db="pubmed", term=query, usehistory="y", retmax=0)
+        if data is None:
+            return 0, None
+        record = Entrez.read(io.BytesIO(data))
+        count = int(record["Count"])
+        logger.info('Found {} PMIDs.'.format(count))
+        return count, (record["WebEnv"], record["QueryKey"])
+
+
+    def _post_ids(self, pmid_list):
+        """Uploads a list of PMIDs to the history server.
+        Returns a tuple of (WebEnv, query_key) or None."""
+        if not pmid_list:
+            return None
+        data = self._entrez(
+            'epost', db="pubmed", id=','.join(str(pmid) for pmid in pmid_list)
+        )
+        if data is None:
+            return None
+        record = Entrez.read(io.BytesIO(data))
+        return record["WebEnv"], record["QueryKey"]
+
+
+    def _get_ids(self, history, count):
+        """Loads the PMIDs of the first `count` results on the history
+        server. Returns a list of PMIDs or None if loading failed."""
+        if history is None:
+            return None
+        webenv, query_key = history
+        pmids = []
+        for start in range(0, count, MAX_PAGE_SIZE):
+            page = self._entrez(
+                'efetch', db="pubmed", webenv=webenv, query_key=query_key,
+                rettype="uilist", retmode="text",
+                retstart=start, retmax=min(MAX_PAGE_SIZE, count - start)
+            )
+            if page is None:
+                return None
+            pmids += page.decode('utf-8').split()
+        return pmids
+
+
+    def _download_page(self, history, start, page_size, pmids_hash=None):
+        """Loads one page of records from the history server.
+        Returns the records as unparsed text in MEDLINE format.
+
+        Args:
+            pmids_hash (string): Identifies the list of PMIDs on the history
+                server (see `_hash_ids()`). If given, the page is cached.
+
+        Raises:
+            RuntimeError: If the page couldn't be loaded. Skipping it would
+                silently lose its articles.
         """
-        # Efetch can only handle retmax = 10000
-        # Keep retmax constant and iterate over retstart
-        start = 0
-        step_size = 10000
-        records = []
-        while start < len(pmid_list):
-            for num_tries in range(MAX_NR_REQUESTS):
-                try:
-                    # Get the articles from pubmed
-                    handle = Entrez.efetch(
-                        db="pubmed", id=pmid_list, rettype="medline", 
-                        retmode="text", retstart=start, retmax=step_size
-                    )
-
-                    parsed_results = Medline.parse(handle)
-                    records += list(parsed_results)
-
-                    start += step_size
-                    break
-                except:
-                    logger.error("An error occured while fetching Pubmed records:", exc_info=True)
-                    if num_tries == MAX_NR_REQUESTS - 1:
-                        logger.warning("Maximum number of tries reached. Stopping here.")
-                    else:
-                        logger.warning("Trying again in {} seconds.".format(WAIT_SECONDS))
-                        # Wait a bit to avoid sending too many requests
-                        time.sleep(WAIT_SECONDS)
-        return records
+        webenv, query_key = history
+        cache_key = None
+        if pmids_hash is not None:
+            cache_key = {
+                'db': "pubmed", 'pmids': pmids_hash, 'rettype': "medline",
+                'retstart': start, 'retmax': page_size,
+            }
+        page = self._entrez(
+            'efetch', cache_key=cache_key, db="pubmed", webenv=webenv,
+            query_key=query_key, rettype="medline", retmode="text",
+            retstart=start, retmax=page_size
+        )
+        if page is None:
+            raise RuntimeError("Could not load Pubmed records {} to {}".format(
+                start, start + page_size))
+        return page.decode('utf-8')
+
+
+    def _parse_page(self, page):
+        """Parses a page of text in MEDLINE format.
+        Returns a list of Pubmed records."""
+        return list(Medline.parse(io.StringIO(page)))
+
+
+    def _download_pages(self, history, count, page_size, pmids=None):
+        """Loads the first `count` records of a search result (or of posted
+        PMIDs) from the history server.
+
+        Pages are fetched by several threads at once. The overall rate of
+        requests still respects NCBI's limit.
+
+        Args:
+            pmids (list): The PMIDs on the history server, if known. Their
+                pages are cached, so repeating a download (e.g. a resumed
+                backfill) doesn't load them again.
+
+        Yields:
+            The text of each page, in the order of the result.
+        """
+        if history is None or count <= 0:
+            return
+        pmids_hash = None if pmids is None else self._hash_ids(pmids[:count])
+        starts = list(range(0, count, page_size))
+        with ThreadPoolExecutor(max_workers=PARALLEL_REQUESTS) as executor:
+            # Only keep a few pages in flight to limit memory usage
+            pending = []
+            for start in starts:
+                size = min(page_size, count - start)
+                pending.append(executor.submit(
+                    self._download_page, history, start, size, pmids_hash
+                ))
+                if len(pending) >= PARALLEL_REQUESTS:
+                    yield pending.pop(0).result()
+            for future in pending:
+                yield future.result()
+
+
+    def _hash_ids(self, pmids):
+        """Returns a short, stable identifier of a list of PMIDs."""
+        text = ','.join(str(pmid) for pmid in pmids)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
 
     def _find_full_text(self, records):
@@ -348,20 +531,12 @@ class Pubmed(AbstractSource):
         while idlist:
             slist = idlist[:step_size]
             del idlist[:step_size]
-            for num_tries in range(MAX_NR_REQUESTS):
-                try:
-                    handle = Entrez.elink(db="pubmed", id=slist, cmd="prlinks", retmode="xml")
-                    break
-                except:
-                    logger.error("Error while loading data:", exc_info=True)
-                    if num_tries == MAX_NR_REQUESTS - 1:
-                        logger.warning("Maximum number of tries reached. Stopping here.")
-                        return record_map.values()
-                    else:
-                        logger.warning("Trying again in {} seconds.".format(WAIT_SECONDS))
-                        time.sleep(WAIT_SECONDS)
-            
-            root = Entrez.read(handle)
+            root = self._request(lambda: Entrez.read(Entrez.elink(
+                db="pubmed", id=slist, cmd="prlinks", retmode="xml"
+            )))
+            if root is None:
+                logger.warning("Stopping here.")
+                return record_map.values()
             for r in root:
                 mylist = r["IdUrlList"]["IdUrlSet"]
                 if mylist[0]:
@@ -0,0 +1,239 @@
+"""Rate limiting and retries for the requests of all sources.
+
+Every source sends its requests through a `RequestScheduler`. It keeps the
+request rate within the limit of the service (token bucket), backs off
+when the service asks it to, and retries transient failures after a short,
+randomized and exponentially growing delay.
+
+Example:
+    from fetching.sources.scheduler import get_scheduler
+    scheduler = get_scheduler('pubmed', requests_per_second=10)
+    record = scheduler.call(lambda: Entrez.read(Entrez.esearch(...)))
+    print(scheduler.get_counters())
+"""
+
+import time
+import random
+import socket
+import threading
+import urllib.error
+from collections import Counter
+
+import requests
+import urllib3
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Maximum number of times a request is sent before giving up
+MAX_TRIES = 8
+
+# Delay before the first retry. Doubles with every further try.
+BASE_DELAY_SECONDS = 1
+
+# Upper limit of the delay between two tries
+MAX_DELAY_SECONDS = 60
+
+# The rate is never reduced below this fraction of the allowed rate
+MIN_RATE_FRACTION = 1 / 16
+
+
+# Kinds of failures
+TIMEOUT = 'timeout'
+CONNECTION_ERROR = 'connection_error'
+RATE_LIMITED = 'rate_limited'
+CLIENT_ERROR = 'client_error'
+SERVER_ERROR = 'server_error'
+OTHER_ERROR = 'other_error'
+
+# Everything else is a problem with the request itself. Sending it again
+# wouldn't help.
+RETRYABLE = {TIMEOUT, CONNECTION_ERROR, RATE_LIMITED, SERVER_ERROR, OTHER_ERROR}
+
+
+class HTTPStatusError(Exception):
+    """Raised by sources if a response has an unexpected status code."""
+
+    def __init__(self, status, url=None):
+        super().__init__("HTTP Error {} for {}".format(status, url))
+        self.status = status
+        self.url = url
+
+
+def classify(exception):
+    """Returns the kind of failure an exception stands for."""
+    if isinstance(exception, (socket.timeout, TimeoutError, requests.Timeout,
+                              urllib3.exceptions.TimeoutError)):
+        return TIMEOUT
+    if (isinstance(exception, urllib.error.URLError)
+            and isinstance(exception.reason, socket.timeout)):
+        return TIMEOUT
+
+    status = _get_status(exception)
+    if status is not None:
+        if status == 429:
+            return RATE_LIMITED
+        if 400 <= status < 500:
+            return CLIENT_ERROR
+        if status >= 500:
+            return SERVER_ERROR
+
+    if isinstance(exception, (ConnectionError, requests.ConnectionError,
+                              urllib.error.URLError, urllib3.exceptions.HTTPError)):
+        return CONNECTION_ERROR
+    return OTHER_ERROR
+
+
+def _get_status(exception):
+    """Returns the HTTP status code of an exception or None."""
+    if isinstance(exception, HTTPStatusError):
+        return exception.status
+    if isinstance(exception, urllib.error.HTTPError):
+        return exception.code
+    response = getattr(exception, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+
+class TokenBucket:
+    """Limits the rate at which tokens are taken by all threads together.
+
+    The rate is halved whenever the service signals that we are too fast
+    and slowly recovers with every successful request.
+
+    Args:
+        rate (float): The maximum number of tokens per second.
+        capacity (int): The number of tokens that may be taken at once
+            after a period without requests.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self):
+        """Blocks until a token is available and takes it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._time) * self.rate
+            )
+            self._time = now
+            # A missing token is reserved, so waiting threads queue up in
+            # the order they arrived
+            self._tokens -= 1
+            wait = max(0, -self._tokens / self.rate)
+        time.sleep(wait)
+
+
+    def slow_down(self):
+        """Halves the rate."""
+        with self._lock:
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+
+
+    def speed_up(self):
+        """Increases the rate a bit, up to the maximum rate."""
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+
+class RequestScheduler:
+    """Sends the requests of one source.
+
+    Args:
+        name (string): The name of the source, used in log messages.
+        requests_per_second (float): The rate limit of the service.
+        max_tries (int): Maximum number of times a request is sent.
+    """
+
+    def __init__(self, name, requests_per_second, max_tries=MAX_TRIES):
+        self.name = name
+        self.bucket = TokenBucket(requests_per_second)
+        self.max_tries = max_tries
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+
+    def call(self, send):
+        """Sends a request, retrying it if it failed for a transient reason.
+
+        Args:
+            send (callable): Sends the request and returns its result. Must
+                raise an exception if the request failed.
+
+        Returns:
+            The result of `send`. If the last try failed or the failure
+            can't be fixed by retrying, its exception is raised.
+        """
+        for attempt in range(self.max_tries):
+            self.bucket.acquire()
+            self._count('requests')
+            try:
+                result = send()
+            except Exception as e:
+                kind = classify(e)
+                self._count(kind)
+                if kind == RATE_LIMITED:
+                    self.bucket.slow_down()
+                if kind not in RETRYABLE or attempt == self.max_tries - 1:
+                    self._count('failures')
+                    raise
+                delay = self._get_delay(attempt)
+                logger.warning("{} request failed ({}: {}). Trying again in "
+                    "{:.1f} seconds.".format(self.name, kind, e, delay))
+                self._count('retries')
+                time.sleep(delay)
+            else:
+                self._count('successes')
+                self.bucket.speed_up()
+                return result
+
+
+    def get_counters(self):
+        """Returns the number of requests, successes, retries and failures,
+        and of each kind of failure."""
+        with self._lock:
+            return dict(self._counters)
+
+
+    def _count(self, key):
+        with self._lock:
+            self._counters[key] += 1
+
+
+    def _get_delay(self, attempt):
+        """Returns a random delay between half and all of the exponential
+        backoff, so that concurrent retries don't hit the service at once."""
+        delay = min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+
+
+# One scheduler per source, shared by all threads and instances
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(name, requests_per_second):
+    """Returns the scheduler of a source, creating it on first access."""
+    with _schedulers_lock:
+        if name not in _schedulers:
+            _schedulers[name] = RequestScheduler(name, requests_per_second)
+        return _schedulers[name]
+
+
+def get_counters():
+    """Returns the counters of all schedulers by the name of the source."""
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return {s.name: s.get_counters() for s in schedulers}
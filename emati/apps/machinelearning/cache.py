@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+"""
+A process-wide cache for models loaded from disk.
+
+Example:
+    from machinelearning.cache import ModelCache
+    cache = ModelCache(max_size=512*1024*1024)
+    classifier = cache.load('/path/to/classifier.joblib')
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from sklearn.externals import joblib
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ModelCache:
+    """A thread-safe least-recently-used cache of deserialized files.
+
+    Entries are keyed by the file's path and its modification time. Thus a
+    file that was overwritten is loaded again on the next access. The size
+    of an entry is estimated by the size of its file on disk. Paths may also
+    point to directories, in which case the newest modification time and the
+    total size of all files inside are used instead. Whenever the
+    total size exceeds `max_size`, the least recently used entries are
+    evicted.
+
+    Args:
+        max_size (int): The memory budget in bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._keys_by_path = {}
+        self._lock = threading.Lock()
+
+
+    def load(self, path, loader=joblib.load, version=None):
+        """Returns the object stored in a file. Loads it if necessary.
+
+        Args:
+            path (string): The file to load.
+            loader (callable): Used to load the file if it is not cached.
+            version: Optional identifier of the file's content. Use this for
+                files that never change once written. Cached entries are
+                then keyed by version instead of the modification time and
+                the file isn't accessed at all if it is cached.
+
+        Raises:
+            FileNotFoundError: If the file does not exist.
+        """
+        if version is None:
+            mtime, size = self._stat(path)
+            key = (path, mtime)
+        else:
+            key = (path, version)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+
+        # Don't block other threads while loading
+        if version is not None:
+            _, size = self._stat(path)
+        value = loader(path)
+
+        with self._lock:
+            # Forget previous versions of this file
+            old_key = self._keys_by_path.get(path)
+            if old_key is not None and old_key in self._entries:
+                self._remove(old_key)
+
+            self._entries[key] = (value, size)
+            self._keys_by_path[path] = key
+            self.size += size
+
+            # Always keep the newest entry, even if it exceeds the budget
+            while self.size > self.max_size and len(self._entries) > 1:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+        return value
+
+
+    def clear(self):
+        """Removes all entries."""
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_path.clear()
+            self.size = 0
+
+
+    def get_stats(self):
+        """Returns a dictionary with the current usage counters."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+    def _stat(self, path):
+        """Returns the modification time and size of a file or directory."""
+        if not os.path.isdir(path):
+            stat = os.stat(path)
+            return stat.st_mtime_ns, stat.st_size
+
+        mtime = 0
+        size = 0
+        for entry in os.scandir(path):
+            stat = entry.stat()
+            mtime = max(mtime, stat.st_mtime_ns)
+            size += stat.st_size
+        return mtime, size
+
+
+    def _remove(self, key):
+        _, size = self._entries.pop(key)
+        self.size -= size
+        if self._keys_by_path.get(key[0]) == key:
+            del self._keys_by_path[key[0]]
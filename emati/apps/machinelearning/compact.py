@@ -0,0 +1,204 @@
+#!/usr/bin/python
+
+"""
+A compact on-disk format for vectorizers and classifiers.
+
+Instead of pickling whole objects, every estimator is written to a directory
+of plain NumPy arrays plus a small JSON file with its parameters. The arrays
+are loaded with `np.load(mmap_mode='r')`, so loading is almost free and all
+processes that load the same files share the same memory pages.
+
+Supported are fitted `TfidfVectorizer` and `MultinomialNB` objects. Use
+`save_estimator()` and `load_estimator()` from `machinelearning.utils`,
+which fall back to joblib for anything else.
+"""
+
+import os
+import json
+import numpy as np
+import scipy.sparse as sp
+from sklearn.preprocessing import normalize
+from sklearn.naive_bayes import MultinomialNB
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+
+META_FILE = 'meta.json'
+
+# Parameters of a TfidfVectorizer that are needed to reproduce its
+# transformation. Anything else (e.g. custom tokenizers) isn't supported.
+VECTORIZER_PARAMS = [
+    'analyzer', 'binary', 'decode_error', 'encoding', 'input', 'lowercase',
+    'ngram_range', 'norm', 'smooth_idf', 'stop_words', 'strip_accents',
+    'sublinear_tf', 'token_pattern', 'use_idf',
+]
+
+
+class CompactVectorizer:
+    """A read-only replacement for a fitted `TfidfVectorizer`.
+
+    The vocabulary is kept as a sorted array of UTF-8 encoded terms instead
+    of a dictionary. Terms are looked up via binary search. Since a fitted
+    TfidfVectorizer numbers its features in alphabetical order, the position
+    of a term in this array is also its feature index.
+
+    Args:
+        params (dict): The parameters of the original vectorizer.
+        terms (array): Sorted array of encoded terms (dtype bytes).
+        idf (array): The idf weight of every term.
+    """
+
+    def __init__(self, params, terms, idf):
+        self.params = params
+        self.terms = terms
+        self.idf = idf
+        self.feature_store_fingerprint = None
+        self._analyzer = TfidfVectorizer(**params).build_analyzer()
+
+
+    def transform(self, raw_documents):
+        """Transforms documents into a tf-idf weighted document-term matrix.
+        Gives the same results as `TfidfVectorizer.transform()`."""
+        indptr = [0]
+        indices = []
+        values = []
+        for doc in raw_documents:
+            tokens = self._analyzer(doc)
+            if tokens and len(self.terms) > 0:
+                tokens = np.array([t.encode('utf-8') for t in tokens])
+                positions = np.searchsorted(self.terms, tokens)
+                positions = np.minimum(positions, len(self.terms) - 1)
+                known = self.terms[positions] == tokens
+                feature_ids, counts = np.unique(positions[known], return_counts=True)
+                indices.extend(feature_ids)
+                values.extend(counts)
+            indptr.append(len(indices))
+
+        x = sp.csr_matrix(
+            (np.array(values, dtype=np.float64), np.array(indices, dtype=np.int32), indptr),
+            shape=(len(indptr) - 1, len(self.terms))
+        )
+
+        if self.params.get('binary'):
+            x.data[:] = 1
+        if self.params.get('sublinear_tf'):
+            np.log(x.data, x.data)
+            x.data += 1
+        if self.params.get('use_idf', True):
+            x.data *= self.idf[x.indices]
+        if self.params.get('norm'):
+            x = normalize(x, norm=self.params['norm'], copy=False)
+        return x
+
+
+    def get_feature_names(self):
+        return [t.decode('utf-8') for t in self.terms]
+
+
+def can_save(obj):
+    """Checks whether an object can be stored in the compact format."""
+    if isinstance(obj, CompactVectorizer):
+        return True
+    if isinstance(obj, MultinomialNB):
+        return hasattr(obj, 'feature_log_prob_')
+    if isinstance(obj, TfidfVectorizer):
+        if not hasattr(obj, 'vocabulary_'):
+            return False
+        params = obj.get_params()
+        if params['tokenizer'] or params['preprocessor'] or callable(params['analyzer']):
+            return False
+        # Feature indices must follow the alphabetical order of the terms
+        terms = obj.get_feature_names()
+        return all(a < b for (a, b) in zip(terms, terms[1:]))
+    return False
+
+
+def save(obj, path):
+    """Writes a supported estimator to the directory `path`.
+
+    Every file is first written under a temporary name and then renamed.
+    Processes that currently have the old files memory-mapped keep reading
+    the old, unchanged data.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    if isinstance(obj, MultinomialNB):
+        meta = {
+            'type': 'MultinomialNB',
+            'alpha': obj.alpha,
+            'fit_prior': obj.fit_prior,
+            'class_prior': None if obj.class_prior is None else list(obj.class_prior),
+        }
+        # The counts keep their full precision. Incremental updates add and
+        # subtract samples over and over again, so rounding errors would
+        # accumulate. Only the derived probabilities are reduced.
+        arrays = {
+            'classes': obj.classes_,
+            'class_count': np.asarray(obj.class_count_, dtype=np.float64),
+            'class_log_prior': obj.class_log_prior_,
+            'feature_count': np.asarray(obj.feature_count_, dtype=np.float64),
+            'feature_log_prob': obj.feature_log_prob_.astype(np.float32),
+        }
+    elif isinstance(obj, CompactVectorizer):
+        meta = {'type': 'TfidfVectorizer', 'params': obj.params}
+        arrays = {'terms': obj.terms, 'idf': obj.idf}
+    else:
+        params = obj.get_params()
+        params = {p: params[p] for p in VECTORIZER_PARAMS}
+        params['ngram_range'] = list(params['ngram_range'])
+        if params['stop_words'] is not None and not isinstance(params['stop_words'], str):
+            params['stop_words'] = list(params['stop_words'])
+        meta = {'type': 'TfidfVectorizer', 'params': params}
+        arrays = {
+            'terms': np.array([t.encode('utf-8') for t in obj.get_feature_names()]),
+            'idf': obj.idf_.astype(np.float32),
+        }
+    meta['feature_store_fingerprint'] = getattr(obj, 'feature_store_fingerprint', None)
+
+    for name, array in arrays.items():
+        _replace(os.path.join(path, name + '.npy'), lambda f: np.save(f, array))
+
+    # The meta file is written last. It marks the set of arrays as complete.
+    _replace(os.path.join(path, META_FILE), lambda f: f.write(json.dumps(meta).encode()))
+
+
+def load(path, mmap_mode='r'):
+    """Loads an estimator from the directory `path`.
+
+    Args:
+        mmap_mode: Passed on to `np.load()`. Use None to load all arrays
+            into memory, e.g. if you want to modify them.
+    """
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        meta = json.load(f)
+
+    def load_array(name):
+        return np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+
+    if meta['type'] == 'MultinomialNB':
+        obj = MultinomialNB(
+            alpha=meta['alpha'],
+            fit_prior=meta['fit_prior'],
+            class_prior=meta['class_prior']
+        )
+        obj.classes_ = load_array('classes')
+        obj.class_count_ = load_array('class_count')
+        obj.class_log_prior_ = load_array('class_log_prior')
+        obj.feature_count_ = load_array('feature_count')
+        obj.feature_log_prob_ = load_array('feature_log_prob')
+    else:
+        params = meta['params']
+        params['ngram_range'] = tuple(params['ngram_range'])
+        obj = CompactVectorizer(params, load_array('terms'), load_array('idf'))
+
+    if meta['feature_store_fingerprint'] is not None:
+        obj.feature_store_fingerprint = meta['feature_store_fingerprint']
+    return obj
+
+
+def _replace(path, write):
+    """Writes a file under a temporary name and renames it to `path`."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,362 @@
+#!/usr/bin/python
+
+"""
+A store of precomputed feature vectors.
+
+All samples are vectorized once, using a single vocabulary that was fit on the
+whole corpus. The resulting sparse vectors are appended to flat binary files
+on disk which are memory-mapped when reading. Every classifier that was
+trained in this feature space can then look up the vectors of its samples
+instead of vectorizing their text over and over again.
+
+Example:
+    from machinelearning.featurestore import FeatureStore
+    store = FeatureStore('/path/to/store')
+    store.fit(all_texts)
+    store.add([1, 2, 3], ["first text", "second text", "third text"])
+    x, found = store.get_rows([3, 1])
+"""
+
+import os
+import json
+import uuid
+import numpy as np
+import scipy.sparse as sp
+from sklearn.externals import joblib
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class FeatureStore:
+    """A memory-mapped sparse matrix of feature vectors indexed by key.
+
+    Keys are integers (e.g. primary keys of articles) and must be added in
+    strictly ascending order. Rows are stored in CSR layout across four
+    files (keys, indptr, indices, data). The number of valid rows is tracked
+    in a separate meta file which is replaced atomically after each write.
+    Readers therefore never see partially written rows.
+
+    Every vocabulary gets its own directory, named after its fingerprint.
+    Fitting a new one never touches the files of the previous one, which
+    other processes might still have memory-mapped. The meta file names the
+    current directory. Readers notice a new meta file via `is_changed()`.
+    The vectorizers of previous vocabularies are kept, so classifiers that
+    refer to them by fingerprint can still be loaded.
+
+    Args:
+        path (string): The directory where the store is kept.
+    """
+
+    META_FILE = 'meta.json'
+    VECTORIZER_FILE = 'vectorizer.joblib'
+
+    # Name and dtype of every array file
+    ARRAYS = {
+        'keys': np.int64,
+        'indptr': np.int64,
+        'indices': np.int32,
+        'data': np.float32,
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.vectorizer = None
+        self.fingerprint = None
+        self.num_features = 0
+        self.num_rows = 0
+        self.num_values = 0
+        self.directory = None
+        self.data_path = path
+        self._meta_stat = None
+        self.load()
+
+
+    def is_initialized(self):
+        """Returns True if a vocabulary was fit for this store."""
+        return self.vectorizer is not None
+
+
+    def is_compatible(self, vectorizer):
+        """Checks whether a vectorizer describes the same feature space as
+        this store. Only classifiers trained with a compatible vectorizer can
+        make use of the stored features."""
+        if not self.is_initialized() or vectorizer is None:
+            return False
+        fingerprint = getattr(vectorizer, 'feature_store_fingerprint', None)
+        return fingerprint == self.fingerprint
+
+
+    def get_vectorizer_path(self, fingerprint):
+        """Returns the file of the vectorizer with the given fingerprint.
+        It might belong to a previous vocabulary."""
+        if fingerprint == self.fingerprint:
+            return os.path.join(self.data_path, self.VECTORIZER_FILE)
+        return os.path.join(self.path, fingerprint, self.VECTORIZER_FILE)
+
+
+    def max_key(self):
+        """Returns the largest key in this store or 0 if it is empty."""
+        if self.num_rows == 0:
+            return 0
+        return int(self._keys[-1])
+
+
+    def is_changed(self):
+        """Returns True if the store was written since it was loaded, e.g.
+        by another process."""
+        return self._get_meta_stat() != self._meta_stat
+
+
+    def load(self):
+        """(Re)loads the vocabulary and memory-maps all arrays."""
+        meta_path = os.path.join(self.path, self.META_FILE)
+        self._meta_stat = self._get_meta_stat()
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            # Stores from before fingerprint directories keep their files
+            # directly in `path`
+            self.directory = meta.get('directory')
+            self.data_path = os.path.join(self.path, self.directory or '')
+            self.vectorizer = joblib.load(
+                os.path.join(self.data_path, self.VECTORIZER_FILE)
+            )
+        except FileNotFoundError:
+            # Nothing was stored yet
+            self.vectorizer = None
+            self.directory = None
+            self.data_path = self.path
+            meta = {}
+
+        self.fingerprint = meta.get('fingerprint')
+        self.num_features = meta.get('num_features', 0)
+        self.num_rows = meta.get('num_rows', 0)
+        self.num_values = meta.get('num_values', 0)
+
+        self._keys = self._map_array('keys', self.num_rows)
+        self._indptr = self._map_array('indptr', self.num_rows + 1)
+        self._indices = self._map_array('indices', self.num_values)
+        self._data = self._map_array('data', self.num_values)
+
+
+    def fit(self, samples):
+        """Fits a new vocabulary on the given samples.
+
+        This invalidates all previously stored feature vectors. The store
+        switches to a new, empty directory and has to be filled again using
+        `add()`. The arrays of the previous directory are removed. Processes
+        that still have them memory-mapped keep reading them until they
+        reload.
+
+        Args:
+            samples (list): A list of strings.
+        """
+        logger.info("Fitting vocabulary on {} samples ...".format(len(samples)))
+        vectorizer = TfidfVectorizer(min_df=2)
+        vectorizer.fit(samples)
+
+        # Tag the vectorizer so that classifiers trained with it can refer to
+        # it (and copies of it can be recognized) later on
+        fingerprint = uuid.uuid4().hex
+        vectorizer.feature_store_fingerprint = fingerprint
+        self.data_path = os.path.join(self.path, fingerprint)
+        os.makedirs(self.data_path)
+        joblib.dump(vectorizer, os.path.join(self.data_path, self.VECTORIZER_FILE))
+        logger.info("  {} features".format(len(vectorizer.vocabulary_)))
+
+        # Create empty arrays. A single zero marks the start of the first row.
+        for name in self.ARRAYS:
+            open(self._get_array_path(name), 'wb').close()
+        self._append_array('indptr', np.zeros(1))
+
+        self._write_meta({
+            'fingerprint': fingerprint,
+            'directory': fingerprint,
+            'num_features': len(vectorizer.vocabulary_),
+            'num_rows': 0,
+            'num_values': 0,
+        })
+        self.load()
+        self._remove_old_files()
+
+
+    def add(self, keys, samples):
+        """Vectorizes samples and appends them to the store.
+
+        Args:
+            keys (list): Integer keys, one for each sample. They must be
+                sorted and larger than any key already in the store.
+            samples (list): A list of strings.
+        """
+        if not self.is_initialized():
+            raise ValueError("Can't add samples, no vocabulary was fit yet.")
+        if len(keys) == 0:
+            return
+
+        keys = np.asarray(keys, dtype=np.int64)
+        if np.any(np.diff(keys) <= 0) or keys[0] <= self.max_key():
+            raise ValueError("Keys must be added in strictly ascending order.")
+        self._check_unchanged()
+
+        x = self.vectorizer.transform(samples).tocsr()
+        x.sort_indices()
+
+        # Discard anything that might be left over from an aborted write
+        self._truncate_arrays()
+
+        self._append_array('data', x.data)
+        self._append_array('indices', x.indices)
+        self._append_array('indptr', x.indptr[1:] + self.num_values)
+        self._append_array('keys', keys)
+
+        # Only now make the new rows visible to readers
+        self._check_unchanged()
+        self._write_meta({
+            'fingerprint': self.fingerprint,
+            'directory': self.directory,
+            'num_features': self.num_features,
+            'num_rows': self.num_rows + len(keys),
+            'num_values': self.num_values + x.nnz,
+        })
+        self.load()
+
+
+    def get_rows(self, keys):
+        """Looks up the feature vectors for a list of keys.
+
+        Returns:
+            A tuple of (matrix, found). `matrix` is a sparse matrix with one
+            row for each key, in the same order as the given keys. `found` is
+            a boolean array that is False for every key that is not in the
+            store. The rows of these keys are left empty.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if self.num_rows == 0:
+            found = np.zeros(len(keys), dtype=bool)
+            return sp.csr_matrix((len(keys), self.num_features)), found
+
+        rows = np.searchsorted(self._keys, keys)
+        rows = np.minimum(rows, self.num_rows - 1)
+        found = self._keys[rows] == keys
+
+        # Gather the slices of all requested rows from the flat arrays
+        starts = np.where(found, self._indptr[rows], 0)
+        lengths = np.where(found, self._indptr[rows + 1] - starts, 0)
+        indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+
+        matrix = sp.csr_matrix(
+            (self._data[positions], self._indices[positions], indptr),
+            shape=(len(keys), self.num_features)
+        )
+        return matrix, found
+
+
+    def transform(self, keys, get_samples):
+        """Same as `get_rows()` but vectorizes missing keys on the fly.
+
+        Args:
+            keys (list): Integer keys.
+            get_samples (callable): Takes a list of indices into `keys` and
+                returns the corresponding samples as a list of strings. Only
+                called (once) for keys that are not in the store.
+
+        Returns:
+            A sparse matrix with one row for each key.
+        """
+        matrix, found = self.get_rows(keys)
+        missing = np.flatnonzero(~found)
+        if len(missing) == 0:
+            return matrix
+
+        x = self.vectorizer.transform(get_samples(list(missing)))
+
+        # Move each newly vectorized row to the position of its key
+        placement = sp.csr_matrix(
+            (np.ones(len(missing)), (missing, np.arange(len(missing)))),
+            shape=(len(keys), len(missing))
+        )
+        return (matrix + placement.dot(x)).tocsr()
+
+
+    def _get_array_path(self, name):
+        return os.path.join(self.data_path, name + '.bin')
+
+
+    def _get_meta_stat(self):
+        """Identifies the current version of the meta file. It is replaced
+        (not overwritten) by every write, so its inode changes too."""
+        try:
+            stat = os.stat(os.path.join(self.path, self.META_FILE))
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+    def _check_unchanged(self):
+        """Makes sure no other process wrote to the store in the meantime.
+        Their rows would be overwritten otherwise."""
+        if self.is_changed():
+            raise RuntimeError(
+                "The feature store was changed by another process. Reload it "
+                "and try again."
+            )
+
+
+    def _remove_old_files(self):
+        """Removes the arrays of all vocabularies but the current one. Only
+        their vectorizers are kept."""
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if os.path.isdir(path):
+                if name != self.directory:
+                    for filename in os.listdir(path):
+                        if filename != self.VECTORIZER_FILE:
+                            os.remove(os.path.join(path, filename))
+            elif name.endswith('.bin') or name == self.VECTORIZER_FILE:
+                # Left over from a store without fingerprint directories
+                os.remove(path)
+
+
+    def _map_array(self, name, length):
+        """Memory-maps the first `length` values of an array file."""
+        dtype = self.ARRAYS[name]
+        path = self._get_array_path(name)
+        if length <= 0 or not os.path.exists(path):
+            # Empty files can't be memory-mapped
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(length,))
+
+
+    def _append_array(self, name, values):
+        values = np.asarray(values, dtype=self.ARRAYS[name])
+        with open(self._get_array_path(name), 'ab') as f:
+            f.write(values.tobytes())
+
+
+    def _truncate_arrays(self):
+        """Cuts every array file down to the number of valid values."""
+        lengths = {
+            'keys': self.num_rows,
+            'indptr': self.num_rows + 1,
+            'indices': self.num_values,
+            'data': self.num_values,
+        }
+        for name, length in lengths.items():
+            itemsize = np.dtype(self.ARRAYS[name]).itemsize
+            with open(self._get_array_path(name), 'r+b') as f:
+                f.truncate(length * itemsize)
+
+
+    def _write_meta(self, meta):
+        """Replaces the meta file in a single atomic step."""
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        meta_path = os.path.join(self.path, self.META_FILE)
+        tmp_path = '{}.{}.tmp'.format(meta_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
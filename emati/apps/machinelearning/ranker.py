@@ -1,5 +1,8 @@
 #!/usr/bin/python
 
+import numpy as np
+from scipy.special import expit
+
 from .utils import Targets, prepare_article
 
 
@@ -45,16 +48,21 @@ class Ranker():
         """
         if not self.model:
             raise ValueError("Can't run the classifier, no model was supplied.")
-        
-        if not self.data:
-            raise ValueError("Can't run the classifier, no data to predict.")
 
-        x_tfidf = self.model.vectorizer.transform(self.data)
+        x_tfidf = self.get_features()
         prediction = self.model.classifier.predict_proba(x_tfidf)
 
         return prediction
 
 
+    def get_features(self):
+        """Returns the feature vectors of all data samples."""
+        if not self.data:
+            raise ValueError("Can't run the classifier, no data to predict.")
+
+        return self.model.vectorizer.transform(self.data)
+
+
     def predict_single(self, data):
         """Predict a single data sample.
         
@@ -75,20 +83,70 @@ class Ranker():
 
 class ArticleRanker(Ranker):
     """A ranker specifically designed to rank Articles.
+
+    If a `feature_store` is supplied and the model was trained in the same
+    feature space, the precomputed feature vectors of articles are looked up
+    in the store instead of vectorizing each article's text again.
     """
 
+    def __init__(self, model, feature_store=None):
+        super().__init__(model)
+        self.articles = []
+        self.feature_store = feature_store
+        self.use_feature_store = self._can_use_feature_store()
+
+
+    def set_model(self, model):
+        super().set_model(model)
+        self.use_feature_store = self._can_use_feature_store()
+
+
+    def set_feature_store(self, feature_store):
+        """Specify where to look up precomputed article features."""
+        self.feature_store = feature_store
+        self.use_feature_store = self._can_use_feature_store()
+
+
+    def _can_use_feature_store(self):
+        """The store can only be used if the model was trained in the
+        same feature space."""
+        if self.feature_store is None or not self.model:
+            return False
+        return self.feature_store.is_compatible(self.model.vectorizer)
+
+
+    def reset_data(self):
+        super().reset_data()
+        self.articles = []
+
 
     def add_article(self, article):
         """Adds a single article as data sample for later ranking."""
-        sample = prepare_article(article)
-        self.add_data(sample)
+        if self.use_feature_store:
+            # Text is only needed if the article is missing from the store
+            self.articles.append(article)
+        else:
+            sample = prepare_article(article)
+            self.add_data(sample)
 
     
     def add_articles(self, articles):
         """Adds a list of articles as data samples for later ranking."""
         for a in articles:
-            sample = prepare_article(a)
-            self.add_data(sample)
+            self.add_article(a)
+
+
+    def get_features(self):
+        if not self.use_feature_store:
+            return super().get_features()
+
+        if not self.articles:
+            raise ValueError("Can't run the classifier, no data to predict.")
+
+        return self.feature_store.transform(
+            [a.pk for a in self.articles],
+            lambda indices: [prepare_article(self.articles[i]) for i in indices]
+        )
 
     
     def rank_articles(self, articles):
@@ -107,3 +165,166 @@ class ArticleRanker(Ranker):
         scores = [p[Targets.INTERESTING] for p in predictions]
 
         return sorted(zip(articles, scores), key=lambda x: x[1], reverse=True)
+
+
+class MultiUserRanker():
+    """Calculates scores for many models at once.
+
+    Only supports `MultinomialNB` classifiers that were trained on the two
+    classes in `Targets` and in the same feature space. For those, the
+    probability of a sample x being interesting is
+
+        1 / (1 + exp(-(x * w + b)))
+
+    where w is the difference of the feature log probabilities and b the
+    difference of the class log priors of both classes. The weights of all
+    models are stacked into a single matrix, so that scoring a batch of
+    samples for every model takes only one matrix multiplication.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self._weights = []
+        self._biases = []
+        self._matrix = None
+        self._bias_vector = None
+
+
+    def add_model(self, key, model):
+        """Adds a model that should be scored.
+
+        Args:
+            key: An identifier for this model (e.g. the user's ID).
+            model: A model with a fitted classifier.
+
+        Returns:
+            False if the model is not supported, True otherwise.
+        """
+        classifier = model.classifier
+        if not hasattr(classifier, 'feature_log_prob_'):
+            return False
+
+        classes = list(classifier.classes_)
+        if sorted(classes) != sorted([Targets.INTERESTING, Targets.IRRELEVANT]):
+            return False
+        i = classes.index(Targets.INTERESTING)
+        j = classes.index(Targets.IRRELEVANT)
+
+        log_prob = classifier.feature_log_prob_
+        log_prior = classifier.class_log_prior_
+        self._weights.append((log_prob[i] - log_prob[j]).astype(np.float32))
+        self._biases.append(log_prior[i] - log_prior[j])
+        self.keys.append(key)
+        return True
+
+
+    def get_scores(self, x):
+        """Scores a batch of samples for all models.
+
+        Args:
+            x: A sparse matrix of feature vectors, one row per sample.
+
+        Returns:
+            A dense array with one row per sample and one column per model
+            (in the same order as the models were added). Each value is the
+            probability that the sample is interesting to the model's user.
+        """
+        if not self.keys:
+            raise ValueError("Can't calculate scores, no models were added.")
+
+        if self._weights:
+            self._stack_weights()
+
+        z = x.astype(np.float32).dot(self._matrix)
+        z += self._bias_vector
+        return expit(z)
+
+
+    def _stack_weights(self):
+        """Moves the weights of newly added models into the weight matrix.
+        Every column of this matrix belongs to one model."""
+        new_matrix = np.empty(
+            (len(self._weights[0]), len(self._weights)), dtype=np.float32
+        )
+        for column, w in enumerate(self._weights):
+            new_matrix[:, column] = w
+        new_biases = np.array(self._biases, dtype=np.float32)
+
+        if self._matrix is None:
+            self._matrix = new_matrix
+            self._bias_vector = new_biases
+        else:
+            self._matrix = np.hstack([self._matrix, new_matrix])
+            self._bias_vector = np.concatenate([self._bias_vector, new_biases])
+
+        self._weights = []
+        self._biases = []
+
+
+class TopK():
+    """Keeps the k best scores seen so far, for one or many columns.
+
+    Scores are pushed in batches. Each batch is reduced to its k best rows
+    with `np.argpartition` (linear time) and merged into a buffer that never
+    holds more than k rows per column. The result is exactly the top k of
+    everything pushed, no matter how many batches there were.
+
+    Args:
+        k (int): The number of best scores to keep.
+        num_columns (int): Keep the top k separately for each column of the
+            pushed scores (e.g. one column per user).
+    """
+
+    def __init__(self, k, num_columns=1):
+        self.k = k
+        self.num_columns = num_columns
+        self._keys = np.zeros((0, num_columns), dtype=np.int64)
+        self._scores = np.zeros((0, num_columns), dtype=np.float64)
+
+
+    def push(self, keys, scores):
+        """Adds a batch of scores.
+
+        Args:
+            keys (list): One key (e.g. an article ID) for each row.
+            scores (array): An array of shape (len(keys),) or
+                (len(keys), num_columns).
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        scores = np.asarray(scores, dtype=np.float64).reshape(len(keys), self.num_columns)
+
+        # Reduce the batch first, then merge it with the best rows so far
+        if len(keys) > self.k:
+            best = np.argpartition(-scores, self.k - 1, axis=0)[:self.k]
+            keys = keys[best]
+            scores = np.take_along_axis(scores, best, axis=0)
+        else:
+            keys = np.repeat(keys[:, None], self.num_columns, axis=1)
+
+        self._keys, self._scores = self._select(
+            np.vstack([self._keys, keys]),
+            np.vstack([self._scores, scores])
+        )
+
+
+    def get_result(self, column=0):
+        """Returns a list of (key, score) tuples sorted by descending score.
+        Rows with non-finite scores (e.g. masked with -inf) are left out."""
+        scores = self._scores[:, column]
+        order = np.argsort(-scores, kind='mergesort')
+        return [
+            (int(self._keys[i, column]), float(scores[i]))
+            for i in order
+            if np.isfinite(scores[i])
+        ]
+
+
+    def _select(self, keys, scores):
+        """Returns the k rows with the highest scores of every column."""
+        if len(scores) <= self.k:
+            return keys, scores
+        best = np.argpartition(-scores, self.k - 1, axis=0)[:self.k]
+        return (
+            np.take_along_axis(keys, best, axis=0),
+            np.take_along_axis(scores, best, axis=0)
+        )
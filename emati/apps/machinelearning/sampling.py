@@ -0,0 +1,185 @@
+#!/usr/bin/python
+
+"""
+Random sampling from a large set of integer keys.
+
+Example:
+    from machinelearning.sampling import KeySampler
+    sampler = KeySampler('/path/to/sampler.npz')
+    sampler.add([1, 2, 3], [2017, 2018, 2018])
+    sampler.save()
+    keys = sampler.sample(2, excluded=[2])
+"""
+
+import os
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class KeySampler:
+    """Draws random keys without loading them from the database each time.
+
+    All keys are kept in a compact array which is stored in a single file.
+    Every key carries an integer stratum (e.g. the publication year of an
+    article) which allows sampling an equal share from each stratum. Keys
+    must be added in ascending order, so the array can be brought up to date
+    by only adding keys larger than `max_key()`.
+
+    Sampling draws random positions until enough distinct keys were found.
+    Its cost depends on the number of requested and excluded keys, not on
+    the total number of keys.
+
+    Args:
+        path (string): The file in which the keys are kept.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.strata = np.zeros(0, dtype=np.int32)
+        self._groups = None
+        self.load()
+
+
+    def load(self):
+        """(Re)loads all keys from disk."""
+        try:
+            with np.load(self.path) as f:
+                self.keys = f['keys']
+                self.strata = f['strata']
+        except FileNotFoundError:
+            # Nothing was stored yet
+            pass
+        self._groups = None
+
+
+    def save(self):
+        """Writes all keys to disk, replacing the file in a single step."""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # Use a unique temporary name. Several processes might save at once.
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, keys=self.keys, strata=self.strata)
+        os.replace(tmp_path, self.path)
+
+
+    def max_key(self):
+        """Returns the largest key or 0 if there are none."""
+        if len(self.keys) == 0:
+            return 0
+        return int(self.keys[-1])
+
+
+    def add(self, keys, strata):
+        """Adds keys which must be sorted and larger than any existing key.
+
+        Args:
+            keys (list): Integer keys.
+            strata (list): The stratum of each key.
+        """
+        if len(keys) == 0:
+            return
+        keys = np.asarray(keys, dtype=np.int64)
+        if np.any(np.diff(keys) <= 0) or keys[0] <= self.max_key():
+            raise ValueError("Keys must be added in strictly ascending order.")
+
+        self.keys = np.concatenate([self.keys, keys])
+        self.strata = np.concatenate([self.strata, np.asarray(strata, dtype=np.int32)])
+        self._groups = None
+
+
+    def remove(self, keys):
+        """Removes keys, e.g. those of deleted articles."""
+        keep = ~np.isin(self.keys, np.asarray(list(keys), dtype=np.int64))
+        self.keys = self.keys[keep]
+        self.strata = self.strata[keep]
+        self._groups = None
+
+
+    def sample(self, n, excluded=(), stratify=False, random_state=None):
+        """Draws up to `n` distinct random keys.
+
+        Args:
+            n (int): The number of keys to draw.
+            excluded (iterable): Keys that must not be drawn.
+            stratify (bool): Draw an equal share from each stratum instead
+                of sampling uniformly from all keys. Strata with too few keys
+                are exhausted and the rest is spread across the others.
+            random_state (int): Optional seed.
+
+        Returns:
+            An array of at most `n` keys. Fewer keys are only returned if
+            not enough keys are available.
+        """
+        rng = np.random.RandomState(random_state)
+        excluded = set(excluded)
+
+        if not stratify:
+            return self._draw(rng, self.keys, n, excluded)
+
+        keys, offsets = self._get_groups()
+        pools = [keys[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+        # Fill the smallest strata first, so that whatever they can't
+        # provide is passed on to the larger ones
+        result = []
+        remaining = n
+        for i, pool in enumerate(sorted(pools, key=len)):
+            share = remaining // (len(pools) - i)
+            if i < remaining % (len(pools) - i):
+                share += 1
+            drawn = self._draw(rng, pool, share, excluded)
+            result.append(drawn)
+            remaining -= len(drawn)
+        if not result:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(result)
+
+
+    def _get_groups(self):
+        """Returns all keys sorted by stratum, plus the offset at which each
+        stratum starts. Computed once after every change."""
+        if self._groups is None:
+            order = np.argsort(self.strata, kind='mergesort')
+            strata = self.strata[order]
+            starts = np.flatnonzero(np.diff(strata)) + 1
+            offsets = np.concatenate([[0], starts, [len(strata)]]).astype(np.int64)
+            if len(strata) == 0:
+                offsets = offsets[:1]
+            self._groups = (self.keys[order], offsets)
+        return self._groups
+
+
+    def _draw(self, rng, pool, n, excluded):
+        """Draws up to `n` distinct keys from `pool` that are not excluded."""
+        if n <= 0 or len(pool) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        if 2 * (n + len(excluded)) >= len(pool):
+            # The pool is small. Simply shuffle all of it.
+            candidates = pool[rng.permutation(len(pool))]
+            if excluded:
+                candidates = candidates[
+                    ~np.isin(candidates, np.fromiter(excluded, dtype=np.int64))
+                ]
+            return candidates[:n]
+
+        # At least half of the pool is available. Draw random positions
+        # until we found enough keys, which takes about two rounds.
+        result = []
+        chosen = set()
+        while len(result) < n:
+            positions = rng.randint(0, len(pool), size=2 * (n - len(result)))
+            for key in pool[positions].tolist():
+                if key in excluded or key in chosen:
+                    continue
+                chosen.add(key)
+                result.append(key)
+                if len(result) == n:
+                    break
+        return np.array(result, dtype=np.int64)
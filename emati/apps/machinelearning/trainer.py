@@ -10,12 +10,13 @@ Example:
     trainer.add_data("this is very interesting to the user", Targets.INTERESTING)
     trainer.add_data("this is a totally irrelevant article", Targets.IRRLEVANT)
     my_model = trainer.train()
-    ml.utils.save_model(my_model, 'my_model')    
+    ml.utils.save_model(my_model, "my_model")
 """
 
 import os
+import copy
 import numpy as np
-from sklearn.model_selection import cross_val_score
+from sklearn.model_selection import cross_validate
 from sklearn.externals import joblib
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.naive_bayes import MultinomialNB
@@ -46,14 +47,27 @@ class Sample:
 
 
 class Trainer:
-    """Responsible for training machine learning models."""
+    """Responsible for training machine learning models.
 
-    def __init__(self):
+    Args:
+        vectorizer: An optional, already fitted vectorizer. If provided, the
+            model is trained in this fixed feature space (e.g. the one of a
+            `FeatureStore`). Otherwise a new vectorizer is fit on the
+            training data.
+        cv (int): Number of folds used for cross-validating the model. Set
+            to 0 or None to skip the evaluation entirely.
+        n_jobs (int): Number of processes used for cross-validation. -1
+            means using all processors.
+    """
+
+    def __init__(self, vectorizer=None, cv=10, n_jobs=-1):
         self.model = utils.Model()
         self.samples = []
+        self.vectorizer = vectorizer
 
         # Amount of cross-validation
-        self.cv = 10
+        self.cv = cv
+        self.n_jobs = n_jobs
     
 
     def add_data(self, data, target, weight=None):
@@ -89,14 +103,18 @@ class Trainer:
             weights.append(s.weight)
 
         logger.info("Extracting features ...")
-        self.model.vectorizer = TfidfVectorizer()
 
         # Convert to numpy arrays
         data_np = np.array(data)
         targets_np = np.array(targets)
         weights_np = np.array(weights)
 
-        x_train_tfidf = self.model.vectorizer.fit_transform(data_np)
+        if self.vectorizer is None:
+            self.model.vectorizer = TfidfVectorizer()
+            x_train_tfidf = self.model.vectorizer.fit_transform(data_np)
+        else:
+            self.model.vectorizer = self.vectorizer
+            x_train_tfidf = self.model.vectorizer.transform(data_np)
         logger.info("  {} samples".format(len(self.samples)))
         logger.info("  {} features".format(x_train_tfidf.shape[1]))
 
@@ -104,13 +122,117 @@ class Trainer:
         self.model.classifier = MultinomialNB()
         self.model.classifier.fit(x_train_tfidf, targets_np, weights_np)
 
+        if self.cv:
+            self.model.metrics = self._evaluate(x_train_tfidf, targets_np)
+
+        return self.model
+
+
+    def _evaluate(self, x, targets):
+        """Cross-validates the classifier on the given training data.
+
+        All metrics are calculated in a single pass over the folds, which are
+        processed in parallel.
+
+        Returns:
+            A dictionary of metrics. Empty if there was too little data.
+        """
+        # Every class needs at least one sample in each fold
+        class_counts = np.bincount(targets)
+        class_counts = class_counts[class_counts > 0]
+        num_folds = min(self.cv, class_counts.min())
+        if len(class_counts) < 2 or num_folds < 2:
+            logger.info("Skipping cross-validation. Not enough samples.")
+            return {}
+
         logger.info("Calculating cross-validation ...")
-        precision = cross_val_score(self.model.classifier, x_train_tfidf, targets_np, cv=self.cv, scoring='precision')
-        recall = cross_val_score(self.model.classifier, x_train_tfidf, targets_np, cv=self.cv, scoring='recall')
+        scores = cross_validate(
+            self.model.classifier, x, targets, cv=num_folds,
+            scoring=['precision', 'recall'], n_jobs=self.n_jobs,
+            return_train_score=False
+        )
+        precision = scores['test_precision']
+        recall = scores['test_recall']
         p = precision.mean()
         r = recall.mean()
+        f = 2 * p * r / (p + r) if p + r > 0 else 0.0
         logger.info("  Precision:\t{:.2f} (+/- {:.2f})".format(p, precision.std() * 2))
         logger.info("  Recall:\t{:.2f} (+/- {:.2f})".format(r, recall.std() * 2))
-        logger.info("  F-Measure:\t{:.2f}".format(2 * p * r / (p + r)))
+        logger.info("  F-Measure:\t{:.2f}".format(f))
+
+        return {
+            'folds': int(num_folds),
+            'precision': float(p),
+            'precision_std': float(precision.std()),
+            'recall': float(r),
+            'recall_std': float(recall.std()),
+            'f_measure': float(f),
+        }
+
+
+def supports_updates(model):
+    """Checks whether a model can be updated incrementally.
 
-        return self.model
\ No newline at end of file
+    Requires a classifier that supports `partial_fit` and that was trained on
+    both classes in `Targets`.
+    """
+    classifier = model.classifier
+    if classifier is None or not hasattr(classifier, 'partial_fit'):
+        return False
+    if not hasattr(classifier, 'classes_'):
+        return False
+    return sorted(classifier.classes_) == sorted([
+        utils.Targets.INTERESTING, utils.Targets.IRRELEVANT
+    ])
+
+
+def update_model(model, samples):
+    """Incrementally trains an existing model on additional samples.
+
+    The vectorizer is left untouched, i.e. the feature space stays fixed.
+    Only the statistics of the classifier are updated. A sample with a
+    negative weight reverts a sample that was learned before with the same
+    positive weight.
+
+    The classifier is copied before updating it, since the original might be
+    shared with others (e.g. via a cache).
+
+    Args:
+        model: A trained model. Its classifier is replaced by the update.
+        samples (list): A list of `Sample` objects.
+
+    Returns:
+        False if the model does not support incremental updates.
+    """
+    if not supports_updates(model):
+        return False
+    if not samples:
+        return True
+
+    x = model.vectorizer.transform([s.data for s in samples])
+    targets = np.array([s.target for s in samples])
+    weights = np.array([s.weight for s in samples], dtype=float)
+
+    classifier = copy.deepcopy(model.classifier)
+    classifier.partial_fit(x, targets, sample_weight=weights)
+    _clamp_counts(classifier)
+    model.classifier = classifier
+    return True
+
+
+def _clamp_counts(classifier):
+    """Sets negative counts of a naive Bayes classifier to zero.
+
+    Reverting a sample that was never learned (e.g. because the classifier
+    was retrained in between) can push counts below zero. Their logarithms
+    would be NaN and spoil every prediction.
+    """
+    if not hasattr(classifier, 'feature_count_'):
+        return
+    if (classifier.feature_count_ >= 0).all() and (classifier.class_count_ >= 0).all():
+        return
+    np.maximum(classifier.feature_count_, 0, out=classifier.feature_count_)
+    np.maximum(classifier.class_count_, 0, out=classifier.class_count_)
+    # Recompute the probabilities just like `partial_fit` does
+    classifier._update_feature_log_prob(classifier._check_alpha())
+    classifier._update_class_log_prior(class_prior=classifier.class_prior)
@@ -1,15 +1,66 @@
 from sklearn.externals import joblib
 import os
+import shutil
 
+from . import compact
 
-def save_model(model, filename):
-    """Serializes a model and writes it to disk."""
-    joblib.dump(model, filename)
 
+def save_model(model, path):
+    """Serializes a model and writes it to disk.
 
-def load_model(filename):
-    """Loads a model from a file. Returns the model."""
-    return joblib.load(filename)
+    The vectorizer and the classifier are stored in two subdirectories of
+    `path`. See `save_estimator()` for the format.
+    """
+    save_estimator(model.vectorizer, os.path.join(path, 'vectorizer'))
+    save_estimator(model.classifier, os.path.join(path, 'classifier'))
+
+
+def load_model(path, mmap_mode='r'):
+    """Loads a model from disk. Returns the model.
+
+    Also supports models that were pickled into a single file.
+    """
+    if os.path.isfile(path):
+        return joblib.load(path)
+
+    model = Model()
+    model.vectorizer = load_estimator(os.path.join(path, 'vectorizer'), mmap_mode)
+    model.classifier = load_estimator(os.path.join(path, 'classifier'), mmap_mode)
+    return model
+
+
+def save_estimator(obj, path):
+    """Writes a vectorizer or classifier to disk.
+
+    Fitted TfidfVectorizers and MultinomialNB classifiers are stored in a
+    compact format that can be memory-mapped (see `machinelearning.compact`).
+    Then `path` is a directory. Everything else is pickled into the single
+    file `path`.
+    """
+    if compact.can_save(obj):
+        if os.path.isfile(path):
+            os.remove(path)
+        compact.save(obj, path)
+    else:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        joblib.dump(obj, path)
+
+
+def load_estimator(path, mmap_mode='r'):
+    """Loads a vectorizer or classifier that was written with
+    `save_estimator()` or pickled with joblib.
+
+    Args:
+        mmap_mode: How to load arrays of the compact format. By default they
+            are memory-mapped read-only. Use None to load them into memory.
+
+    Raises:
+        FileNotFoundError: If nothing is stored at `path`.
+    """
+    if os.path.isdir(path):
+        return compact.load(path, mmap_mode)
+    return joblib.load(path)
 
 
 class Targets():
@@ -27,6 +78,13 @@ class Model():
         self.vectorizer = None
         self.classifier = None
 
+        # Results of the evaluation during training (if any)
+        self.metrics = None
+
+
+# The fields of an article that are used by `prepare_article()`
+ARTICLE_FIELDS = ['title', 'abstract', 'journal', 'authors_string']
+
 
 def prepare_article(article):
     """Returns an article represented as a single string.
@@ -35,9 +93,4 @@ def prepare_article(article):
     machine learning. Expects the given `article` object to be an instance
     of website.models.Article.
     """
-    return ' '.join([
-            article.title,
-            article.abstract,
-            article.journal,
-            article.authors_string
-        ])
\ No newline at end of file
+    return ' '.join(getattr(article, field) for field in ARTICLE_FIELDS)
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""A module to maintain the global feature store of articles.
+
+Every article is vectorized once, using a single vocabulary that was fit on
+the whole corpus. Classifiers trained in this feature space can then score
+articles by looking up their precomputed feature vectors.
+"""
+
+import random
+
+from django.conf import settings
+
+from machinelearning.featurestore import FeatureStore
+from machinelearning.utils import prepare_article, ARTICLE_FIELDS
+from .models import Article
+from .utils import chunked
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Batch size when updating the store
+UPDATE_BATCH_SIZE = 10000
+
+# The global store. Loaded on first access.
+_store = None
+
+
+def get_store():
+    """Returns the global feature store. Reloads it if it was written since
+    it was loaded, e.g. by `rebuild_store()` in another process."""
+    global _store
+    if _store is None:
+        _store = FeatureStore(settings.WEBSITE_FEATURE_STORE_PATH)
+    elif _store.is_changed():
+        _store.load()
+    return _store
+
+
+def update_store():
+    """Vectorizes all articles that were added to the database since the
+    last update and appends them to the store."""
+    store = get_store()
+    if not store.is_initialized():
+        logger.warning("The feature store is not initialized. Rebuild it first.")
+        return
+
+    articles = Article.objects.filter(pk__gt=store.max_key())
+    total = articles.count()
+
+    logger.info("Updating the feature store ...")
+
+    # Chunks are ordered by primary key, as required by the store
+    done = 0
+    for batch in chunked(articles, UPDATE_BATCH_SIZE, ARTICLE_FIELDS):
+        store.add(
+            [a.pk for a in batch],
+            [prepare_article(a) for a in batch]
+        )
+        done += len(batch)
+        logger.info("  {}/{}".format(min(done, total), total))
+
+
+def rebuild_store():
+    """Rebuilds the store from scratch.
+
+    Fits a new vocabulary on a random sample of articles and vectorizes every
+    article in the database. Classifiers trained with the previous vocabulary
+    fall back to vectorizing articles themselves until they are retrained.
+    """
+    keys = list(Article.objects.values_list('pk', flat=True))
+    num_samples = min(len(keys), settings.WEBSITE_FEATURE_STORE_FIT_SAMPLES)
+    sample_keys = random.sample(keys, num_samples)
+
+    samples = []
+    for start in range(0, num_samples, UPDATE_BATCH_SIZE):
+        batch = Article.objects.filter(
+            pk__in=sample_keys[start:start + UPDATE_BATCH_SIZE]
+        ).only(*ARTICLE_FIELDS)
+        samples += [prepare_article(a) for a in batch]
+
+    get_store().fit(samples)
+    update_store()
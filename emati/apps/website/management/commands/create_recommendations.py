@@ -1,12 +1,17 @@
 import sklearn
 import datetime
+import numpy as np
 
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth.models import User
 
-from machinelearning.ranker import ArticleRanker
-from machinelearning.utils import Targets
-from website.models import Article, Classifier, Recommendation
+from machinelearning.ranker import ArticleRanker, MultiUserRanker, TopK
+from machinelearning.utils import Targets, prepare_article, ARTICLE_FIELDS
+from django.db.models import Q
+
+from website.models import Article, Classifier, Recommendation, IngestBatch
+from website import features
+from website.utils import chunked
 
 
 import logging
@@ -20,8 +25,12 @@ class Command(BaseCommand):
     # Predictions are calculated in batches
     BATCH_SIZE = 10000
 
-    # Create recommendations only for the best scores
-    RECOMMENDATIONS_PER_BATCH = 100
+    # Create recommendations only for the best scores of each user
+    # (unless set via --top-k)
+    RECOMMENDATIONS_PER_USER = 1000
+
+    # Number of users whose classifiers are scored together in batched mode
+    USER_BLOCK_SIZE = 500
 
 
     def add_arguments(self, parser):
@@ -40,6 +49,11 @@ class Command(BaseCommand):
             '--last-week',
             action='store_true',
             help="Only consider articles published within the last seven days.")
+        parser.add_argument(
+            '--new-articles',
+            action='store_true',
+            help="""Only consider articles that were fetched since the last
+            run with this option (see `IngestBatch`).""")
         parser.add_argument(
             '--unranked-articles',
             action='store_true',
@@ -56,6 +70,18 @@ class Command(BaseCommand):
             '--preserve-existing', 
             action='store_true',
             help="""Ensures that existing recommendations are skipped and not recalculated.""")
+        parser.add_argument(
+            '--batched',
+            action='store_true',
+            help="""Score each batch of articles for many users at once. Only
+            applies to users whose classifiers were trained on the feature
+            store. All other users are processed one after another.""")
+        parser.add_argument(
+            '-k', '--top-k',
+            type=int,
+            help="""Number of recommendations to create or update for each
+            user, keeping only the best scores among all considered articles.
+            Defaults to {}.""".format(self.RECOMMENDATIONS_PER_USER))
 
 
     def _get_user_list(self, **options):
@@ -71,6 +97,8 @@ class Command(BaseCommand):
         # ... determine which articles to work on
         if options['all_articles']:
             return Article.objects.all()
+        elif options['new_articles']:
+            return self._get_new_articles()
         elif options['unranked_articles']:
             return Article.objects.exclude(recommendation__user=user.pk)
         elif options['last_week']:
@@ -82,6 +110,17 @@ class Command(BaseCommand):
             return None
 
 
+    def _get_new_articles(self):
+        """Returns all articles of the ingest batches that were not scored
+        yet, or None if there are none."""
+        if not self.ingest_batches:
+            return None
+        ranges = Q()
+        for b in self.ingest_batches:
+            ranges |= Q(pk__gte=b.first_article_id, pk__lte=b.last_article_id)
+        return Article.objects.filter(ranges)
+
+
     def handle(self, *args, **options):
         """The main entry point for this command."""
 
@@ -89,11 +128,33 @@ class Command(BaseCommand):
         if not users:
             self.stderr.write("No users to work with.")
             return
+
+        # Only the batches that exist right now are marked as scored at the
+        # end. Articles fetched in the meantime are left for the next run.
+        # Batches stay unscored if only some of the users were considered.
+        self.ingest_batches = []
+        if options['new_articles']:
+            self.ingest_batches = list(IngestBatch.objects.filter(scored=False))
+            logger.info("{} new ingest batches".format(len(self.ingest_batches)))
+
+        if options['top_k'] is None:
+            options['top_k'] = self.RECOMMENDATIONS_PER_USER
+        if options['top_k'] < 1:
+            raise CommandError("--top-k must be at least 1.")
+
+        # Precomputed article features shared by all users
+        feature_store = features.get_store()
+        if not feature_store.is_initialized():
+            feature_store = None
+
+        if options['batched'] and feature_store is not None:
+            # Only the users that can't be batched remain for the loop below
+            users = self._handle_batched(users, feature_store, **options)
         
         for u in users:
 
             articles = self._get_article_list(user=u, **options)
-            if not articles:
+            if articles is None:
                 logger.warning(
                     "Skipping user {}. No articles "
                     "found for classification.".format(u.pk)
@@ -111,39 +172,43 @@ class Command(BaseCommand):
                 logger.info("  no articles found")
                 continue
 
-            logger.info("  {} articles to rank".format(articles.count()))
+            logger.info("  {} articles to rank".format(num_articles))
 
             if not u.classifier.is_initialized():
                 logger.warning("Skipping user. Classifier not yet initialized.")
                 continue
             
             # Create a ranker using this user's classifier
-            ranker = ArticleRanker(u.classifier)
+            ranker = ArticleRanker(u.classifier, feature_store=feature_store)
 
             # Calculate scores and create recommendations
-            self._rank_articles(u, ranker, articles)
+            self._rank_articles(u, ranker, articles, num_articles, options['top_k'])
+
+        if self.ingest_batches and not options['user_ids']:
+            IngestBatch.objects.filter(
+                pk__in=[b.pk for b in self.ingest_batches]
+            ).update(scored=True)
         
         logger.info("Finished creating recommendations")
 
 
 
-    def _rank_articles(self, user_id, ranker, articles):
+    def _rank_articles(self, user_id, ranker, articles, num_articles, top_k):
 
-        start = 0
-        end = start + self.BATCH_SIZE
-        num_articles = articles.count()
+        best = TopK(top_k)
+        done = 0
         batch_nr = 1
 
         # Classify in batches
-        while start < num_articles:
+        for article_batch in chunked(articles, self.BATCH_SIZE, ARTICLE_FIELDS):
+            done += len(article_batch)
             logger.info("  batch {} ({}/{}):".format(
                 batch_nr,
-                min(end, num_articles), 
+                done,
                 num_articles)
             )
 
             # Prepare this batch
-            article_batch = articles[start:end]
             ranker.reset_data()
 
             # Add those articles to the ranker
@@ -160,30 +225,121 @@ class Command(BaseCommand):
                     "model and try again.", exc_info=True)
                 return
 
-            # Sort by scores
-            scores = [p[Targets.INTERESTING] for p in predictions]
-            articles_with_scores = zip(article_batch, scores)
-            articles_with_scores = sorted(
-                articles_with_scores, 
-                key=lambda x: x[1], 
-                reverse=True
+            # Only keep the best articles among all batches
+            best.push(
+                [a.pk for a in article_batch],
+                predictions[:, Targets.INTERESTING]
             )
+            batch_nr += 1
+
+        # Create recommendations with these scores
+        logger.info("  creating recommendations ...")
+        self._save_recommendations(user_id, best.get_result())
+
+
+    def _save_recommendations(self, user, scores):
+        """Creates or overwrites recommendations.
+
+        Args:
+            user: The user (or the user's ID) to create recommendations for.
+            scores (list): A list of tuples (article_id, score).
+        """
+        Recommendation.objects.upsert_scores(user, scores)
+
+
+    def _handle_batched(self, users, feature_store, **options):
+        """Creates recommendations for blocks of users at once.
+
+        The classifiers of all users in a block are scored together on each
+        batch of articles (see `MultiUserRanker`). This only works for users
+        whose classifiers were trained in the feature space of the store.
 
-            # Only use the best articles
-            best_articles = articles_with_scores[:self.RECOMMENDATIONS_PER_BATCH]
+        Returns:
+            The list of users that could not be processed this way.
+        """
+        # The same set of articles is ranked for all users. Unranked
+        # articles are those without an existing recommendation.
+        if options['unranked_articles'] and not options['all_articles']:
+            articles = Article.objects.all()
+            skip_existing = True
+        else:
+            articles = self._get_article_list(user=None, **options)
+            skip_existing = options['preserve_existing']
+
+        if articles is None:
+            return users
 
-            # Create recommendations with these scores
-            logger.info("  creating recommendations ...")
-            for (i, (article, score)) in enumerate(best_articles):
+        remaining_users = []
+        ranker = MultiUserRanker()
+        for u in users:
+            if not u.classifier.is_initialized():
+                logger.warning("Skipping user {}. Classifier not yet "
+                    "initialized.".format(u.pk))
+                continue
+            if (not feature_store.is_compatible(u.classifier.vectorizer)
+                    or not ranker.add_model(u.pk, u.classifier)):
+                remaining_users.append(u)
+                continue
 
-                # Create a new or overwrite an existing recommendation
-                r, _ = Recommendation.objects.get_or_create(
-                    user=user_id, 
-                    article=article
+            if len(ranker.keys) >= self.USER_BLOCK_SIZE:
+                self._rank_articles_batched(
+                    ranker, feature_store, articles, skip_existing, options['top_k']
                 )
-                r.score = score
-                r.save()
-            
-            start += self.BATCH_SIZE
-            end = start + self.BATCH_SIZE
-            batch_nr += 1
+                ranker = MultiUserRanker()
+
+        if ranker.keys:
+            self._rank_articles_batched(
+                ranker, feature_store, articles, skip_existing, options['top_k']
+            )
+
+        return remaining_users
+
+
+    def _rank_articles_batched(self, ranker, feature_store, articles, skip_existing, top_k):
+        """Scores all articles for every user of the given `MultiUserRanker`
+        and creates recommendations for the `top_k` best ones of each user."""
+        logger.info("Creating recommendations for {} users at once ...".format(
+            len(ranker.keys))
+        )
+
+        num_articles = articles.count()
+        best = TopK(top_k, num_columns=len(ranker.keys))
+
+        # Only the keys are needed, features come from the store
+        done = 0
+        for batch in chunked(articles, self.BATCH_SIZE, fields=[]):
+            batch_ids = [a.pk for a in batch]
+            done += len(batch_ids)
+            logger.info("  batch {}/{}".format(done, num_articles))
+
+            x = feature_store.transform(
+                batch_ids,
+                lambda indices: self._load_samples([batch_ids[i] for i in indices])
+            )
+
+            # One row per article, one column per user
+            scores = ranker.get_scores(x)
+
+            if skip_existing:
+                # Articles that were already recommended must not be picked
+                row = {a_id: i for (i, a_id) in enumerate(batch_ids)}
+                column = {u_id: i for (i, u_id) in enumerate(ranker.keys)}
+                existing = Recommendation.objects.filter(
+                    user__in=ranker.keys, article__in=batch_ids
+                ).values_list('user', 'article')
+                for (u_id, a_id) in existing:
+                    scores[row[a_id], column[u_id]] = -np.inf
+
+            # Only keep the best articles of every user among all batches
+            best.push(batch_ids, scores)
+
+        logger.info("  creating recommendations ...")
+        for (column, user_id) in enumerate(ranker.keys):
+            self._save_recommendations(user_id, best.get_result(column))
+
+
+    def _load_samples(self, article_ids):
+        """Returns the prepared text of the given articles (in the same
+        order as their IDs)."""
+        articles = Article.objects.only(*ARTICLE_FIELDS).in_bulk(article_ids)
+        return [prepare_article(articles[a_id]) for a_id in article_ids]
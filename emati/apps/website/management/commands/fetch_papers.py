@@ -51,6 +51,24 @@ class Command(BaseCommand):
                 "will be set to the current day."
             )
         )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help=(
+                "Use with --start-date. Skip the weeks that were already "
+                "downloaded by an earlier run with the same time span, e.g. "
+                "after it was interrupted."
+            )
+        )
+        parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            default=1,
+            help=(
+                "Use with --start-date. Number of weeks that are downloaded "
+                "at the same time."
+            )
+        )
 
 
     def handle(self, *args, **options):
@@ -72,12 +90,15 @@ class Command(BaseCommand):
             if end_date < start_date:
                 self.stderr.write("The start date must lie before the end date.")
                 return
+            if options['jobs'] < 1:
+                raise CommandError("--jobs must be at least 1.")
 
-            # Break down large time spans into week-batches
-            while start_date < end_date:
-                batch_end = min(start_date + timedelta(days=6), end_date)
-                fetcher.download("", start_date, batch_end)
-                start_date += timedelta(days=7)
+            # Large time spans are broken down into week-batches
+            fetcher.download_range(
+                start_date, end_date,
+                jobs=options['jobs'],
+                resume=options['resume']
+            )
             return
 
         else:
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from website.models import Article
+from website.utils import chunked
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Fill in the normalized title of articles that were saved without one.'
+
+    BATCH_SIZE = 10000
+
+    def handle(self, *args, **options):
+        """The main entry point for this command."""
+        articles = Article.objects.filter(normalized_title='')
+        total = articles.count()
+        done = 0
+        for batch in chunked(articles, self.BATCH_SIZE, fields=['title']):
+            with transaction.atomic():
+                for a in batch:
+                    Article.objects.filter(pk=a.pk).update(
+                        normalized_title=Article.normalize_title(a.title)
+                    )
+            done += len(batch)
+            logger.info("  {}/{}".format(done, total))
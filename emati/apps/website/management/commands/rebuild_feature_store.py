@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand, CommandError
+from website import features
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Fit a new vocabulary and rebuild the article feature store from scratch.'
+
+    def handle(self, *args, **options):
+        """The main entry point for this command."""
+        features.rebuild_store()
@@ -1,7 +1,9 @@
 import os
 import io
 import re
-import random
+import time
+import functools
+import multiprocessing
 import numpy as np
 import itertools
 import bibtexparser
@@ -10,18 +12,38 @@ import xml.etree.ElementTree as ET
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django import db
 from django.contrib.auth.models import User
 
 from machinelearning.trainer import Trainer
 from machinelearning.utils import Targets, prepare_article
 from fetching import Fetcher
 from website.models import Article, Classifier, UserUpload, UserTextInput
+from website import features, sampling
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+def train_user(uid, exhaustive=False, cv=10, stratify=False, cv_jobs=-1):
+    """Trains and saves the classifier of a single user.
+
+    Defined on module level so that it can be run in worker processes. Errors
+    are logged and never propagate, so one user can't abort the others.
+
+    Returns:
+        A tuple of (user ID, status, elapsed seconds).
+    """
+    start = time.time()
+    try:
+        status = Command()._train_user(uid, exhaustive, cv, stratify, cv_jobs)
+    except Exception:
+        logger.exception("Training failed for user {}".format(uid))
+        status = 'failed'
+    return uid, status, time.time() - start
+
+
 class Command(BaseCommand):
     help = '(Re)train the classifier for the specified user.'
 
@@ -33,48 +55,110 @@ class Command(BaseCommand):
                             help="""Try to look up missing abstracts from all registered 
             sources. Training will take significantly longer."""
                             )
+        parser.add_argument('--cv', type=int, default=10,
+                            help="""Number of folds used to cross-validate the trained
+            classifier. Defaults to 10."""
+                            )
+        parser.add_argument('--no-evaluation', action='store_true',
+                            help="""Skip cross-validating the trained classifier.
+            Recommended for routine retraining."""
+                            )
+        parser.add_argument('--stratify', action='store_true',
+                            help="""Pick random negative samples evenly across all
+            publication years instead of uniformly from all articles."""
+                            )
+        parser.add_argument('--jobs', type=int, default=1,
+                            help="""Number of users to train in parallel, each in its
+            own process. Defaults to 1."""
+                            )
+        parser.add_argument('--cv-jobs', type=int, default=None,
+                            help="""Number of processes used to cross-validate each
+            classifier. -1 means all processors. Defaults to -1, or to 1 if several
+            users are trained in parallel."""
+                            )
 
     def handle(self, *args, **options):
         """The main entrypoint for this command."""
+        user_ids = options['user_id']
+        jobs = min(options['jobs'], len(user_ids))
+
+        # Every worker process would start its own pool of processes for
+        # cross-validation. Don't multiply them unless asked to.
+        cv_jobs = options['cv_jobs']
+        if cv_jobs is None:
+            cv_jobs = 1 if jobs > 1 else -1
+
+        train = functools.partial(
+            train_user,
+            exhaustive=options['exhaustive'],
+            cv=0 if options['no_evaluation'] else options['cv'],
+            stratify=options['stratify'],
+            cv_jobs=cv_jobs
+        )
 
-        for uid in options['user_id']:
-            try:
-                self.user = User.objects.get(pk=uid)
-            except User.DoesNotExist as e:
-                logger.error("Could not find user {}".format(uid))
-                continue
-
-            m = self._train(options['exhaustive'])
-
-            if m is None:
-                return
-
-            # Save the trained classifier to the user
-            self.user.classifier.classifier = m.classifier
-            self.user.classifier.vectorizer = m.vectorizer
-            self.user.classifier.save()
-
-            logger.info('Finished training for user {}'.format(self.user.pk))
-
-    def _get_random_articles(self, nr_samples, excluded_keys=[]):
+        # Bring the random article sampler up to date once. Worker processes
+        # inherit it instead of updating it themselves.
+        sampling.get_sampler()
+
+        if jobs > 1:
+            # Close our database connection so that each process can generate
+            # a custom connection. Sharing one connection is not allowed.
+            db.connections.close_all()
+            with multiprocessing.Pool(jobs) as pool:
+                results = list(pool.imap_unordered(train, user_ids))
+        else:
+            results = [train(uid) for uid in user_ids]
+
+        if len(results) > 1:
+            self._print_summary(results)
+
+    def _print_summary(self, results):
+        """Prints the status and duration of every user's training."""
+        self.stdout.write("{:>10}  {:<10}  {:>10}".format('user', 'status', 'seconds'))
+        for uid, status, elapsed in sorted(results):
+            self.stdout.write("{:>10}  {:<10}  {:>10.1f}".format(uid, status, elapsed))
+
+        counts = {}
+        for _, status, _ in results:
+            counts[status] = counts.get(status, 0) + 1
+        self.stdout.write(', '.join(
+            '{} {}'.format(n, status) for status, n in sorted(counts.items())
+        ))
+
+    def _train_user(self, uid, exhaustive, cv, stratify=False, cv_jobs=-1):
+        """Trains and saves the classifier of a single user.
+        Returns 'trained', 'skipped' (not enough data) or 'not found'."""
+        try:
+            self.user = User.objects.get(pk=uid)
+        except User.DoesNotExist as e:
+            logger.error("Could not find user {}".format(uid))
+            return 'not found'
+
+        m = self._train(exhaustive, cv, stratify, cv_jobs)
+        if m is None:
+            return 'skipped'
+
+        # Save the trained classifier to the user. A vectorizer of the
+        # feature store is not copied, the classifier only refers to it.
+        self.user.classifier.classifier = m.classifier
+        self.user.classifier.vectorizer = m.vectorizer
+        # Without evaluation the metrics of the previous classifier would
+        # no longer match. Clear them instead.
+        self.user.classifier.set_metrics_dict(m.metrics)
+        self.user.classifier.save()
+
+        logger.info('Finished training for user {}'.format(self.user.pk))
+        return 'trained'
+
+    def _get_random_articles(self, nr_samples, excluded_keys=[], stratify=False):
         """Returns a list of randomly picked articles.
 
         Args:
             excluded_keys (list): Optional list of article IDs 
                 that should not be picked.
+            stratify (bool): Pick articles evenly across publication years.
         """
-        # Get a list of keys that actually exist in the db
-        valid_keys = Article.objects.values_list('pk', flat=True)
-
-        # Remove the excluded keys from the valid list
-        valid_keys = [x for x in valid_keys if x not in excluded_keys]
-
-        # Randomly pick some valid keys
-        random_keys = random.sample(valid_keys, nr_samples)
-
-        # Get the corresponding articles
-        articles = Article.objects.filter(pk__in=random_keys)
-        return articles
+        return sampling.get_random_articles(nr_samples, excluded_keys, stratify)
 
     def _get_liked_articles(self):
         return Article.objects.filter(
@@ -101,45 +185,56 @@ class Command(BaseCommand):
     def _get_uploaded_articles(self, exhaustive=False):
         uploads = UserUpload.objects.filter(user=self.user)
         all_articles = []
+        parsed = []
         for u in uploads:
+            # Files that didn't change since the last training were parsed
+            # (and completed) before
+            cached = u.get_cached_articles(exhaustive)
+            if cached is not None:
+                all_articles += cached
+                continue
             try:
                 # Try to get all articles specified in this file
-                articles_in_file = self._parse_file(u)
+                parsed.append((u, self._parse_file(u)))
             except:
                 logger.error("Error while parsing file:", exc_info=True)
                 continue
 
-            # Are we allowed to search for missing fields?
-            if exhaustive:
-                fetcher = Fetcher()
-                for i, a in enumerate(articles_in_file):
-
-                    # Skip article if it's already complete
-                    if a.title and a.abstract and a.journal and a.authors_list:
-                        continue
-
-                    # We need at least a title to work with it
-                    if not a.title:
-                        continue
+        # Uploads with titles that couldn't be looked up completely. Their
+        # results must not be cached, so they are looked up again next time.
+        unsure = set()
+
+        # Are we allowed to search for missing fields?
+        if exhaustive:
+            # Skip articles that are already complete. We need at least a
+            # title to work with the others.
+            incomplete = [
+                a.title for (_, articles) in parsed for a in articles
+                if a.title and not (a.abstract and a.journal and a.authors_list)
+            ]
+            if incomplete:
+                logger.info("Updating {} articles ...".format(len(incomplete)))
+
+                # Look up all titles at once, in the database and all sources
+                failed = []
+                found = Fetcher().resolve_titles(incomplete, failed)
+                failed = set(failed)
+                unsure = {
+                    u.pk for (u, articles) in parsed
+                    if any(a.title in failed for a in articles)
+                }
+                parsed = [
+                    (u, [found.get(a.title, a) for a in articles])
+                    for (u, articles) in parsed
+                ]
+
+        for (u, articles) in parsed:
+            # An empty result might be due to a failed request. Try again
+            # next time.
+            if articles and u.pk not in unsure:
+                u.cache_articles(articles, exhaustive)
+            all_articles += articles
 
-                    logger.info("Updating article {}/{} ...".format(i, len(articles_in_file)))
-
-                    # Start a search in all sources for this specific title
-                    queried_articles = fetcher.query_title(
-                        a.title,
-                        max_results=10
-                    )
-
-                    # The search probably returned more than one article
-                    # Therefore loop over all those results
-                    for aa in queried_articles:
-
-                        # Find the first where the title matches perfectly
-                        if self._titles_match(a, aa):
-                            articles_in_file[i] = aa
-                            break
-
-            all_articles += articles_in_file
         return all_articles
 
     def _get_input_articles(self, exhaustive=False):
@@ -158,22 +253,20 @@ class Command(BaseCommand):
             all_articles = fetcher.query_pmid(query_pmids, max_results=10000)
         return all_articles
 
-    def _titles_match(self, x, y):
-        """Compares the titles of Articles x and y. Ignores case of 
-        characters as well as all non-alphanumeric characters.
-        """
-        pattern = re.compile('[\W_]+')
-        x_title = pattern.sub('', x.title.lower())
-        y_title = pattern.sub('', y.title.lower())
-        return x_title == y_title
-
     def _add_articles_to_trainer(self, trainer, articles, target, weight=None):
         for a in articles:
             trainer.add_data(prepare_article(a), target, weight)
 
-    def _train(self, exhaustive):
+    def _train(self, exhaustive, cv=10, stratify=False, cv_jobs=-1):
         logger.info('Training classifier for user {} ...'.format(self.user.pk))
-        trainer = Trainer()
+
+        # Train in the shared feature space if possible. This allows ranking
+        # articles with their precomputed features later on.
+        feature_store = features.get_store()
+        if feature_store.is_initialized():
+            trainer = Trainer(vectorizer=feature_store.vectorizer, cv=cv, n_jobs=cv_jobs)
+        else:
+            trainer = Trainer(cv=cv, n_jobs=cv_jobs)
 
         # Get all articles the user interacted with
         likes = self._get_liked_articles()
@@ -207,15 +300,17 @@ class Command(BaseCommand):
         # Do we need to add random articles?
         if (nr_padding_negatives > 0):
             # Get a list of IDs of articles that were already considered for
-            # training (Ignore uploaded files here, since their articles have
-            # no ID in our database)
-            article_list = list(itertools.chain(likes, dislikes, clicks, typed))
-            excluded_keys = [a.pk for a in article_list]
+            # training. Uploaded articles only have an ID if they were found
+            # in our database.
+            article_list = list(itertools.chain(likes, dislikes, clicks, uploaded, typed))
+            excluded_keys = [a.pk for a in article_list if a.pk is not None]
 
             # Get a random set of articles and add them to the trainer. 
             # Avoid randomly picking a previously added article.
             logger.info('  {} random articles as negatives'.format(nr_padding_negatives))
-            random_articles = self._get_random_articles(nr_padding_negatives, excluded_keys)
+            random_articles = self._get_random_articles(
+                nr_padding_negatives, excluded_keys, stratify
+            )
             self._add_articles_to_trainer(trainer, random_articles, Targets.IRRELEVANT)
 
         # Train the classifier 
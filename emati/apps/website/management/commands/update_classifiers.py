@@ -30,6 +30,12 @@ class Command(BaseCommand):
     # Absolute number of new interactions required to trigger a retraining.
     RETRAINING_THRESHOLD_ABSOLUTE = 10
 
+    # Classifiers that support incremental training already learn from every
+    # interaction right away (see `views.update_classifier`). For those a full
+    # retraining only consolidates the model and can happen less often.
+    CONSOLIDATION_THRESHOLD_PERCENT = 0.5
+    CONSOLIDATION_THRESHOLD_ABSOLUTE = 100
+
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -61,7 +67,7 @@ class Command(BaseCommand):
                 logger.info(
                     "Retraining classifier for user {} ...".format(u.pk)
                 )
-                call_command('train_classifiers', u.pk, '--exhaustive')
+                call_command('train_classifiers', u.pk, '--exhaustive', '--no-evaluation')
                 u.profile.recent_interactions = 0
                 u.profile.save()
 
@@ -78,10 +84,16 @@ class Command(BaseCommand):
         ).count()
 
         # Use whichever threshold is lower
-        threshold = min(
-            self.RETRAINING_THRESHOLD_ABSOLUTE, 
-            self.RETRAINING_THRESHOLD_PERCENT * total_interactions
-        )
+        if user.classifier.supports_updates():
+            threshold = min(
+                self.CONSOLIDATION_THRESHOLD_ABSOLUTE,
+                self.CONSOLIDATION_THRESHOLD_PERCENT * total_interactions
+            )
+        else:
+            threshold = min(
+                self.RETRAINING_THRESHOLD_ABSOLUTE, 
+                self.RETRAINING_THRESHOLD_PERCENT * total_interactions
+            )
 
         return user.profile.recent_interactions >= threshold
 
@@ -96,8 +108,13 @@ class Command(BaseCommand):
             .filter(Q(clicked=True) | Q(liked=True) | Q(disliked=True))\
             .select_related('article')\
             .values_list('article__pk', flat=True)
+        interacted_articles_keys = list(interacted_articles_keys)
+        if not interacted_articles_keys:
+            return
 
+        # Every one of these articles has to be rescored
         call_command('create_recommendations', 
             user_ids=[user.pk],
-            article_ids=list(interacted_articles_keys)
+            article_ids=interacted_articles_keys,
+            top_k=len(interacted_articles_keys)
         )
\ No newline at end of file
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand, CommandError
+from website import features
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Add the feature vectors of new articles to the article feature store.'
+
+    def handle(self, *args, **options):
+        """The main entry point for this command."""
+        features.update_store()
@@ -1,10 +1,15 @@
 import os
+import re
 import json
-from sklearn.externals import joblib
-from django.db import models
+import uuid
+import shutil
+import hashlib
+from django.db import models, transaction
+from django.db.models import Case, When, Value, FloatField
 from django.db.utils import IntegrityError
 from django.db.models.signals import pre_delete
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.conf import settings
 from django.dispatch import receiver
 from django.core.exceptions import ValidationError
@@ -12,11 +17,20 @@ from django.contrib.auth import get_user_model
 from django.core.files.base import ContentFile
 from annoying.fields import AutoOneToOneField
 
+from machinelearning import trainer
+from machinelearning.cache import ModelCache
+from machinelearning.utils import Model, Targets, prepare_article
+from machinelearning.utils import save_estimator, load_estimator
+
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+# Deserialized classifiers and vectorizers shared by the whole process
+classifier_cache = ModelCache(settings.WEBSITE_CLASSIFIER_CACHE_SIZE)
+
+
 class UserProfile(models.Model):
     user = AutoOneToOneField(
         settings.AUTH_USER_MODEL,
@@ -40,9 +54,93 @@ def user_directory_path(instance, filename):
     return 'uploads/user_{0}/{1}'.format(instance.user.id, filename)
 
 class UserUpload(models.Model):
+    """A file with references that a user uploaded.
+
+    Parsing the file (and looking up missing details in the sources) takes
+    a while. The resulting articles are therefore cached in a file next to
+    the upload, together with a hash of the upload's content. The cache is
+    used as long as the content doesn't change.
+    """
+
+    # Fields of the cached articles
+    CACHED_FIELDS = [
+        'id', 'title', 'abstract', 'journal', 'authors_string', 'pubdate',
+        'url_fulltext', 'url_source', 'pmid', 'arxiv_id', 'doi',
+    ]
+
     file = models.FileField(upload_to=user_directory_path)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='uploads')
 
+    def get_cached_articles(self, exhaustive=False):
+        """Returns the cached articles of this file, or None if there are
+        none for its current content.
+
+        Args:
+            exhaustive (bool): Whether to return the articles that were
+                completed by searching the sources. Both variants are cached
+                separately.
+        """
+        cache = self._read_cache()
+        if cache is None or cache.get('sha256') != self._get_hash():
+            return None
+        entries = cache.get(self._get_cache_key(exhaustive))
+        if entries is None:
+            return None
+        articles = []
+        for e in entries:
+            e['pubdate'] = parse_date(e['pubdate']) if e['pubdate'] else None
+            articles.append(Article(**e))
+        return articles
+
+    def cache_articles(self, articles, exhaustive=False):
+        """Caches the articles parsed from the current content of this file
+        (see `get_cached_articles()`)."""
+        sha256 = self._get_hash()
+        cache = self._read_cache()
+        if cache is None or cache.get('sha256') != sha256:
+            cache = {'sha256': sha256}
+
+        entries = []
+        for a in articles:
+            e = {f: getattr(a, f) for f in self.CACHED_FIELDS}
+            e['pubdate'] = a.pubdate.isoformat() if a.pubdate else None
+            entries.append(e)
+        cache[self._get_cache_key(exhaustive)] = entries
+
+        # Replace the file in a single step. Several trainings might run.
+        path = self._get_cache_path()
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, path)
+
+    def delete_cache(self):
+        try:
+            os.remove(self._get_cache_path())
+        except FileNotFoundError:
+            pass
+
+    def _get_cache_path(self):
+        return self.file.path + '.articles.json'
+
+    def _get_cache_key(self, exhaustive):
+        return 'exhaustive' if exhaustive else 'parsed'
+
+    def _get_hash(self):
+        """Returns the SHA-256 of the file's content."""
+        h = hashlib.sha256()
+        with open(self.file.path, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 16), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def _read_cache(self):
+        try:
+            with open(self._get_cache_path()) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
 class UserTextInput(models.Model):
     # pmid_list = models.ListTextField(
     #     base_field=models.IntegerField(),
@@ -123,10 +221,22 @@ class UserLog(models.Model):
 
 
 
+# Used by `Article.normalize_title()`
+_NON_ALPHANUMERIC = re.compile(r'[\W_]+')
+
+# Names of the version directories of classifiers, e.g. 'v12-3f2a9c1e'.
+# Directories written by older releases have no suffix.
+_VERSION_DIRECTORY = re.compile(r'^v(\d+)(?:-[0-9a-f]+)?$')
+
+
 class Article(models.Model):
 
     # Do not allow duplicate titles
     title = models.CharField(max_length=255, unique=True)
+
+    # The title without case and punctuation (see `normalize_title()`). Used
+    # to look up articles by a title from another source.
+    normalized_title = models.CharField(max_length=255, blank=True, db_index=True)
     abstract = models.TextField()
     journal = models.CharField(max_length=255)
     authors_string = models.TextField()
@@ -134,18 +244,35 @@ class Article(models.Model):
     url_fulltext = models.URLField()
     url_source = models.URLField()
 
+    # Identifiers at the source. Used to skip known articles before they
+    # are downloaded. Empty if the source doesn't provide them.
+    pmid = models.CharField(max_length=16, null=True, blank=True, db_index=True)
+    arxiv_id = models.CharField(max_length=32, null=True, blank=True, db_index=True)
+    doi = models.CharField(max_length=255, null=True, blank=True, db_index=True)
+
     def save(self, *args, **kwargs):
         # We want to enforce unique titles. Therefore the DB must index over
         # the title field. MySQL can't index fields that are longer than 255
         # characters. Hence we must ensure that article titles are less than
         # 255 characters.
-
-        # Cut off long titles and add some dots instead. 
-        if len(self.title) > 255:
-            self.title = self.title[:251] + ' ...'
-            
+        self.title = self.truncate_title(self.title)
+        self.normalized_title = self.normalize_title(self.title)
         super(Article, self).save(*args, **kwargs)
 
+    @staticmethod
+    def truncate_title(title):
+        """Cuts off long titles and adds some dots instead. Must be applied
+        to every title before it is written to the database."""
+        if len(title) > 255:
+            return title[:251] + ' ...'
+        return title
+
+    @staticmethod
+    def normalize_title(title):
+        """Removes everything but lowercase letters and digits. Titles from
+        different sources that are equal after this are considered the same."""
+        return _NON_ALPHANUMERIC.sub('', title.lower())
+
     @property
     def authors_list(self):
         return self.authors_string.split(';')
@@ -155,6 +282,160 @@ class Article(models.Model):
         self.authors_string = ';'.join(authors_list)
 
 
+class IngestBatch(models.Model):
+    """The articles that were added to the database by one run of the
+    `Fetcher`. They are stored as a range of primary keys.
+
+    Batches that were not scored yet are picked up by
+    `create_recommendations --new-articles`, which then marks them as scored.
+    """
+    created = models.DateTimeField(auto_now_add=True)
+    first_article_id = models.IntegerField()
+    last_article_id = models.IntegerField()
+    scored = models.BooleanField(default=False, db_index=True)
+
+    def get_articles(self):
+        return Article.objects.filter(
+            pk__gte=self.first_article_id,
+            pk__lte=self.last_article_id
+        )
+
+    def __str__(self):
+        return "articles:{}-{}, scored:{}".format(
+            self.first_article_id, self.last_article_id, self.scored
+        )
+
+
+class FetchWindow(models.Model):
+    """A time span that is downloaded from one source during a backfill
+    (see `Fetcher.download_range()`). Records whether it is done, so an
+    interrupted backfill can be resumed.
+    """
+
+    class Status():
+        PENDING = 'PENDING'
+        IN_PROGRESS = 'IN_PROGRESS'
+        DONE = 'DONE'
+        FAILED = 'FAILED'
+
+    STATUS_CHOICES = [
+        (Status.PENDING, 'Pending'),
+        (Status.IN_PROGRESS, 'In progress'),
+        (Status.DONE, 'Done'),
+        (Status.FAILED, 'Failed'),
+    ]
+
+    # The import path of the source, as in `settings.FETCHING_SOURCES`
+    source = models.CharField(max_length=255)
+    start_date = models.DateField()
+    end_date = models.DateField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES,
+        default=Status.PENDING, db_index=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('source', 'start_date', 'end_date')
+
+    def __str__(self):
+        return "{} {}-{}: {}".format(
+            self.source, self.start_date, self.end_date, self.status
+        )
+
+
+class FeedState(models.Model):
+    """The validators of the last response of a feed. They are sent with
+    the next request, so the server can tell us if nothing changed."""
+    url = models.CharField(max_length=255, unique=True)
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=255, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def get_headers(self):
+        """Returns the headers of a conditional request."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def __str__(self):
+        return self.url
+
+
+class RecommendationManager(models.Manager):
+
+    # Number of recommendations written per query
+    BATCH_SIZE = 500
+
+    # Number of times creating a batch is tried before giving up
+    MAX_ATTEMPTS = 3
+
+    def upsert_scores(self, user, scores):
+        """Creates or updates recommendations with the given scores.
+
+        Needs three queries per batch: one to find existing recommendations,
+        one to create all missing ones and one to update all others. Clicks,
+        likes and dislikes of existing recommendations are kept.
+
+        Example:
+        upsert_scores(user=u, scores=[(article_id, 0.9), ...])
+
+        Args:
+            user: The user (or the user's ID) to create recommendations for.
+            scores (list): A list of tuples (article_id, score).
+        """
+        user_id = getattr(user, 'pk', user)
+        scores = list(dict(scores).items())
+        for start in range(0, len(scores), self.BATCH_SIZE):
+            batch = dict(scores[start:start + self.BATCH_SIZE])
+            existing = self._create_missing(user_id, batch)
+            if existing:
+                self.filter(pk__in=existing.values()).update(score=Case(
+                    *[When(pk=pk, then=Value(float(batch[article_id])))
+                        for (article_id, pk) in existing.items()],
+                    output_field=FloatField()
+                ))
+
+    def _create_missing(self, user_id, scores):
+        """Creates recommendations for all articles in `scores` that have
+        none yet. Returns a dict mapping the article IDs of the remaining,
+        already existing recommendations to their primary keys.
+
+        Raises:
+            IntegrityError: If the batch still couldn't be written after
+                `MAX_ATTEMPTS` tries.
+        """
+        for attempt in range(self.MAX_ATTEMPTS):
+            existing = dict(
+                self.filter(user_id=user_id, article_id__in=list(scores))
+                .values_list('article_id', 'pk')
+            )
+            try:
+                with transaction.atomic():
+                    self.bulk_create([
+                        self.model(user_id=user_id, article_id=article_id, score=score)
+                        for (article_id, score) in scores.items()
+                        if article_id not in existing
+                    ])
+                return existing
+            except IntegrityError:
+                if attempt == self.MAX_ATTEMPTS - 1:
+                    raise
+                # Either another process created some of them in the
+                # meantime or some articles were deleted. Look up both again
+                # and only keep articles that still exist.
+                logger.info("Recommendations were created concurrently. Retrying ...")
+                remaining = set(
+                    Article.objects.filter(pk__in=list(scores))
+                    .values_list('pk', flat=True)
+                )
+                scores = {
+                    article_id: score for (article_id, score) in scores.items()
+                    if article_id in remaining
+                }
+
+
 class Recommendation(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     article = models.ForeignKey(Article, on_delete=models.CASCADE)
@@ -163,22 +444,29 @@ class Recommendation(models.Model):
     liked = models.BooleanField(default=False)
     disliked = models.BooleanField(default=False)
 
+    objects = RecommendationManager()
+
     class Meta:
         # Order descending by score
         ordering = ["-score"]
+        # At most one recommendation per user and article
+        unique_together = ('user', 'article')
 
-    def validate_unique(self, exclude=None):
-        # Get all recommendations with the same user and article
-        qs = Recommendation.objects.filter(user=self.user, article=self.article)
-        if self.pk is None:
-            if qs.exists():
-                raise IntegrityError("Item already exists")
+    def get_training_target(self):
+        """Returns how this recommendation's article is used when training
+        the user's classifier. This corresponds to the way the command
+        `train_classifiers` picks its training data.
 
-    def save(self, *args, **kwargs):
-        # ALWAYS before saving ensure we avoid duplicates. Because by default
-        # validate_unique is only called when submitting forms.
-        self.validate_unique()
-        super(Recommendation, self).save(*args, **kwargs)
+        Returns:
+            A tuple of (target, weight) or None if the article is not used.
+        """
+        if self.liked and not self.disliked:
+            return (Targets.INTERESTING, 1)
+        if self.disliked and not self.liked:
+            return (Targets.IRRELEVANT, 1)
+        if self.clicked and not self.liked and not self.disliked:
+            return (Targets.INTERESTING, 0.5)
+        return None
 
 
 
@@ -186,7 +474,21 @@ class Classifier(models.Model):
     """A machine learning model used for predicting scores.
 
     Consists of a vectorizer and a classifier. The database only stores the
-    respective filenames and the associated user.
+    respective filenames and the associated user. The files are only loaded
+    when the classifier or vectorizer is accessed for the first time. Loaded
+    files are shared across instances via the process-wide `classifier_cache`.
+
+    Every save writes a new version directory
+    (`classifiers/user_<id>/v<version>-<random suffix>/`), which is never
+    modified afterwards. The suffix keeps the name unique even if version
+    numbers start over, e.g. after the account was reset. The directory is
+    written under a temporary name and renamed once it is complete. Readers
+    therefore always load a matching pair of vectorizer and classifier, even
+    while the classifier is retrained concurrently.
+
+    Classifiers trained in the feature space of the global feature store
+    (see `website.features`) don't keep a copy of its vectorizer. They only
+    store its fingerprint and load the shared vectorizer from the store.
     """
     user = AutoOneToOneField(
         settings.AUTH_USER_MODEL,
@@ -196,31 +498,127 @@ class Classifier(models.Model):
     )
     path_clf = models.CharField(max_length=255)
     path_vec = models.CharField(max_length=255)
-    classifier = None
-    vectorizer = None
+    # Set instead of `path_vec` if the vectorizer is the feature store's
+    vectorizer_fingerprint = models.CharField(max_length=32, blank=True, default='')
+    metrics_json_string = models.TextField(blank=True, default='')
+    version = models.PositiveIntegerField(default=0)
 
-    def is_initialized(self):
-        if not self.classifier:
-            return False
-        if not self.vectorizer:
-            return False
-        return True
+    # Number of versions kept on disk. Processes that read the row before
+    # it was updated can still load the previous version.
+    KEEP_VERSIONS = 2
 
     def __init__(self, *args, **kwargs):
         super(Classifier, self).__init__(*args, **kwargs)
-        self.classifier = self._load_from_file(self.path_clf)
-        self.vectorizer = self._load_from_file(self.path_vec)
+        self._classifier = None
+        self._vectorizer = None
+        # Objects that were assigned and have to be written on save
+        self._modified = set()
+
+    @property
+    def classifier(self):
+        if self._classifier is None:
+            self._classifier = self._load_from_file(self.path_clf)
+        return self._classifier
+
+    @classifier.setter
+    def classifier(self, value):
+        self._classifier = value
+        self._modified.add('classifier')
+
+    @property
+    def vectorizer(self):
+        if self._vectorizer is None:
+            if self.vectorizer_fingerprint:
+                self._vectorizer = self._load_shared_vectorizer()
+            else:
+                self._vectorizer = self._load_from_file(self.path_vec)
+        return self._vectorizer
+
+    @vectorizer.setter
+    def vectorizer(self, value):
+        self._vectorizer = value
+        self._modified.add('vectorizer')
+
+    def get_metrics_dict(self):
+        """Returns the evaluation results of the last training."""
+        if not self.metrics_json_string:
+            return {}
+        return json.loads(self.metrics_json_string)
+
+    def set_metrics_dict(self, d):
+        self.metrics_json_string = json.dumps(d or {})
+
+    def is_initialized(self):
+        """Checks whether a classifier and a vectorizer are available.
+        Does not load anything from disk."""
+        path_vec = self.path_vec
+        if self.vectorizer_fingerprint:
+            path_vec = self._get_store().get_vectorizer_path(self.vectorizer_fingerprint)
+        for (obj, path) in [(self._classifier, self.path_clf),
+                            (self._vectorizer, path_vec)]:
+            if obj is None and not (path and os.path.exists(path)):
+                return False
+        return True
+
+    def get_version(self):
+        """Returns a string that changes whenever the classifier is saved,
+        retrained or updated. Returns None if nothing was saved yet."""
+        if self.version:
+            # The name of the version directory without the leading 'v'
+            path = self.path_clf or self.path_vec
+            return os.path.basename(os.path.dirname(path))[1:]
+        # Files written before versioning was introduced
+        try:
+            return '{}-{}'.format(
+                os.stat(self.path_clf).st_mtime_ns,
+                os.stat(self.path_vec).st_mtime_ns
+            )
+        except FileNotFoundError:
+            return None
 
     def _load_from_file(self, path):
         """Loads a file from disk. Returns None if no file was found."""
         if not path:
             return None
         try:
-            return joblib.load(path)
+            # Version directories never change. Their files need no stat
+            # calls to check whether a cached copy is still up to date.
+            return classifier_cache.load(
+                path, load_estimator,
+                version=self.get_version() if self.version else None
+            )
         except FileNotFoundError as e:
             # Apparently no classifier exists that we could load
             return None
 
+    def _load_shared_vectorizer(self):
+        """Returns the vectorizer of the feature store this classifier was
+        trained with. Returns None if it no longer exists."""
+        store = self._get_store()
+        if store.fingerprint == self.vectorizer_fingerprint:
+            return store.vectorizer
+        # A previous vocabulary of the store. Its file never changes.
+        try:
+            return classifier_cache.load(
+                store.get_vectorizer_path(self.vectorizer_fingerprint),
+                load_estimator, version=self.vectorizer_fingerprint
+            )
+        except FileNotFoundError as e:
+            return None
+
+    def _get_shared_fingerprint(self, vectorizer):
+        """Returns the fingerprint of a vectorizer if it belongs to the
+        feature store, otherwise an empty string."""
+        fingerprint = getattr(vectorizer, 'feature_store_fingerprint', None)
+        if fingerprint and os.path.exists(self._get_store().get_vectorizer_path(fingerprint)):
+            return fingerprint
+        return ''
+
+    def _get_store(self):
+        # Imported here, `website.features` depends on this module
+        from .features import get_store
+        return get_store()
+
     def get_path(self, filename):
         """Returns the absolute path for a given file when it belongs 
         to this classifier."""
@@ -236,32 +634,180 @@ class Classifier(models.Model):
             os.makedirs(os.path.dirname(path))
 
     def save(self, *args, **kwargs):
-        if self.classifier:
-            self.path_clf = self.get_path('classifier.joblib')
-            self.create_path(self.path_clf)
-            joblib.dump(self.classifier, self.path_clf)
-        if self.vectorizer:
-            self.path_vec = self.get_path('vectorizer.joblib')
-            self.create_path(self.path_vec)
-            joblib.dump(self.vectorizer, self.path_vec)
+        # Only write what was modified. Never load a file just to write it
+        # back unchanged.
+        if self._modified:
+            self._write_version()
         super(Classifier, self).save(*args, **kwargs)
+        if self._modified:
+            self._modified = set()
+            self._remove_old_versions()
+
+    def _write_version(self):
+        """Writes the classifier and vectorizer to a new version directory.
+        Files that were not modified are linked from the current version. A
+        vectorizer of the feature store is only referred to."""
+        if 'vectorizer' in self._modified:
+            self.vectorizer_fingerprint = self._get_shared_fingerprint(self._vectorizer)
+
+        tmp_dir = self.get_path('tmp-{}'.format(uuid.uuid4().hex))
+        self.create_path(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        paths = {}
+        for (name, obj, old_path) in [
+                ('classifier', self._classifier, self.path_clf),
+                ('vectorizer', self._vectorizer, self.path_vec)]:
+            path = os.path.join(tmp_dir, name)
+            if name == 'vectorizer' and self.vectorizer_fingerprint:
+                path = None
+            elif name in self._modified:
+                save_estimator(obj, path)
+            elif old_path and os.path.exists(old_path):
+                if not os.path.isdir(old_path):
+                    # A single file in the old pickled format
+                    path += '.joblib'
+                self._link(old_path, path)
+            else:
+                path = None
+            paths[name] = path
+
+        # Publish the new version. The random suffix makes the name unique,
+        # even if another process took the same version number in the
+        # meantime.
+        version = self._get_latest_version() + 1
+        version_dir = self.get_path('v{}-{}'.format(version, uuid.uuid4().hex[:8]))
+        os.rename(tmp_dir, version_dir)
+
+        def move(path):
+            return path and os.path.join(version_dir, os.path.basename(path))
+        self.path_clf = move(paths['classifier']) or ''
+        self.path_vec = move(paths['vectorizer']) or ''
+        self.version = version
+
+    def _get_latest_version(self):
+        """Returns the highest version found on disk or in the database."""
+        versions = [self.version]
+        try:
+            for entry in os.scandir(self.get_path('')):
+                version = self._parse_version(entry.name)
+                if version is not None:
+                    versions.append(version)
+        except FileNotFoundError:
+            pass
+        return max(versions)
+
+    def _parse_version(self, name):
+        """Returns the version number of a version directory or None if
+        `name` is not a version directory."""
+        match = _VERSION_DIRECTORY.match(name)
+        return int(match.group(1)) if match else None
+
+    def _remove_old_versions(self):
+        """Deletes all but the newest versions on disk as well as files from
+        before versioning was introduced."""
+        try:
+            entries = list(os.scandir(self.get_path('')))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            name = entry.name
+            version = self._parse_version(name)
+            if version is not None:
+                if version > self.version - self.KEEP_VERSIONS:
+                    continue
+            elif name.startswith('tmp-'):
+                # Possibly being written by another process right now
+                continue
+            try:
+                self._remove_path(entry.path)
+            except OSError as e:
+                logger.error(e)
+
+    def _link(self, src, dst):
+        """Hard-links a file or every file in a directory. Falls back to
+        copying if the file system doesn't support links."""
+        if os.path.isdir(src):
+            os.makedirs(dst)
+            for name in os.listdir(src):
+                self._link(os.path.join(src, name), os.path.join(dst, name))
+            return
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    def _remove_path(self, path):
+        """Deletes a file or a directory in the compact format."""
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def supports_updates(self):
+        """Checks whether this classifier can be trained incrementally."""
+        return self.is_initialized() and trainer.supports_updates(self)
+
+    def update(self, article, targets):
+        """Incrementally trains the classifier on a single article.
+
+        The vocabulary stays the same. Therefore only the classifier is
+        updated and written to disk. This is cheap enough to be done right
+        after each interaction of a user.
+
+        Args:
+            article: The article to learn from.
+            targets (list): A list of tuples (target, weight). Use a negative
+                weight to revert something that was learned before.
+
+        Returns:
+            False if the classifier does not support incremental training.
+        """
+        with transaction.atomic():
+            # Lock the row, so concurrent updates are applied one after
+            # another instead of overwriting each other
+            latest = Classifier.objects.select_for_update().get(pk=self.pk)
+            if (latest.version, latest.path_clf) != (self.version, self.path_clf):
+                # Another process saved a newer version in the meantime.
+                # Update that one instead.
+                self.path_clf = latest.path_clf
+                self.path_vec = latest.path_vec
+                self.vectorizer_fingerprint = latest.vectorizer_fingerprint
+                self.version = latest.version
+                self._classifier = None
+                self._vectorizer = None
+
+            if not self.supports_updates():
+                return False
+
+            model = Model()
+            model.vectorizer = self.vectorizer
+            model.classifier = self.classifier
+
+            data = prepare_article(article)
+            samples = [trainer.Sample(data, t, w) for (t, w) in targets]
+            if not trainer.update_model(model, samples):
+                return False
+
+            # Writes a new version. The vectorizer is linked, not rewritten.
+            self.classifier = model.classifier
+            self.save(update_fields=[
+                'path_clf', 'path_vec', 'vectorizer_fingerprint', 'version'
+            ])
+        return True
 
     def delete_files(self):
         logger.info("Deleting classifier files (user {}) ...".format(self.user.pk))
         try:
-            os.remove(self.path_clf)
-            os.remove(self.path_vec)
+            shutil.rmtree(self.get_path(''))
         except FileNotFoundError as e:
             logger.error(e)
 
-        dir_clf = os.path.dirname(self.path_clf)
-        dir_vec = os.path.dirname(self.path_vec)
-        try:
-            os.rmdir(dir_clf)
-            if dir_clf != dir_vec:
-                os.rmdir(dir_vec)
-        except OSError as e:
-            logger.error(e)
+
+@receiver(pre_delete, sender=UserUpload)
+def user_upload_pre_delete(sender, instance, *args, **kwargs):
+    # Also called when the upload is deleted together with its user
+    instance.delete_cache()
 
 
 @receiver(pre_delete, sender=Classifier)
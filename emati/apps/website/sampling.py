@@ -0,0 +1,107 @@
+"""A module to pick random articles, e.g. as negative training samples.
+
+The keys of all articles are cached in a compact array on disk, together with
+their publication year. The array is brought up to date incrementally the
+first time it is used in a process and whenever the `Fetcher` recorded a new
+`IngestBatch` since. Newly fetched articles are thus included without reading
+the whole table again.
+"""
+
+from django.conf import settings
+
+from machinelearning.sampling import KeySampler
+from .models import Article, IngestBatch
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Batch size when updating the sampler
+UPDATE_BATCH_SIZE = 100000
+
+# How often to draw again if some of the picked articles were deleted
+MAX_ATTEMPTS = 5
+
+# The global sampler. Loaded on first access.
+_sampler = None
+
+# The latest `IngestBatch` when the sampler was last updated
+_latest_batch_id = None
+
+
+def get_sampler():
+    """Returns the global sampler, updated with all articles in the db.
+
+    Long-running processes check for a new `IngestBatch` on every call. If
+    there is one, the sampler is reloaded (another process might have
+    updated it already) and brought up to date.
+    """
+    global _sampler, _latest_batch_id
+    latest_batch_id = (
+        IngestBatch.objects.order_by('-pk').values_list('pk', flat=True).first()
+    )
+    if _sampler is None:
+        _sampler = KeySampler(settings.WEBSITE_ARTICLE_SAMPLER_PATH)
+        update_sampler(_sampler)
+    elif latest_batch_id != _latest_batch_id:
+        _sampler.load()
+        update_sampler(_sampler)
+    _latest_batch_id = latest_batch_id
+    return _sampler
+
+
+def update_sampler(sampler):
+    """Adds all articles that were added to the database since the last
+    update to the sampler and saves it."""
+    added = 0
+    while True:
+        # Walk the table by primary key. Keys must be added in ascending
+        # order anyway and this keeps every batch equally fast.
+        batch = list(
+            Article.objects.filter(pk__gt=sampler.max_key())
+            .order_by('pk')
+            .values_list('pk', 'pubdate')[:UPDATE_BATCH_SIZE]
+        )
+        if not batch:
+            break
+        sampler.add(
+            [pk for pk, _ in batch],
+            [pubdate.year for _, pubdate in batch]
+        )
+        added += len(batch)
+
+    if added:
+        logger.info("Added {} articles to the sampler".format(added))
+        sampler.save()
+
+
+def get_random_articles(nr_samples, excluded_keys=(), stratify=False):
+    """Returns a list of randomly picked articles.
+
+    Args:
+        nr_samples (int): The number of articles to pick.
+        excluded_keys (iterable): Optional article IDs that should not be
+            picked.
+        stratify (bool): Pick an equal number of articles from each year
+            instead of sampling uniformly from all articles.
+    """
+    sampler = get_sampler()
+    excluded_keys = set(excluded_keys)
+
+    articles = []
+    for _ in range(MAX_ATTEMPTS):
+        keys = sampler.sample(nr_samples - len(articles), excluded_keys, stratify)
+        if len(keys) == 0:
+            break
+        found = list(Article.objects.filter(pk__in=keys.tolist()))
+        articles += found
+        if len(articles) >= nr_samples:
+            break
+
+        # Some articles were deleted since the sampler was updated. Forget
+        # their keys and top up with new ones.
+        excluded_keys.update(keys.tolist())
+        sampler.remove(set(keys.tolist()) - set(a.pk for a in found))
+        sampler.save()
+    return articles
@@ -2,13 +2,19 @@
 
 """
 
+import re
+import hashlib
 from datetime import date
 
 import elasticsearch
 import elasticsearch.helpers
 from django.conf import settings
+from django.core.cache import caches
 
+from machinelearning.ranker import ArticleRanker
 from .models import Article
+from .utils import chunked
+from . import features
 
 
 import logging
@@ -21,14 +27,31 @@ es = settings.WEBSITE_SEARCH_CLIENT
 # Batch size when updating the index
 UPDATE_BATCH_SIZE = 1000
 
+# Valid classifier versions passed in by clients (see `ranked_search()`)
+_VERSION = re.compile(r'^[\w-]{1,64}$')
 
-def fulltext_search(query_string, offset=0, max_results=10):
+# The fields of an article that are stored in the index (see `_to_doc()`)
+DOC_FIELDS = ['title', 'abstract', 'journal', 'authors_string', 'pubdate', 'url_fulltext']
+
+# Which fields of the results to highlight
+HIGHLIGHT = {
+    'fields': {
+        'title': {
+            'number_of_fragments': 0
+        },
+        'abstract': {}
+    }
+}
+
+
+def fulltext_search(query_string, offset=0, max_results=10, highlight=True):
     """Search the index for articles matching in title or abstract.
 
     Args:
         query_string (string): the search query.
         offset (int): Skip this number of results.
         max_results (int): maximum number of results to return.
+        highlight (bool): Whether to highlight the matches in the results.
 
     Returns: a tuple of (total_number_of_results, list_of_articles).
     """
@@ -39,24 +62,12 @@ def fulltext_search(query_string, offset=0, max_results=10):
     else:
         # Search in title and abstract
         query = {
-            'query': {
-                'query_string': {
-                    'fields': ['title', 'abstract', 'journal', 'authors_string'],
-                    'query': query_string,
-                    'default_operator': 'AND'
-                }
-            },
-            'highlight': {
-                'fields': {
-                    'title': {
-                        'number_of_fragments': 0
-                    },
-                    'abstract': {}
-                }
-            },
+            'query': _compose_query(query_string),
             'from': offset,
             'size': max_results
         }
+        if highlight:
+            query['highlight'] = HIGHLIGHT
     result = es.search(index=settings.WEBSITE_SEARCH_INDEX, body=query)
     articles = []
     for hit in result['hits']['hits']:
@@ -65,6 +76,89 @@ def fulltext_search(query_string, offset=0, max_results=10):
             articles.append(a)
     total_results = result['hits']['total']
     return total_results, articles
+
+
+def get_articles(query_string, article_ids):
+    """Loads articles from the index with the matches of a query highlighted.
+
+    Returns: a dictionary mapping article IDs to articles. Articles that are
+        not in the index or don't match the query are left out.
+    """
+    if not article_ids:
+        return {}
+    query = {
+        'query': {
+            'bool': {
+                'must': _compose_query(query_string),
+                'filter': {'ids': {'values': [str(pk) for pk in article_ids]}}
+            }
+        },
+        'highlight': HIGHLIGHT,
+        'size': len(article_ids)
+    }
+    result = es.search(index=settings.WEBSITE_SEARCH_INDEX, body=query)
+    articles = {}
+    for hit in result['hits']['hits']:
+        a = _to_article(hit)
+        if a is not None:
+            articles[a.pk] = a
+    return articles
+
+
+def ranked_search(user, query_string, offset=0, max_results=10, version=None):
+    """Search the index and rank the results using the user's classifier.
+
+    Up to `WEBSITE_SEARCH_MAX_RESULTS` results are ranked. Their IDs and
+    scores are cached per user, query and version of the classifier (see
+    `WEBSITE_SEARCH_CACHE`). Repeating a search or requesting further results
+    only loads the articles of the requested page. Retraining or updating the
+    classifier changes its version and thus invalidates its cached results.
+
+    Without a classifier, results are returned in the order of the index
+    with a score of 0.
+
+    Args:
+        version: The version returned for the first page of this search.
+            Pass it when requesting further pages. They are then taken from
+            the same ranking, even if the classifier was updated (e.g. by a
+            like) in the meantime. Ignored if that ranking is no longer
+            cached.
+
+    Returns: a tuple of (total_number_of_results, list of (article, score),
+        version). `version` identifies the ranking and is None if the results
+        were not ranked.
+    """
+    cache = caches[settings.WEBSITE_SEARCH_CACHE]
+    result = None
+    if version is not None and _VERSION.match(version):
+        result = cache.get(_get_cache_key(user, query_string, version))
+
+    if result is None:
+        version = user.classifier.get_version()
+        if version is None:
+            total_results, articles = fulltext_search(query_string, offset, max_results)
+            return total_results, [(a, 0) for a in articles], None
+        key = _get_cache_key(user, query_string, version)
+        result = cache.get(key)
+
+    if result is None:
+        total_results, articles = fulltext_search(
+            query_string,
+            max_results=settings.WEBSITE_SEARCH_MAX_RESULTS,
+            highlight=False
+        )
+        ranked = []
+        if articles:
+            ranker = ArticleRanker(user.classifier, feature_store=features.get_store())
+            ranked = [(a.pk, float(s)) for (a, s) in ranker.rank_articles(articles)]
+        result = (total_results, ranked)
+        cache.set(key, result)
+
+    total_results, ranked = result
+    page = ranked[offset:offset + max_results]
+    articles = get_articles(query_string, [pk for (pk, s) in page])
+    results = [(articles[pk], s) for (pk, s) in page if pk in articles]
+    return total_results, results, version
         
 
 def update_index(start_date=None, end_date=None):
@@ -83,18 +177,14 @@ def update_index(start_date=None, end_date=None):
     if end_date is not None:
         articles = articles.filter(pubdate__lte=end_date)
 
-    # Make sure articles are ordered or else we risk
-    # getting the same article in different batches
-    articles = articles.order_by('pk')
-
     logger.info("Updating the search index ...")
 
     total = articles.count()
-    for start in range(0, total, UPDATE_BATCH_SIZE):
-        end = min(start + UPDATE_BATCH_SIZE, total)
-        batch = articles[start:end]
+    done = 0
+    for batch in chunked(articles, UPDATE_BATCH_SIZE, DOC_FIELDS):
         elasticsearch.helpers.bulk(es, doc_gen(batch))
-        logger.info("  {}/{}".format(end, total))
+        done += len(batch)
+        logger.info("  {}/{}".format(done, total))
 
 
 def doc_gen(articles):
@@ -131,6 +221,24 @@ def rebuild_index():
     update_index()
 
 
+def _compose_query(query_string):
+    """Returns the query that searches for a query string in all fields."""
+    return {
+        'query_string': {
+            'fields': ['title', 'abstract', 'journal', 'authors_string'],
+            'query': query_string,
+            'default_operator': 'AND'
+        }
+    }
+
+
+def _get_cache_key(user, query_string, version):
+    """Returns the key of a user's cached search results. Queries are hashed
+    since cache keys must not contain arbitrary characters."""
+    query_hash = hashlib.sha1(query_string.encode('utf-8')).hexdigest()
+    return 'search:{}:{}:{}'.format(user.pk, version, query_hash)
+
+
 def _to_doc(article):
     """Converts an article to the JSON format used by elasticsearch."""
     doc = {
@@ -148,7 +256,7 @@ def _to_article(hit):
     """Converts a search result hit into an Article object."""
     try:
         article = Article()
-        article.pk = hit['_id']
+        article.pk = int(hit['_id'])
         article.title = hit['_source']['title']
         article.abstract = hit['_source']['abstract']
         article.journal = hit['_source']['journal']
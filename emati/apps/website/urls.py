@@ -29,5 +29,6 @@ urlpatterns = [
     
     path('download_file', views.download_file, name='download_file'),
     path('ajax/load_more/home/', views.LoadMoreHome.as_view(), name='load_more_home'),
+    path('ajax/load_more/search/', views.LoadMoreSearch.as_view(), name='load_more_search'),
     path('ajax/get_uploaded_file_html/', views.get_uploaded_file_html, name='get_uploaded_file_html'),
 ]
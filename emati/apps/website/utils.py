@@ -0,0 +1,38 @@
+"""Helpers for working with large querysets."""
+
+
+def chunked(queryset, chunk_size, fields=None):
+    """Iterates over a queryset in chunks, ordered by primary key.
+
+    Each chunk continues after the largest primary key of the previous one
+    (keyset pagination). Unlike slicing with an offset, every chunk is
+    equally fast, no matter how far into the table it is. Any ordering of
+    the queryset is replaced.
+
+    Example:
+        for batch in chunked(Article.objects.all(), 1000, ['title']):
+            ...
+
+    Args:
+        queryset: The objects to iterate over.
+        chunk_size (int): Maximum number of objects per chunk.
+        fields (list): Only load these fields (see `QuerySet.only()`). The
+            primary key is always loaded.
+
+    Yields:
+        Lists of at most `chunk_size` objects.
+    """
+    if fields is not None:
+        queryset = queryset.only('pk', *fields)
+    queryset = queryset.order_by('pk')
+
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
@@ -10,6 +10,7 @@ from anonymizeip import anonymize_ip
 
 
 from django import db
+from django.db import transaction
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
 from django.http import HttpResponse, QueryDict
@@ -33,7 +34,6 @@ from allauth.account.signals import email_confirmed, user_signed_up
 
 from .forms import MyLoginForm, SearchForm, SettingsForm, ChangeEmailForm
 from .models import UserUpload,UserTextInput, UserLog, Article, Recommendation, Classifier
-from machinelearning.ranker import ArticleRanker
 from . import search
 
 import logging
@@ -220,47 +220,50 @@ class SearchView(LoginRequiredMixin, TemplateView):
         if not query:
             return context
 
-        # Log this search event
-        UserLog.objects.create_log(
-            user=self.request.user,
-            event=UserLog.Events.SEARCH,
-            context={'query': query}
-        )
+        # Log this search event (but not when loading more results)
+        if self.offset == 0:
+            UserLog.objects.create_log(
+                user=self.request.user,
+                event=UserLog.Events.SEARCH,
+                context={'query': query}
+            )
 
-        # Search for articles
-        total_results, articles = search.fulltext_search(
-            query, max_results=settings.WEBSITE_SEARCH_MAX_RESULTS
+        # Search for articles and rank them if the classifier is initialized.
+        # Only the results on this page are loaded. Further pages continue
+        # the ranking of the first one.
+        total_results, articles_with_scores, version = search.ranked_search(
+            self.request.user,
+            query,
+            offset=self.offset,
+            max_results=self.results_to_show,
+            version=self.request.GET.get('v')
+        )
+        recommendations = self._load_recommendations_from_search_results(
+            articles = [a for (a,s) in articles_with_scores],
+            scores = [s for (a,s) in articles_with_scores]
         )
-
-        # Check if there is data to rank and the classifier is initialized
-        if articles and self.request.user.classifier.is_initialized():
-            ranker = ArticleRanker(self.request.user.classifier)
-            articles_with_scores = ranker.rank_articles(articles)
-
-            # Limit results to the best ones
-            articles_with_scores = articles_with_scores[:self.results_to_show]
-
-            recommendations = self._load_recommendations_from_search_results(
-                articles = [a for (a,s) in articles_with_scores],
-                scores = [s for (a,s) in articles_with_scores]
-            )
-        else:
-            # Limit results to the best ones
-            articles = articles[:self.results_to_show]
-            recommendations = self._load_recommendations_from_search_results(
-                articles
-            )
 
         context['query'] = query
         context['total_results'] = total_results
         context['recommendations'] = recommendations
         context['search_form'] = SearchForm(self.request.GET)
         context['cancel_search_url'] = self._get_home_url(self.request)
+        context['load_more_url'] = self._get_load_more_url(version)
         context['classifier_initialized'] = self.request.user.classifier.is_initialized()
 
         return context
 
 
+    def _get_load_more_url(self, version):
+        """Returns the url for loading further results of the same ranking."""
+        url = reverse('load_more_search')
+        if version is None:
+            return url
+        querydict = QueryDict(mutable=True)
+        querydict['v'] = version
+        return url + '?' + querydict.urlencode()
+
+
     def _load_recommendations_from_search_results(self, articles, scores=[]):
         """Returns recommendations for articles found using the search.
         Its main purpose is to load metadata for existing recommendations.
@@ -349,6 +352,15 @@ class LoadMoreHome(LoadMoreMixin, HomePageView):
     template_name = 'website/snippets/recommendations.html'
 
 
+class LoadMoreSearch(LoadMoreMixin, SearchView):
+    """The Ajax endpoint for requesting more results of a search.
+
+    Works like `LoadMoreHome`. The ranked results of the search are cached,
+    so only the articles of the requested page have to be loaded.
+    """
+    template_name = 'website/snippets/recommendations.html'
+
+
 class TermsAndConditionsView(TemplateView):
     template_name = 'website/termsandconditions.html'
 
@@ -407,7 +419,7 @@ class SettingsView(LoginRequiredMixin, TemplateView):
         """Meant to run in the background as a separate process. 
         Called after a file was uploaded/deleted. Retrains the 
         classifier and creates some recommendations."""
-        management.call_command('train_classifiers', userid)
+        management.call_command('train_classifiers', userid, '--no-evaluation')
         management.call_command('create_recommendations', '--last-week', user_ids=[userid])
 
 
@@ -680,16 +692,21 @@ def download_file(request):
     return response
 
 
-def get_recommendation_or_new(user, article_id):
+def get_recommendation_or_new(user, article_id, lock=False):
     """Returns the recommendation for this combination of user and article.
     If there is none then a new one will be created with a default score.
     The returned recommendation is not yet saved to the database. You have
     to call `save()` manually if that is what you desire.
     If you need to call this function multiple times in a row use the batch 
     version instead (`get_recommendations_or_new()`).
+    With `lock=True` an existing recommendation is locked until the end of
+    the current transaction.
     """
+    recommendations = Recommendation.objects
+    if lock:
+        recommendations = recommendations.select_for_update()
     try:
-        r = Recommendation.objects.get(user=user, article=article_id)
+        r = recommendations.get(user=user, article=article_id)
     except Recommendation.DoesNotExist:
         article = Article.objects.get(pk=article_id)
         r = Recommendation(user=user, article=article)
@@ -736,6 +753,37 @@ def get_recommendations_or_new(user, article_ids):
 
 
 
+def update_classifier(user, recommendation, previous_target):
+    """Incrementally updates a user's classifier after the user interacted
+    with a recommendation.
+
+    Reverts what the classifier learned from the recommendation's previous
+    state and learns from its current state instead. Call it in the same
+    transaction that locked and saved the recommendation, so concurrent
+    requests can't revert the same state twice. Any error is logged but
+    never interrupts the request. A full retraining via `update_classifiers`
+    will pick up the interaction anyway.
+
+    Args:
+        previous_target: The result of `get_training_target()` before the
+            recommendation was modified.
+    """
+    current_target = recommendation.get_training_target()
+    if current_target == previous_target:
+        return
+
+    targets = []
+    if previous_target is not None:
+        targets.append((previous_target[0], -previous_target[1]))
+    if current_target is not None:
+        targets.append(current_target)
+
+    try:
+        user.classifier.update(recommendation.article, targets)
+    except Exception:
+        logger.exception("Could not update the classifier of user {}".format(user.pk))
+
+
 @csrf_exempt
 @login_required
 @require_POST
@@ -743,9 +791,12 @@ def log_click(request, article_pk):
     """Stores a user's click on an article.
     Called via the 'ping' argument on a link (sends a POST request).
     """
-    r = get_recommendation_or_new(request.user, article_pk)
-    r.clicked = True
-    r.save()
+    with transaction.atomic():
+        r = get_recommendation_or_new(request.user, article_pk, lock=True)
+        previous_target = r.get_training_target()
+        r.clicked = True
+        r.save()
+        update_classifier(request.user, r, previous_target)
 
     UserLog.objects.create_log(
         user=request.user, 
@@ -766,10 +817,13 @@ def log_like(request, article_pk):
     Toggles the `liked` state of the respective article. 
     Called via ajax.
     """
-    r = get_recommendation_or_new(request.user, article_pk)
-    r.liked = not r.liked
-    r.disliked = False
-    r.save()
+    with transaction.atomic():
+        r = get_recommendation_or_new(request.user, article_pk, lock=True)
+        previous_target = r.get_training_target()
+        r.liked = not r.liked
+        r.disliked = False
+        r.save()
+        update_classifier(request.user, r, previous_target)
 
     UserLog.objects.create_log(
         user=request.user, 
@@ -790,10 +844,13 @@ def log_dislike(request, article_pk):
     Toggles the `disliked` state of the respective article. 
     Called via ajax.
     """
-    r = get_recommendation_or_new(request.user, article_pk)
-    r.liked = False
-    r.disliked = not r.disliked
-    r.save()
+    with transaction.atomic():
+        r = get_recommendation_or_new(request.user, article_pk, lock=True)
+        previous_target = r.get_training_target()
+        r.liked = False
+        r.disliked = not r.disliked
+        r.save()
+        update_classifier(request.user, r, previous_target)
 
     UserLog.objects.create_log(
         user=request.user, 
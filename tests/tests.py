@@ -1,19 +1,46 @@
 import os
+import socket
+import shutil
+import tempfile
+import threading
+from io import StringIO
+import numpy as np
+import feedparser
 from datetime import date, datetime, timedelta
+from unittest import mock
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.db.utils import IntegrityError
 from django.db.models import Q
 from django.contrib.auth.models import User
 from django.core.management import call_command
 from django.urls import reverse
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache.backends.locmem import LocMemCache
 
 import machinelearning as ml
 from machinelearning.trainer import Trainer
-from machinelearning.ranker import Ranker
-from website.models import Article, Recommendation, Classifier, UserUpload
+from machinelearning.ranker import Ranker, MultiUserRanker, TopK
+from machinelearning.cache import ModelCache
+from machinelearning.utils import Model, save_estimator, load_estimator
+from machinelearning import compact
+from machinelearning.sampling import KeySampler
+from machinelearning.featurestore import FeatureStore
+from sklearn.feature_extraction.text import TfidfVectorizer
+from website.models import Article, Recommendation, Classifier, UserUpload, IngestBatch, FetchWindow
+from website.utils import chunked
+from website.management.commands import train_classifiers
+from website import search, features, sampling
 from fetching import Fetcher
+from fetching.pipeline import run_pipeline
+from fetching.ingest import store_articles, drop_known_ids, IngestResult
+from fetching.sources import scheduler
+from fetching.sources.scheduler import RequestScheduler, TokenBucket, HTTPStatusError
+from fetching.sources import pubmed
+from fetching.sources.pubmed import Pubmed
+from fetching.sources import biorxiv
+from fetching.sources.biorxiv import bioRxiv
+from fetching.sources.cache import ResponseCache, CacheMiss
 
 import logging
 logging.disable(logging.CRITICAL)
@@ -28,6 +55,323 @@ class FetcherTest(TestCase):
         nr_articles = Article.objects.all().count()
         self.assertGreater(nr_articles, 0)
 
+    def test_sources_are_called_concurrently(self):
+        # Both paired sources only return once the other one was called too
+        barrier = threading.Barrier(2, timeout=10)
+        released = threading.Event()
+
+        class PairedSource:
+            query_timeout = 60
+            max_concurrent_requests = 1
+
+            def query(self, query, max_results=10):
+                barrier.wait()
+                return [type(self).__name__]
+
+        class OtherPairedSource(PairedSource):
+            pass
+
+        class HangingSource(PairedSource):
+            query_timeout = 0.1
+
+            def query(self, query, max_results=10):
+                released.wait()
+                return [type(self).__name__]
+
+        class BrokenSource(PairedSource):
+            def query(self, query, max_results=10):
+                raise RuntimeError("Service unavailable")
+
+        fetcher = Fetcher()
+        fetcher.sources = [
+            HangingSource(), PairedSource(), OtherPairedSource(), BrokenSource()
+        ]
+        failed = []
+        try:
+            results = fetcher._call_all('query', 'query', failed=failed)
+        finally:
+            released.set()
+
+        # The hanging source is given up after its timeout, the broken one is
+        # left out and neither holds up the others
+        self.assertEqual(
+            sorted(r[0] for (_, r) in results), ['OtherPairedSource', 'PairedSource']
+        )
+        self.assertEqual(
+            sorted(type(s).__name__ for s in failed), ['BrokenSource', 'HangingSource']
+        )
+
+    def test_windows(self):
+        class Source:
+            max_concurrent_requests = 1
+            supports_date_range = True
+
+        fetcher = Fetcher()
+        fetcher.sources = [Source()]
+        windows = fetcher._get_windows(date(2019, 1, 1), date(2019, 1, 20), resume=False)
+        self.assertEqual([(w.start_date, w.end_date) for (_, w) in windows], [
+            (date(2019, 1, 1), date(2019, 1, 7)),
+            (date(2019, 1, 8), date(2019, 1, 14)),
+            (date(2019, 1, 15), date(2019, 1, 20)),
+        ])
+
+        # Resuming skips windows that are done
+        w = windows[0][1]
+        w.status = FetchWindow.Status.DONE
+        w.save()
+        self.assertEqual(len(fetcher._get_windows(date(2019, 1, 1), date(2019, 1, 20), resume=True)), 2)
+        self.assertEqual(len(fetcher._get_windows(date(2019, 1, 1), date(2019, 1, 20), resume=False)), 3)
+        self.assertEqual(FetchWindow.objects.count(), 3)
+
+    def test_sources_without_dates_get_a_single_window(self):
+        class Source:
+            max_concurrent_requests = 1
+            supports_date_range = True
+
+        class FeedSource(Source):
+            supports_date_range = False
+
+        fetcher = Fetcher()
+        fetcher.sources = [Source(), FeedSource()]
+        windows = fetcher._get_windows(date(2019, 1, 1), date(2019, 1, 20), resume=False)
+        feed_windows = [w for (s, w) in windows if isinstance(s, FeedSource)]
+        self.assertEqual(len(windows), 4)
+        self.assertEqual(
+            [(w.start_date, w.end_date) for w in feed_windows],
+            [(date(2019, 1, 1), date(2019, 1, 20))]
+        )
+
+    def test_windows_are_in_progress_while_downloading(self):
+        statuses = []
+        class Source:
+            max_concurrent_requests = 1
+            supports_date_range = True
+            fail = False
+
+            def download(self, query, start_date=None, end_date=None):
+                statuses.append(FetchWindow.objects.get().status)
+                if self.fail:
+                    raise RuntimeError("Service unavailable")
+
+        source = Source()
+        fetcher = Fetcher()
+        fetcher.sources = [source]
+        window = FetchWindow.objects.create(
+            source='test', start_date=date(2019, 1, 1), end_date=date(2019, 1, 7),
+            status=FetchWindow.Status.DONE
+        )
+        # Don't close the connection of the test's transaction
+        with mock.patch('fetching.fetcher.db.connection.close'):
+            self.assertEqual(fetcher._download_window((source, window)), FetchWindow.Status.DONE)
+            source.fail = True
+            self.assertEqual(fetcher._download_window((source, window)), FetchWindow.Status.FAILED)
+        self.assertEqual(statuses, [FetchWindow.Status.IN_PROGRESS] * 2)
+        self.assertEqual(FetchWindow.objects.get().status, FetchWindow.Status.FAILED)
+
+    def test_resolve_titles_from_database(self):
+        a = Article.objects.create(
+            title='Deep Learning: A Review',
+            abstract='Here we talk about the great things we discovered',
+            pubdate=date.today(),
+        )
+        self.assertEqual(a.normalized_title, 'deeplearningareview')
+
+        fetcher = Fetcher()
+        fetcher.sources = []
+        titles = ['deep learning - a review', 'DEEP LEARNING: A REVIEW.', 'Unknown']
+        found = fetcher.resolve_titles(titles)
+        self.assertEqual(found, {titles[0]: a, titles[1]: a})
+
+    def test_resolve_titles_reports_failures(self):
+        class FailingSource:
+            query_timeout = 10
+            max_concurrent_requests = 1
+
+            def query_titles(self, titles, max_results=10):
+                raise RuntimeError("Service unavailable")
+
+        Article.objects.create(
+            title='A known article',
+            abstract='Here we talk about the great things we discovered',
+            pubdate=date.today(),
+        )
+        fetcher = Fetcher()
+        fetcher.sources = [FailingSource()]
+        failed = []
+        found = fetcher.resolve_titles(['A known article', 'An unknown article'], failed)
+        self.assertEqual(list(found), ['A known article'])
+        self.assertEqual(failed, ['An unknown article'])
+
+    def test_biorxiv_articles_are_stored_once(self):
+        feed = feedparser.parse(b"""<?xml version="1.0" encoding="UTF-8"?>
+            <rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/">
+            <channel>
+                <item>
+                    <title>A preprint</title>
+                    <link>https://www.biorxiv.org/content/10.1101/000001</link>
+                    <description>Here we talk about the great things we discovered</description>
+                    <dc:identifier>doi:10.1101/000001</dc:identifier>
+                    <dc:date>2019-01-02</dc:date>
+                    <dc:creator>Tester, P., Checker, B.</dc:creator>
+                </item>
+            </channel>
+            </rss>""")
+
+        class Source(bioRxiv):
+            failing = set()
+
+            def _load_feed(self, url, state=None):
+                if url in self.failing:
+                    return None, None
+                return feed['entries'], None
+
+        source = Source()
+        # The article appears in every feed, one of which fails
+        source.failing = {source._get_url('zoology')}
+        source.download("")
+        self.assertEqual(Article.objects.filter(doi='10.1101/000001').count(), 1)
+
+        # Fails only if no feed could be loaded at all
+        source.failing = {source._get_url(c) for c in biorxiv.CATEGORIES}
+        with self.assertRaises(RuntimeError):
+            source.download("")
+
+    def test_failed_page_raises(self):
+        source = Pubmed()
+        # Every request fails
+        source._entrez = lambda utility, **params: None
+        with self.assertRaises(RuntimeError):
+            list(source._download_pages(('WebEnv', '1'), 25, 10))
+
+    def test_pages_of_known_pmids_are_cached(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        cache = ResponseCache(directory, 1024 ** 2, {'pubmed': 3600})
+        requests = []
+        def efetch(**params):
+            requests.append(params)
+            return StringIO("PMID- 1\n")
+
+        source = Pubmed()
+        with mock.patch.object(pubmed, 'get_cache', return_value=cache), \
+                mock.patch.object(pubmed.Entrez, 'efetch', efetch):
+            # Every search gets a new WebEnv on the history server
+            for webenv in ['first', 'second']:
+                pages = list(source._download_pages((webenv, '1'), 2, 10, ['1', '2']))
+                self.assertEqual(pages, ["PMID- 1\n"])
+            self.assertEqual(len(requests), 1)
+
+            # Pages of a search result are always loaded again
+            list(source._download_pages(('third', '1'), 2, 10))
+            self.assertEqual(len(requests), 2)
+
+
+class PipelineTest(TestCase):
+
+    def test_results_keep_order(self):
+        results = list(run_pipeline(
+            iter(range(20)), [lambda x: x * 2, lambda x: x + 1], queue_size=1
+        ))
+        self.assertEqual(results, [2 * x + 1 for x in range(20)])
+
+    def test_errors_are_raised(self):
+        def fail(x):
+            if x == 3:
+                raise ValueError("Broken item")
+            return x
+
+        def produce():
+            yield 1
+            raise RuntimeError("Broken download")
+
+        with self.assertRaises(ValueError):
+            list(run_pipeline(range(10), [fail]))
+        with self.assertRaises(RuntimeError):
+            list(run_pipeline(produce(), [fail]))
+
+    def test_stopping_early(self):
+        consumed = []
+        def produce():
+            for i in range(1000):
+                consumed.append(i)
+                yield i
+
+        for x in run_pipeline(produce(), [lambda x: x], queue_size=1):
+            break
+        # Only a few items were read ahead
+        self.assertLess(len(consumed), 10)
+
+
+class SchedulerTest(TestCase):
+
+    class Scheduler(RequestScheduler):
+        # Don't wait between retries
+        def _get_delay(self, attempt):
+            return 0
+
+    def _flaky(self, errors, result='ok'):
+        errors = list(errors)
+        def send():
+            if errors:
+                raise errors.pop(0)
+            return result
+        return send
+
+    def test_classify(self):
+        self.assertEqual(scheduler.classify(socket.timeout()), scheduler.TIMEOUT)
+        self.assertEqual(scheduler.classify(HTTPStatusError(429)), scheduler.RATE_LIMITED)
+        self.assertEqual(scheduler.classify(HTTPStatusError(404)), scheduler.CLIENT_ERROR)
+        self.assertEqual(scheduler.classify(HTTPStatusError(503)), scheduler.SERVER_ERROR)
+        self.assertEqual(scheduler.classify(ConnectionResetError()), scheduler.CONNECTION_ERROR)
+        self.assertEqual(scheduler.classify(ValueError()), scheduler.OTHER_ERROR)
+
+    def test_retries(self):
+        s = self.Scheduler('test', requests_per_second=1000)
+        send = self._flaky([socket.timeout(), HTTPStatusError(503)])
+        self.assertEqual(s.call(send), 'ok')
+        counters = s.get_counters()
+        self.assertEqual(counters['requests'], 3)
+        self.assertEqual(counters['retries'], 2)
+        self.assertEqual(counters['successes'], 1)
+
+    def test_client_errors_are_not_retried(self):
+        s = self.Scheduler('test', requests_per_second=1000)
+        with self.assertRaises(HTTPStatusError):
+            s.call(self._flaky([HTTPStatusError(404)]))
+        self.assertEqual(s.get_counters()['requests'], 1)
+        self.assertEqual(s.get_counters()['failures'], 1)
+
+    def test_giving_up(self):
+        s = self.Scheduler('test', requests_per_second=1000, max_tries=2)
+        with self.assertRaises(socket.timeout):
+            s.call(self._flaky([socket.timeout()] * 3))
+        self.assertEqual(s.get_counters()['requests'], 2)
+
+    def test_rate_limit(self):
+        class Clock:
+            now = 0
+
+            def monotonic(self):
+                return self.now
+
+            def sleep(self, seconds):
+                self.now += seconds
+
+        clock = Clock()
+        with mock.patch.object(scheduler, 'time', clock):
+            bucket = TokenBucket(rate=50)
+            for i in range(11):
+                bucket.acquire()
+        # The first token is available at once, every further one after 1/50 s
+        self.assertAlmostEqual(clock.now, 10 / 50)
+
+        # Slows down when asked to, but never below a fraction of the rate
+        for i in range(10):
+            bucket.slow_down()
+        self.assertAlmostEqual(bucket.rate, 50 * scheduler.MIN_RATE_FRACTION)
+        bucket.speed_up()
+        self.assertGreater(bucket.rate, 50 * scheduler.MIN_RATE_FRACTION)
+
 
 class ClassifierTest(TestCase):
 
@@ -47,6 +391,34 @@ class ClassifierTest(TestCase):
         self.assertFalse(os.path.exists(path_clf))
         self.assertFalse(os.path.exists(path_vec))
 
+    def test_shared_vectorizer_is_referenced(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        store = FeatureStore(directory)
+        store.fit(FeatureStoreTest.SAMPLES)
+
+        with mock.patch.object(features, 'get_store', return_value=store):
+            c = self.u.classifier
+            c.classifier = "FOO"
+            c.vectorizer = store.vectorizer
+            c.save()
+            # Only the classifier is written
+            self.assertEqual(c.path_vec, '')
+            self.assertEqual(c.vectorizer_fingerprint, store.fingerprint)
+            self.assertEqual(os.listdir(os.path.dirname(c.path_clf)), ['classifier'])
+
+            loaded = Classifier.objects.get(pk=self.u.pk)
+            self.assertTrue(loaded.is_initialized())
+            self.assertIs(loaded.vectorizer, store.vectorizer)
+
+            # The vectorizer of a previous vocabulary can still be loaded
+            store.fit(FeatureStoreTest.SAMPLES)
+            loaded = Classifier.objects.get(pk=self.u.pk)
+            self.assertTrue(loaded.is_initialized())
+            self.assertEqual(
+                loaded.vectorizer.feature_store_fingerprint, c.vectorizer_fingerprint
+            )
+
     def test_overwrite_classifier(self):
         """There should be a way to overwrite a user's classifier."""
         u = User.objects.all()[0]
@@ -75,6 +447,152 @@ class ClassifierTest(TestCase):
         u = User.objects.create(username='newuser', email='new@user.com')
         u.classifier
 
+    def test_versioned_saves(self):
+        c = self.u.classifier
+        self.assertIsNone(c.get_version())
+        versions = []
+        for i in range(3):
+            c.classifier = "FOO{}".format(i)
+            c.vectorizer = "BAR"
+            c.save()
+            versions.append(c.get_version())
+        self.assertEqual(c.version, 3)
+        self.assertEqual(len(set(versions)), 3)
+        self.assertEqual(Classifier.objects.get(pk=self.u.pk).classifier, "FOO2")
+
+        # Older versions are removed
+        directory = c.get_path('')
+        self.assertEqual(len(os.listdir(directory)), Classifier.KEEP_VERSIONS)
+
+    def test_versions_are_unique_after_reset(self):
+        c = self.u.classifier
+        c.classifier = "FOO"
+        c.vectorizer = "BAR"
+        c.save()
+        old_version = c.get_version()
+        old_path = c.path_clf
+        c.delete()
+
+        c = Classifier.objects.create(user=self.u)
+        c.classifier = "BAZ"
+        c.vectorizer = "BAR"
+        c.save()
+        self.assertEqual(c.version, 1)
+        self.assertNotEqual(c.get_version(), old_version)
+        self.assertNotEqual(c.path_clf, old_path)
+        self.assertEqual(Classifier.objects.get(pk=self.u.pk).classifier, "BAZ")
+
+    def test_search_cache_key_follows_version(self):
+        c = self.u.classifier
+        c.classifier = "FOO"
+        c.vectorizer = "BAR"
+        c.save()
+        key = search._get_cache_key(self.u, "query", c.get_version())
+        self.assertEqual(key, search._get_cache_key(self.u, "query", c.get_version()))
+        self.assertNotEqual(key, search._get_cache_key(self.u, "other query", c.get_version()))
+
+        # Saving a new classifier invalidates all cached results
+        c.classifier = "BAZ"
+        c.save()
+        self.assertNotEqual(key, search._get_cache_key(self.u, "query", c.get_version()))
+
+    def test_further_search_pages_keep_their_ranking(self):
+        c = self.u.classifier
+        c.classifier = "FOO"
+        c.vectorizer = "BAR"
+        c.save()
+        first_version = c.get_version()
+        articles = [
+            Article.objects.create(title='Article {}'.format(i), abstract='Abstract', pubdate=date.today())
+            for i in range(3)
+        ]
+        cache = LocMemCache('search', {})
+        cache.set(
+            search._get_cache_key(self.u, "query", first_version),
+            (3, [(a.pk, 1 - i / 10) for (i, a) in enumerate(articles)])
+        )
+
+        # The classifier is updated while the user pages through the results
+        c.classifier = "BAZ"
+        c.save()
+        cache.set(search._get_cache_key(self.u, "query", c.get_version()), (1, [(articles[2].pk, 0.5)]))
+
+        def get_articles(query_string, article_ids):
+            return {pk: Article.objects.get(pk=pk) for pk in article_ids}
+
+        with override_settings(WEBSITE_SEARCH_CACHE='search'), \
+                mock.patch.object(search, 'caches', {'search': cache}), \
+                mock.patch.object(search, 'get_articles', get_articles):
+            total, results, version = search.ranked_search(
+                self.u, "query", offset=1, max_results=1, version=first_version
+            )
+            self.assertEqual((total, version), (3, first_version))
+            self.assertEqual([a for (a, s) in results], [articles[1]])
+
+            # Unknown versions start a new ranking with the current classifier
+            total, results, version = search.ranked_search(self.u, "query", version='unknown')
+            self.assertEqual((total, version), (1, c.get_version()))
+            self.assertEqual([a for (a, s) in results], [articles[2]])
+
+    def _train_classifier(self, u):
+        trainer = Trainer()
+        for i in range(10):
+            trainer.add_data("This is a very interesting and relevant and important.", ml.Targets.INTERESTING)
+            trainer.add_data("This is totally boring and irrelevant. Do not read it.", ml.Targets.IRRELEVANT)
+        model = trainer.train()
+        u.classifier.classifier = model.classifier
+        u.classifier.vectorizer = model.vectorizer
+        u.classifier.save()
+        return Classifier.objects.get(pk=u.pk)
+
+    def _create_article(self):
+        return Article.objects.create(
+            title='An interesting article',
+            abstract='Very interesting, relevant and important.',
+            pubdate=date.today(),
+        )
+
+    def test_like_and_unlike_reverts_update(self):
+        self.u.profile.terms_consent = True
+        self.u.profile.save()
+        self.client.force_login(self.u)
+        c = self._train_classifier(self.u)
+        a = self._create_article()
+        counts = c.classifier.feature_count_.copy()
+
+        self.client.post(reverse('log_like', args=[a.pk]))
+        liked = Classifier.objects.get(pk=self.u.pk)
+        self.assertGreater(liked.version, c.version)
+        self.assertGreater(liked.classifier.feature_count_.sum(), counts.sum())
+
+        self.client.post(reverse('log_like', args=[a.pk]))
+        unliked = Classifier.objects.get(pk=self.u.pk)
+        self.assertGreater(unliked.version, liked.version)
+        self.assertAlmostEqual(abs(unliked.classifier.feature_count_ - counts).sum(), 0)
+
+    def test_stale_updates_are_not_lost(self):
+        c = self._train_classifier(self.u)
+        a = self._create_article()
+        count = c.classifier.class_count_.sum()
+
+        # Both were loaded before either was updated
+        first = Classifier.objects.get(pk=self.u.pk)
+        second = Classifier.objects.get(pk=self.u.pk)
+        self.assertTrue(first.update(a, [(ml.Targets.INTERESTING, 1)]))
+        self.assertTrue(second.update(a, [(ml.Targets.INTERESTING, 1)]))
+
+        latest = Classifier.objects.get(pk=self.u.pk)
+        self.assertAlmostEqual(latest.classifier.class_count_.sum(), count + 2)
+
+    def test_reverting_unknown_sample_keeps_counts_positive(self):
+        c = self._train_classifier(self.u)
+        a = self._create_article()
+        self.assertTrue(c.update(a, [(ml.Targets.INTERESTING, -100)]))
+        clf = Classifier.objects.get(pk=self.u.pk).classifier
+        self.assertTrue((clf.feature_count_ >= 0).all())
+        self.assertTrue((clf.class_count_ >= 0).all())
+        self.assertFalse(np.isnan(clf.feature_log_prob_).any())
+
 
 class NewsletterTest(TestCase):
 
@@ -101,6 +619,83 @@ class TrainerTest(TestCase):
         self.assertGreater(score_tuple[ml.Targets.IRRELEVANT], score_tuple[ml.Targets.INTERESTING])
 
 
+    def test_optional_evaluation(self):
+        for cv in [0, 5]:
+            trainer = Trainer(cv=cv, n_jobs=1)
+            for i in range(10):
+                trainer.add_data("This is a very interesting and relevant and important.", ml.Targets.INTERESTING)
+                trainer.add_data("This is totally boring and irrelevant. Do not read it.", ml.Targets.IRRELEVANT)
+            model = trainer.train()
+            if cv:
+                self.assertEqual(model.metrics['folds'], 5)
+                self.assertAlmostEqual(model.metrics['precision'], 1)
+            else:
+                self.assertIsNone(model.metrics)
+
+    def _create_interactions(self, u):
+        for i in range(10):
+            for (text, liked) in [("very interesting and relevant", True),
+                                  ("totally boring and irrelevant", False)]:
+                a = Article.objects.create(
+                    title='{} {} {}'.format(text, u.pk, i), abstract=text, pubdate=date.today()
+                )
+                Recommendation.objects.create(
+                    user=u, article=a, score=0, liked=liked, disliked=not liked
+                )
+
+    def test_training_without_evaluation_clears_metrics(self):
+        u = User.objects.create(username='testuser', email='test@user.com')
+        self._create_interactions(u)
+        u.classifier.set_metrics_dict({'accuracy': 0.9})
+        u.classifier.save()
+
+        call_command('train_classifiers', str(u.pk), '--no-evaluation')
+        c = Classifier.objects.get(pk=u.pk)
+        self.assertTrue(c.is_initialized())
+        self.assertEqual(c.get_metrics_dict(), {})
+
+
+    def test_training_several_users(self):
+        trained = User.objects.create(username='trained', email='trained@user.com')
+        self._create_interactions(trained)
+        skipped = User.objects.create(username='skipped', email='skipped@user.com')
+        missing = skipped.pk + 1
+
+        out = StringIO()
+        call_command(
+            'train_classifiers', str(trained.pk), str(skipped.pk), str(missing),
+            '--no-evaluation', stdout=out
+        )
+        self.assertTrue(Classifier.objects.get(pk=trained.pk).is_initialized())
+        self.assertFalse(skipped.classifier.is_initialized())
+        self.assertIn('1 not found, 1 skipped, 1 trained', out.getvalue())
+
+    def test_parallel_training_cross_validates_in_one_process(self):
+        cv_jobs = []
+        def train_user(uid, **kwargs):
+            cv_jobs.append(kwargs['cv_jobs'])
+            return uid, 'trained', 0
+
+        class Pool:
+            def __init__(self, processes):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def imap_unordered(self, func, iterable):
+                return map(func, iterable)
+
+        with mock.patch.object(train_classifiers, 'train_user', train_user), \
+                mock.patch.object(train_classifiers.multiprocessing, 'Pool', Pool), \
+                mock.patch.object(train_classifiers.db.connections, 'close_all'):
+            for args in [['--jobs', '2'], ['--jobs', '2', '--cv-jobs', '3'], []]:
+                call_command('train_classifiers', '1', '2', *args, stdout=StringIO())
+        self.assertEqual(cv_jobs, [1, 1, 3, 3, -1, -1])
+
     def test_training_without_samples(self):
         """Training shouldn't be successful if no data is provided."""
         u = User.objects.create(username='testuser', email='test@user.com')
@@ -109,6 +704,434 @@ class TrainerTest(TestCase):
         self.assertIsNone(model)
 
 
+class RankerTest(TestCase):
+
+    def _train(self, interesting, boring):
+        trainer = Trainer(vectorizer=self.vectorizer)
+        for i in range(10):
+            trainer.add_data(interesting, ml.Targets.INTERESTING)
+            trainer.add_data(boring, ml.Targets.IRRELEVANT)
+        return trainer.train()
+
+    def setUp(self):
+        self.vectorizer = TfidfVectorizer().fit([
+            "interesting relevant important boring irrelevant text",
+        ])
+
+    def test_multi_user_scores_match_single_models(self):
+        models = [
+            self._train("interesting relevant", "boring irrelevant"),
+            self._train("boring irrelevant", "interesting relevant"),
+        ]
+        ranker = MultiUserRanker()
+        for (key, model) in enumerate(models):
+            self.assertTrue(ranker.add_model(key, model))
+        self.assertEqual(ranker.keys, [0, 1])
+
+        x = self.vectorizer.transform(["interesting text", "boring text", "text"])
+        scores = ranker.get_scores(x)
+        self.assertEqual(scores.shape, (3, 2))
+        for (column, model) in enumerate(models):
+            classes = list(model.classifier.classes_)
+            expected = model.classifier.predict_proba(x)[:, classes.index(ml.Targets.INTERESTING)]
+            np.testing.assert_allclose(scores[:, column], expected, rtol=1e-4)
+
+    def test_multi_user_ranker_rejects_unsupported_models(self):
+        ranker = MultiUserRanker()
+        model = Model()
+        model.classifier = "FOO"
+        self.assertFalse(ranker.add_model(0, model))
+        with self.assertRaises(ValueError):
+            ranker.get_scores(self.vectorizer.transform(["text"]))
+
+
+    def test_top_k(self):
+        top = TopK(3)
+        top.push([1, 2, 3, 4], [0.1, 0.9, 0.5, 0.7])
+        top.push([5, 6], [0.8, 0.2])
+        self.assertEqual([k for (k, _) in top.get_result()], [2, 5, 4])
+
+    def test_top_k_per_column(self):
+        top = TopK(2, num_columns=2)
+        for start in range(0, 10, 3):
+            keys = list(range(start, min(start + 3, 10)))
+            scores = [[k, -k] for k in keys]
+            top.push(keys, scores)
+        self.assertEqual(top.get_result(0), [(9, 9.0), (8, 8.0)])
+        self.assertEqual(top.get_result(1), [(0, 0.0), (1, -1.0)])
+
+    def test_top_k_skips_masked_scores(self):
+        top = TopK(3)
+        top.push([1, 2], [0.5, -np.inf])
+        self.assertEqual(top.get_result(), [(1, 0.5)])
+
+
+class ModelCacheTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.loaded = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def _load(self, path):
+        self.loaded.append(path)
+        with open(path) as f:
+            return f.read()
+
+    def test_hits_and_misses(self):
+        cache = ModelCache(max_size=1024)
+        path = self._write('a', 'first')
+        self.assertEqual(cache.load(path, self._load), 'first')
+        self.assertEqual(cache.load(path, self._load), 'first')
+        self.assertEqual(len(self.loaded), 1)
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        # Overwritten files are loaded again
+        self._write('a', 'second')
+        os.utime(path, ns=(1, 1))
+        self.assertEqual(cache.load(path, self._load), 'second')
+        self.assertEqual(cache.get_stats()['entries'], 1)
+
+    def test_versions(self):
+        cache = ModelCache(max_size=1024)
+        path = self._write('a', 'first')
+        cache.load(path, self._load, version='1')
+        cache.load(path, self._load, version='1')
+        cache.load(path, self._load, version='2')
+        self.assertEqual(len(self.loaded), 2)
+
+        with self.assertRaises(FileNotFoundError):
+            cache.load(os.path.join(self.directory, 'missing'), self._load)
+
+    def test_eviction(self):
+        cache = ModelCache(max_size=10)
+        paths = [self._write(name, 'x' * 4) for name in 'abc']
+        for path in paths:
+            cache.load(path, self._load)
+        stats = cache.get_stats()
+        self.assertLessEqual(stats['size'], 10)
+        self.assertEqual(stats['evictions'], 1)
+
+        # The least recently used entry was evicted
+        cache.load(paths[2], self._load)
+        cache.load(paths[0], self._load)
+        self.assertEqual(self.loaded, paths + [paths[0]])
+
+
+class CompactFormatTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_round_trip(self):
+        trainer = Trainer()
+        for i in range(10):
+            trainer.add_data("This is a very interesting and relevant and important.", ml.Targets.INTERESTING)
+            trainer.add_data("This is totally boring and irrelevant. Do not read it.", ml.Targets.IRRELEVANT)
+        model = trainer.train()
+        for obj in [model.vectorizer, model.classifier]:
+            self.assertTrue(compact.can_save(obj))
+        save_estimator(model.vectorizer, os.path.join(self.directory, 'vectorizer'))
+        save_estimator(model.classifier, os.path.join(self.directory, 'classifier'))
+
+        vectorizer = load_estimator(os.path.join(self.directory, 'vectorizer'))
+        classifier = load_estimator(os.path.join(self.directory, 'classifier'))
+        docs = ["very interesting, important, relevant", "boring and unknown words"]
+        expected = model.vectorizer.transform(docs)
+        x = vectorizer.transform(docs)
+        self.assertAlmostEqual(abs(x - expected).sum(), 0, places=5)
+        np.testing.assert_allclose(
+            classifier.predict_proba(x), model.classifier.predict_proba(expected), rtol=1e-4
+        )
+
+        # Counts are stored exactly, since updates keep adding to them
+        self.assertEqual(classifier.feature_count_.dtype, np.float64)
+        self.assertEqual(classifier.class_count_.dtype, np.float64)
+        np.testing.assert_array_equal(classifier.feature_count_, model.classifier.feature_count_)
+        self.assertEqual(classifier.feature_log_prob_.dtype, np.float32)
+
+    def test_fallback_to_joblib(self):
+        path = os.path.join(self.directory, 'other')
+        self.assertFalse(compact.can_save("FOO"))
+        self.assertFalse(compact.can_save(TfidfVectorizer()))
+        save_estimator("FOO", path)
+        self.assertTrue(os.path.isfile(path))
+        self.assertEqual(load_estimator(path), "FOO")
+
+
+class KeySamplerTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'sampler.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_add_and_save(self):
+        sampler = KeySampler(self.path)
+        self.assertEqual(sampler.max_key(), 0)
+        sampler.add([1, 2, 5], [2017, 2018, 2018])
+        with self.assertRaises(ValueError):
+            sampler.add([4], [2018])
+        sampler.save()
+
+        loaded = KeySampler(self.path)
+        self.assertEqual(loaded.max_key(), 5)
+        loaded.remove([2])
+        self.assertEqual(list(loaded.keys), [1, 5])
+
+    def test_sample(self):
+        sampler = KeySampler(self.path)
+        sampler.add(range(1, 101), [2000 + k % 2 for k in range(1, 101)])
+        keys = sampler.sample(10, excluded=range(1, 51), random_state=0)
+        self.assertEqual(len(set(keys)), 10)
+        self.assertTrue(all(50 < k <= 100 for k in keys))
+
+        # Asking for more than is available returns everything else
+        keys = sampler.sample(200, excluded=[1, 2], random_state=0)
+        self.assertEqual(sorted(keys), list(range(3, 101)))
+
+    def test_stratified_sample(self):
+        sampler = KeySampler(self.path)
+        # 90 keys in one stratum, 10 in the other
+        sampler.add(range(1, 101), [0] * 90 + [1] * 10)
+        keys = sampler.sample(40, stratify=True, random_state=0)
+        self.assertEqual(len(set(keys)), 40)
+        self.assertEqual(sum(1 for k in keys if k > 90), 10)
+
+    def test_global_sampler_follows_ingest_batches(self):
+        def create_article(title):
+            return Article.objects.create(title=title, abstract='Abstract', pubdate=date.today())
+
+        old = create_article('Old article')
+        with override_settings(WEBSITE_ARTICLE_SAMPLER_PATH=self.path), \
+                mock.patch.object(sampling, '_sampler', None):
+            self.assertEqual(sampling.get_sampler().max_key(), old.pk)
+
+            # Articles are only picked up once their batch was recorded
+            new = create_article('New article')
+            self.assertEqual(sampling.get_sampler().max_key(), old.pk)
+            IngestBatch.objects.create(first_article_id=new.pk, last_article_id=new.pk)
+            self.assertEqual(sampling.get_sampler().max_key(), new.pk)
+
+
+class FeatureStoreTest(TestCase):
+
+    SAMPLES = [
+        "interesting relevant important text",
+        "boring irrelevant text",
+        "interesting important text",
+        "relevant boring text",
+    ]
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_round_trip(self):
+        store = FeatureStore(self.path)
+        self.assertFalse(store.is_initialized())
+        store.fit(self.SAMPLES)
+        store.add([1, 2, 5], self.SAMPLES[:3])
+
+        # A new instance reads what the first one wrote
+        reloaded = FeatureStore(self.path)
+        self.assertEqual(reloaded.max_key(), 5)
+        x, found = reloaded.get_rows([5, 3, 1])
+        self.assertEqual(list(found), [True, False, True])
+        self.assertEqual(x[1].nnz, 0)
+        expected = store.vectorizer.transform([self.SAMPLES[2], self.SAMPLES[0]])
+        self.assertAlmostEqual(abs(x[[0, 2]] - expected).sum(), 0, places=5)
+
+    def test_transform_vectorizes_missing_keys_once(self):
+        store = FeatureStore(self.path)
+        store.fit(self.SAMPLES)
+        store.add([1, 2], self.SAMPLES[:2])
+
+        calls = []
+        def get_samples(indices):
+            calls.append(indices)
+            return [self.SAMPLES[k] for k in indices]
+
+        x = store.transform([2, 7, 1, 9], get_samples)
+        self.assertEqual(calls, [[1, 3]])
+        expected = store.vectorizer.transform(
+            [self.SAMPLES[1], self.SAMPLES[1], self.SAMPLES[0], self.SAMPLES[3]]
+        )
+        self.assertAlmostEqual(abs(x - expected).sum(), 0, places=5)
+
+    def test_keys_must_ascend(self):
+        store = FeatureStore(self.path)
+        store.fit(self.SAMPLES)
+        store.add([3], self.SAMPLES[:1])
+        with self.assertRaises(ValueError):
+            store.add([2], self.SAMPLES[1:2])
+
+    def test_is_compatible(self):
+        store = FeatureStore(self.path)
+        self.assertFalse(store.is_compatible(None))
+        store.fit(self.SAMPLES)
+        self.assertTrue(store.is_compatible(store.vectorizer))
+        self.assertFalse(store.is_compatible(TfidfVectorizer().fit(self.SAMPLES)))
+
+        # A new vocabulary makes older vectorizers incompatible
+        old_vectorizer = store.vectorizer
+        store.fit(self.SAMPLES)
+        self.assertFalse(store.is_compatible(old_vectorizer))
+
+    def test_refit_is_noticed_by_readers(self):
+        writer = FeatureStore(self.path)
+        writer.fit(self.SAMPLES)
+        writer.add([1, 2], self.SAMPLES[:2])
+        reader = FeatureStore(self.path)
+        self.assertFalse(reader.is_changed())
+
+        writer.fit(self.SAMPLES)
+
+        # The reader still sees the old rows until it reloads
+        self.assertTrue(reader.is_changed())
+        x, found = reader.get_rows([1, 2])
+        self.assertTrue(found.all())
+
+        reader.load()
+        self.assertEqual(reader.fingerprint, writer.fingerprint)
+        self.assertEqual(reader.num_rows, 0)
+
+    def test_old_vectorizers_are_kept(self):
+        store = FeatureStore(self.path)
+        store.fit(self.SAMPLES)
+        store.add([1, 2], self.SAMPLES[:2])
+        old_fingerprint = store.fingerprint
+        store.fit(self.SAMPLES)
+
+        # Only the vectorizer of the previous vocabulary is left
+        path = store.get_vectorizer_path(old_fingerprint)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [FeatureStore.VECTORIZER_FILE])
+        self.assertNotEqual(path, store.get_vectorizer_path(store.fingerprint))
+        self.assertTrue(os.path.exists(store.get_vectorizer_path(store.fingerprint)))
+
+    def test_concurrent_writes_are_rejected(self):
+        first = FeatureStore(self.path)
+        first.fit(self.SAMPLES)
+        second = FeatureStore(self.path)
+        second.add([1], self.SAMPLES[:1])
+        with self.assertRaises(RuntimeError):
+            first.add([2], self.SAMPLES[1:2])
+
+
+class ResponseCacheTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sent = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _send(self, data=b'response'):
+        def send():
+            self.sent.append(data)
+            return data
+        return send
+
+    def test_cacheable_responses(self):
+        cache = ResponseCache(self.directory, 1024, {'src': 3600})
+        for i in range(2):
+            data = cache.fetch('src', {'url': 'a'}, self._send())
+            self.assertEqual(data, b'response')
+        self.assertEqual(len(self.sent), 1)
+
+        # Other requests, sources and expired responses are sent again
+        cache.fetch('src', {'url': 'b'}, self._send())
+        cache.fetch('other', {'url': 'a'}, self._send())
+        ResponseCache(self.directory, 1024, {'src': -1}).fetch('src', {'url': 'a'}, self._send())
+        self.assertEqual(len(self.sent), 4)
+
+    def test_changing_responses_are_always_sent(self):
+        cache = ResponseCache(self.directory, 1024, {'src': 3600})
+        cache.fetch('src', {'url': 'a'}, self._send(b'old'), cacheable=False)
+        data = cache.fetch('src', {'url': 'a'}, self._send(b'new'), cacheable=False)
+        self.assertEqual(data, b'new')
+        self.assertEqual(len(self.sent), 2)
+
+    def test_failures_are_not_cached(self):
+        cache = ResponseCache(self.directory, 1024, {'src': 3600})
+        self.assertIsNone(cache.fetch('src', {'url': 'a'}, self._send(None)))
+        cache.fetch('src', {'url': 'a'}, self._send())
+        self.assertEqual(len(self.sent), 2)
+
+    def test_offline(self):
+        ResponseCache(self.directory, 1024, {'src': 3600}).fetch(
+            'src', {'url': 'a'}, self._send(), cacheable=False
+        )
+        offline = ResponseCache(self.directory, 1024, {'src': 3600}, offline=True)
+        data = offline.fetch('src', {'url': 'a'}, self._send(), cacheable=False)
+        self.assertEqual(data, b'response')
+        self.assertEqual(len(self.sent), 1)
+        with self.assertRaises(CacheMiss):
+            offline.fetch('src', {'url': 'b'}, self._send())
+
+    def test_replaced_responses_are_counted_once(self):
+        cache = ResponseCache(self.directory, 1024, {'src': 3600})
+        for i in range(5):
+            cache.fetch('src', {'url': 'a'}, self._send(), cacheable=False)
+        self.assertEqual(cache._size, len(b'response'))
+
+    def test_eviction(self):
+        cache = ResponseCache(self.directory, 250, {'src': 3600})
+        for i in range(5):
+            cache.fetch('src', {'url': i}, self._send(b'x' * 100))
+        self.assertLessEqual(sum(size for (_, _, size) in cache._list_files()), 250)
+
+        # The newest response is kept
+        cache.fetch('src', {'url': 4}, self._send())
+        self.assertEqual(len(self.sent), 5)
+
+
+class UserUploadTest(TestCase):
+
+    def setUp(self):
+        u = User.objects.create(username='testuser', email='test@user.com')
+        self.upload = UserUpload.objects.create(
+            user=u, file=SimpleUploadedFile("refs.bib", b"file_content")
+        )
+
+    def tearDown(self):
+        self.upload.delete()
+        self.upload.file.delete(save=False)
+
+    def test_cached_articles(self):
+        self.assertIsNone(self.upload.get_cached_articles())
+        article = Article(title='A cached article', pubdate=date(2019, 1, 2))
+        self.upload.cache_articles([article])
+
+        cached = self.upload.get_cached_articles()
+        self.assertEqual([a.title for a in cached], ['A cached article'])
+        self.assertEqual(cached[0].pubdate, date(2019, 1, 2))
+        # Both variants are cached separately
+        self.assertIsNone(self.upload.get_cached_articles(exhaustive=True))
+
+        # A new content invalidates the cache
+        with open(self.upload.file.path, 'wb') as f:
+            f.write(b"new_content")
+        self.assertIsNone(self.upload.get_cached_articles())
+
+
 class UserTest(TestCase):
 
     def _create_user(self, username, password):
@@ -218,6 +1241,64 @@ class ArticleTest(TestCase):
         self.assertRaises(IntegrityError, a2.save)
 
 
+    def test_store_articles(self):
+        Article.objects.create(title='Existing article', abstract='Abstract', pubdate=date.today())
+        long_title = 'x' * 300
+        articles = [
+            Article(title='Existing article', abstract='Abstract', pubdate=date.today()),
+            Article(title='New article', abstract='Abstract', pubdate=date.today()),
+            Article(title='New article', abstract='Other abstract', pubdate=date.today()),
+            Article(title=long_title, abstract='Abstract', pubdate=date.today()),
+            None,
+        ]
+        result = store_articles(articles)
+        self.assertEqual(result, IngestResult(inserted=2, duplicates=2))
+        self.assertEqual(Article.objects.count(), 3)
+
+        # Long titles are truncated just like in `Article.save()`
+        a = Article.objects.get(title=Article.truncate_title(long_title))
+        self.assertEqual(len(a.title), 255)
+        self.assertEqual(a.normalized_title, Article.normalize_title(a.title))
+
+        # Storing the same long title again is recognized as a duplicate
+        result = store_articles([Article(title=long_title, abstract='Abstract', pubdate=date.today())])
+        self.assertEqual(result, IngestResult(inserted=0, duplicates=1))
+
+
+    def test_known_identifiers(self):
+        Article.objects.create(
+            title='Known article', abstract='Abstract', pubdate=date.today(),
+            pmid='123', doi='10.1000/known'
+        )
+        self.assertEqual(drop_known_ids('pmid', ['124', '123', '125']), ['124', '125'])
+        self.assertEqual(drop_known_ids('doi', ['10.1000/known']), [])
+
+        # Articles with a known identifier are skipped, even with another title
+        result = store_articles([
+            Article(title='Renamed article', abstract='Abstract', pubdate=date.today(), pmid='123'),
+            Article(title='Preprint', abstract='Abstract', pubdate=date.today(), doi='10.1000/new'),
+            Article(title='Same preprint', abstract='Abstract', pubdate=date.today(), doi='10.1000/new'),
+        ])
+        self.assertEqual(result, IngestResult(inserted=1, duplicates=2))
+        self.assertTrue(Article.objects.filter(title='Preprint').exists())
+
+
+    def test_chunked(self):
+        for i in range(5):
+            Article.objects.create(
+                title='Article {}'.format(i), abstract='Abstract', pubdate=date.today()
+            )
+        pks = list(Article.objects.order_by('pk').values_list('pk', flat=True))
+
+        # The ordering of the queryset is replaced by the primary key
+        chunks = list(chunked(Article.objects.order_by('-pk'), 2, ['title']))
+        self.assertEqual([len(c) for c in chunks], [2, 2, 1])
+        self.assertEqual([a.pk for c in chunks for a in c], pks)
+        self.assertEqual(chunks[0][0].title, 'Article 0')
+
+        self.assertEqual(list(chunked(Article.objects.none(), 2)), [])
+
+
 class RecommendationTest(TestCase):
 
     def setUp(self):
@@ -259,6 +1340,40 @@ class RecommendationTest(TestCase):
         self.assertRaises(IntegrityError, r2.save)
 
 
+    def test_upsert_scores(self):
+        u = User.objects.create(username='testuser', email='test@user.com')
+        a1 = Article.objects.all()[0]
+        a2 = Article.objects.create(
+            title='Another article',
+            abstract='Something else',
+            pubdate=date.today(),
+        )
+        Recommendation.objects.create(
+            user=u, article=a1, score=0.1, clicked=True, liked=True
+        )
+
+        Recommendation.objects.upsert_scores(u, [(a1.pk, 0.5), (a2.pk, 0.7)])
+        r1 = Recommendation.objects.get(user=u, article=a1)
+        r2 = Recommendation.objects.get(user=u, article=a2)
+        self.assertAlmostEqual(r1.score, 0.5)
+        self.assertAlmostEqual(r2.score, 0.7)
+        # Interactions are kept
+        self.assertTrue(r1.clicked)
+        self.assertTrue(r1.liked)
+        self.assertFalse(r2.clicked)
+
+        # Scores are updated in batches
+        Recommendation.objects.BATCH_SIZE = 1
+        try:
+            Recommendation.objects.upsert_scores(u.pk, [(a1.pk, 0.2), (a2.pk, 0.3)])
+        finally:
+            del Recommendation.objects.BATCH_SIZE
+        self.assertEqual(
+            list(Recommendation.objects.filter(user=u).values_list('score', flat=True)),
+            [0.3, 0.2]
+        )
+
+
     def test_create_recommendations(self):
         u = User.objects.create(username='testuser', email='test@user.com')
         trainer = Trainer()
@@ -273,3 +1388,29 @@ class RecommendationTest(TestCase):
         self.assertEqual(Recommendation.objects.all().count(), 0)
         call_command("create_recommendations", "--last-week")
         self.assertEqual(Recommendation.objects.all().count(), 1)
+
+
+    def test_score_new_articles(self):
+        u = User.objects.create(username='testuser', email='test@user.com')
+        trainer = Trainer()
+        for i in range(10):
+            trainer.add_data("This is a very interesting and relevant and important.", ml.Targets.INTERESTING)
+            trainer.add_data("This is totally boring and irrelevant. Do not read it.", ml.Targets.IRRELEVANT)
+        model = trainer.train()
+        u.classifier.classifier = model.classifier
+        u.classifier.vectorizer = model.vectorizer
+        u.classifier.save()
+
+        new = Article.objects.create(
+            title='A new article', abstract='Very interesting', pubdate=date.today()
+        )
+        batch = IngestBatch.objects.create(first_article_id=new.pk, last_article_id=new.pk)
+
+        # Only the articles of new batches are scored, and only once
+        for i in range(2):
+            call_command("create_recommendations", "--new-articles")
+            self.assertEqual(
+                list(Recommendation.objects.values_list('article', flat=True)), [new.pk]
+            )
+        batch.refresh_from_db()
+        self.assertTrue(batch.scored)